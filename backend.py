@@ -2,23 +2,49 @@ import argparse
 from getpass import getpass
 from chessmen import chessmenServer, chessmenClient
 from chessmen.utils import get_env, update_env, string_hash
+from chessmen.logger import LOG_LEVELS
+from chessmen.cluster import chessmenDispatcher
+from chessmen.store import chessmenWALStore
+from chessmen.archive import chessmenArchive
 
-parser = argparse.ArgumentParser(description="chessmen server backend interface")
-parser.add_argument("action", help="server action to be taken", type=str, choices=["start", "kill", "update_pass"])
-args = parser.parse_args()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="chessmen server backend interface")
+    parser.add_argument("action", help="server action to be taken", type=str, choices=["start", "kill", "dump", "update_pass"])
+    parser.add_argument("--rated", help="pair users by rating (start only)", action="store_true")
+    parser.add_argument("--authoritative", help="only accept moves validated by the server, not client fens (start only)", action="store_true")
+    parser.add_argument("--bots", help="let a bot play users that wait alone in queue (start only)", action="store_true")
+    parser.add_argument("--bot_processes", help="processes bots search on, one per core if not given (start only)", type=int, default=0)
+    parser.add_argument("--shards", help="run as a dispatcher in front of this many server processes (start only)", type=int, default=0)
+    parser.add_argument("--data_dir", help="keep matches in a write-ahead log in this directory, resumed on restart (start only)", type=str, default=None)
+    parser.add_argument("--archive_dir", help="keep finished games in an archive in this directory (start only)", type=str, default=None)
+    parser.add_argument("--log_level", help="server log level (start only)", type=str, choices=LOG_LEVELS, default="INFO")
+    parser.add_argument("--log_file", help="server log file, stdout if not given (start only)", type=str, default=None)
+    args = parser.parse_args()
+    # the dispatcher pairs users first come first served and shards run no bots
+    if args.shards > 0 and (args.rated or args.bots):
+        parser.error("--rated and --bots cannot be used with --shards")
 
-passwd = getpass("enter server password: ")
+    passwd = getpass("enter server password: ")
 
-if args.action == "start":
-    server = chessmenServer(server_password=passwd)
-    server.run()
-elif args.action == "kill":
-    chessmenClient(server_password=passwd).kill_server()
-elif args.action == "update_pass":
-    envs = get_env(return_json=True)
-    if string_hash(passwd) == envs["server_password"]:
-        new_passwd = getpass("enter new server password: ")
-        envs["server_password"] = string_hash(passwd)
-        update_env(envs)
-    else:
-        print(f"incorrect password")
+    if args.action == "start" and args.shards > 0:
+        dispatcher = chessmenDispatcher(server_password=passwd, shards=args.shards, authoritative=args.authoritative, log_level=args.log_level, log_file=args.log_file,
+                                        data_dir=args.data_dir, archive_dir=args.archive_dir)
+        dispatcher.run()
+    elif args.action == "start":
+        store = chessmenWALStore(args.data_dir) if args.data_dir else None
+        archive = chessmenArchive(args.archive_dir) if args.archive_dir else None
+        server = chessmenServer(server_password=passwd, rated_matchmaking=args.rated, authoritative=args.authoritative, log_level=args.log_level, log_file=args.log_file,
+                                store=store, archive=archive, bots=args.bots, bot_processes=args.bot_processes)
+        server.run()
+    elif args.action == "kill":
+        chessmenClient(server_password=passwd).kill_server()
+    elif args.action == "dump":
+        chessmenClient(server_password=passwd).dump_state()
+    elif args.action == "update_pass":
+        envs = get_env(return_json=True)
+        if string_hash(passwd) == envs["server_password"]:
+            new_passwd = getpass("enter new server password: ")
+            envs["server_password"] = string_hash(passwd)
+            update_env(envs)
+        else:
+            print(f"incorrect password")
@@ -0,0 +1,65 @@
+import sys
+import time
+import argparse
+from typing import List, Tuple
+
+from chessmen import chessmenBoardUtility as CBU, FEN, START_FEN
+from chessmen.search import chessmenSearch, chessmenParallelSearch, SEARCH_PROCESSES
+
+# standard perft positions and their node counts per depth (https://www.chessprogramming.org/Perft_Results)
+PERFT_POSITIONS: List[Tuple[str, FEN, List[int]]] = [
+    ('initial', START_FEN, [20, 400, 8902, 197281, 4865609]),
+    ('kiwipete', 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1', [48, 2039, 97862, 4085603]),
+    ('position_3', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1', [14, 191, 2812, 43238, 674624]),
+    ('position_4', 'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1', [6, 264, 9467, 422333]),
+    ('position_5', 'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8', [44, 1486, 62379, 2103487]),
+    ('position_6', 'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10', [46, 2079, 89890, 3894594]),
+]
+
+def benchmark_perft(depth: int) -> bool:
+    passed = True
+    total_nodes, total_time = 0, 0.0
+    print(f"{'position':<12} {'depth':>5} {'nodes':>10} {'expected':>10} {'status':>6} {'time (s)':>9} {'nodes/sec':>10}")
+    for name, fen, expected_nodes in PERFT_POSITIONS:
+        board_state = CBU.fen2board_state(fen)
+        max_depth = min(depth, len(expected_nodes))
+        start_time = time.perf_counter()
+        nodes = CBU.perft(board_state, max_depth)
+        elapsed = time.perf_counter() - start_time
+        status = 'ok' if nodes == expected_nodes[max_depth - 1] else 'FAIL'
+        passed = passed and status == 'ok'
+        total_nodes += nodes
+        total_time += elapsed
+        print(f"{name:<12} {max_depth:>5} {nodes:>10} {expected_nodes[max_depth - 1]:>10} {status:>6} {elapsed:>9.3f} {nodes / elapsed:>10.0f}")
+    print(f"{'total':<12} {'':>5} {total_nodes:>10} {'':>10} {'ok' if passed else 'FAIL':>6} {total_time:>9.3f} {total_nodes / total_time:>10.0f}")
+    return passed
+
+def benchmark_search(time_budget: float, processes: int) -> bool:
+    # serial search against the lazy smp search over the perft positions, both given the same time
+    parallel_search = chessmenParallelSearch(processes) if processes > 1 else None
+    print(f"{'position':<12} {'mode':>8} {'depth':>5} {'nodes':>10} {'time (s)':>9} {'nodes/sec':>10}")
+    try:
+        for name, fen, _ in PERFT_POSITIONS:
+            for mode, search in (('serial', chessmenSearch()), (f'{processes} procs', parallel_search)):
+                if search == None:
+                    continue
+                result = search.search(CBU.fen2board_state(fen), time_budget)
+                print(f"{name:<12} {mode:>8} {result.depth:>5} {result.nodes:>10} {result.time:>9.3f} {result.nodes / result.time:>10.0f}")
+    finally:
+        if parallel_search != None:
+            parallel_search.close()
+    return True
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='chessmen engine benchmarks')
+    parser.add_argument('suite', help='benchmark suite to run', type=str, choices=['perft', 'search'])
+    parser.add_argument('--depth', help='maximum perft depth per position', type=int, default=3)
+    parser.add_argument('--time', help='seconds of search per position', type=float, default=1.0)
+    parser.add_argument('--processes', help='processes of the parallel search', type=int, default=SEARCH_PROCESSES)
+    args = parser.parse_args()
+
+    if args.suite == 'perft':
+        passed = benchmark_perft(args.depth)
+    elif args.suite == 'search':
+        passed = benchmark_search(args.time, args.processes)
+    sys.exit(0 if passed else 1)
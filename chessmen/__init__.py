@@ -1,3 +1,3 @@
 from .client import chessmenClient
 from .server import chessmenServer
-from .engine import chessmenMove, chessmenBoardState, chessmenBoardUtility, COORD, BOARD, FEN, PIECE_COLOR, START_FEN
\ No newline at end of file
+from .engine import chessmenMove, chessmenBoardState, chessmenBoardUtility, COORD, BOARD, FEN, PIECE_COLOR, START_FEN, GAME_STATUS
\ No newline at end of file
@@ -0,0 +1,37 @@
+import multiprocessing
+from dataclasses import dataclass
+from typing import Iterable, Iterator
+
+from .engine import FEN, chessmenBoardUtility
+from .bitboard import popcount
+from .search import PIECE_VALUES
+from .utils import imap_bounded
+
+ANALYSIS_CHUNK_SIZE = 256 # positions per task
+ANALYSIS_MAX_IN_FLIGHT = 4 # tasks per process submitted ahead of the consumer
+
+@dataclass
+class chessmenPositionAnalysis:
+    legal_moves: int
+    check: bool
+    checkmate: bool
+    stalemate: bool
+    material: int # centipawns of white minus those of black
+
+def analyze_fen(fen: FEN) -> chessmenPositionAnalysis:
+    board_state = chessmenBoardUtility.fen2board_state(fen)
+    legal_moves = len(chessmenBoardUtility.generate_legal_moves(board_state))
+    check = chessmenBoardUtility.is_in_check(board_state, board_state.active_color)
+    pieces = board_state.bitboard.pieces
+    material = sum(PIECE_VALUES[piece.lower()] * (popcount(bb) if piece.isupper() else -popcount(bb)) for piece, bb in pieces.items())
+    return chessmenPositionAnalysis(legal_moves, check, check and legal_moves == 0, not check and legal_moves == 0, material)
+
+def analyze_fens(fens: Iterable[FEN], processes: int = 0, chunk_size: int = ANALYSIS_CHUNK_SIZE) -> Iterator[chessmenPositionAnalysis]:
+    # analyses in the order of the fens, with processes > 0 they are worked out on a pool of that many processes
+    # fens are read only as far as the pool is ahead of the consumer, so any iterable (a file, a generator) streams through
+    if processes <= 0:
+        for fen in fens:
+            yield analyze_fen(fen)
+        return
+    with multiprocessing.Pool(processes) as pool:
+        yield from imap_bounded(pool, analyze_fen, fens, chunk_size, processes * ANALYSIS_MAX_IN_FLIGHT)
@@ -0,0 +1,175 @@
+import os
+import mmap
+import struct
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple, Optional, Iterator
+
+from .engine import FEN, START_FEN, chessmenMove, chessmenBoardState, chessmenBoardUtility
+from .protocol import decode_move
+from .logger import get_logger
+
+ARCHIVE_SEGMENT_SIZE = 64 * 1024 * 1024 # bytes, a new segment is started once the current one would grow past this
+SEGMENT_FILE = "games_{:06d}.dat"
+# result, match id length, white user id length, black user id length, start fen length (0 for START_FEN), number of moves
+# followed by the strings and the moves (2 bytes each, see protocol.encode_move)
+RECORD_HEADER = struct.Struct('!BHHHHH') # string lengths take 2 bytes, the server does not limit user ids
+RESULT_NONE = 0xFF # result byte of games without a result, otherwise twice the score of white
+
+logger = get_logger("archive")
+
+@dataclass
+class chessmenArchivedGame:
+    match_id: str
+    white_user_id: str
+    black_user_id: str
+    result: Optional[float] = None # score of white (1, 0.5 or 0)
+    start_fen: FEN = START_FEN
+    moves: List[int] = field(default_factory=list, repr=False) # encoded moves (see protocol.encode_move)
+
+    def encode(self) -> bytes:
+        match_id, white_user_id, black_user_id = self.match_id.encode(), self.white_user_id.encode(), self.black_user_id.encode()
+        start_fen = b'' if self.start_fen == START_FEN else self.start_fen.encode()
+        result = RESULT_NONE if self.result == None else int(self.result * 2)
+        header = RECORD_HEADER.pack(result, len(match_id), len(white_user_id), len(black_user_id), len(start_fen), len(self.moves))
+        return header + match_id + white_user_id + black_user_id + start_fen + struct.pack(f'!{len(self.moves)}H', *self.moves)
+
+    @staticmethod
+    def record_length(buffer: bytes, offset: int) -> int:
+        _, *lengths, move_count = RECORD_HEADER.unpack_from(buffer, offset)
+        return RECORD_HEADER.size + sum(lengths) + 2 * move_count
+
+    @staticmethod
+    def decode(buffer: bytes, offset: int = 0) -> 'chessmenArchivedGame':
+        result, *lengths, move_count = RECORD_HEADER.unpack_from(buffer, offset)
+        offset += RECORD_HEADER.size
+        strings = []
+        for length in lengths:
+            strings.append(bytes(buffer[offset: offset + length]).decode())
+            offset += length
+        match_id, white_user_id, black_user_id, start_fen = strings
+        return chessmenArchivedGame(
+            match_id=match_id,
+            white_user_id=white_user_id,
+            black_user_id=black_user_id,
+            result=None if result == RESULT_NONE else result / 2,
+            start_fen=start_fen or START_FEN,
+            moves=list(struct.unpack_from(f'!{move_count}H', buffer, offset))
+        )
+
+    def replay(self) -> Iterator[Tuple[chessmenBoardState, chessmenMove]]:
+        # yields the position before every move along with the move, the position is updated in place once the next one is asked for
+        board_state = chessmenBoardUtility.fen2board_state(self.start_fen)
+        for value in self.moves:
+            start_coord, target_coord, promotion = decode_move(value)
+            for move in chessmenBoardUtility.get_valid_moves(start_coord, board_state):
+                if move.target_coord == target_coord and move.promotion == promotion:
+                    break
+            else:
+                raise ValueError(f"archived move {value} of match {self.match_id} is not legal")
+            yield board_state, move
+            board_state.update(move)
+
+class chessmenArchive:
+    """ chessmenArchive keeps finished games in append-only segment files, indexed by match and by player """
+    def __init__(self, directory: str, segment_size: int = ARCHIVE_SEGMENT_SIZE) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        # match id -> (segment, offset), user id -> match ids (oldest first)
+        self.offsets: Dict[str, Tuple[int, int]] = {}
+        self.players: Dict[str, List[str]] = {}
+        # read-only maps of the segments, remapped when a read goes past the end of the map of the segment being written
+        self.maps: Dict[int, mmap.mmap] = {}
+        segments = sorted(int(name[6: -4]) for name in os.listdir(directory) if name.startswith("games_") and name.endswith(".dat"))
+        for segment in segments:
+            self._load_segment(segment)
+        self.segment = segments[-1] if segments else 0
+        self.writer = open(self._segment_path(self.segment), 'ab')
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __contains__(self, match_id: str) -> bool:
+        return match_id in self.offsets
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, SEGMENT_FILE.format(segment))
+
+    def _index(self, match_id: str, white_user_id: str, black_user_id: str, segment: int, offset: int) -> None:
+        self.offsets[match_id] = (segment, offset)
+        self.players.setdefault(white_user_id, []).append(match_id)
+        self.players.setdefault(black_user_id, []).append(match_id)
+
+    def _load_segment(self, segment: int) -> None:
+        # index every complete record, a torn record at the end (crash during an append) is cut off
+        path = self._segment_path(segment)
+        size = os.path.getsize(path)
+        if size == 0:
+            return
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = 0
+        while offset + RECORD_HEADER.size <= size:
+            length = chessmenArchivedGame.record_length(buffer, offset)
+            if offset + length > size:
+                break
+            _, match_id_length, white_length, black_length, _, _ = RECORD_HEADER.unpack_from(buffer, offset)
+            position = offset + RECORD_HEADER.size
+            match_id = buffer[position: position + match_id_length].decode()
+            position += match_id_length
+            white_user_id = buffer[position: position + white_length].decode()
+            position += white_length
+            black_user_id = buffer[position: position + black_length].decode()
+            self._index(match_id, white_user_id, black_user_id, segment, offset)
+            offset += length
+        if offset < size:
+            logger.warning("archive segment truncated segment=%d size=%d kept=%d", segment, size, offset)
+            buffer.close()
+            os.truncate(path, offset)
+            return
+        self.maps[segment] = buffer
+
+    def append(self, game: chessmenArchivedGame) -> None:
+        record = game.encode()
+        offset = self.writer.tell()
+        if offset > 0 and offset + len(record) > self.segment_size:
+            self.writer.close()
+            self.segment += 1
+            self.writer = open(self._segment_path(self.segment), 'ab')
+            offset = 0
+        self.writer.write(record)
+        self.writer.flush()
+        self._index(game.match_id, game.white_user_id, game.black_user_id, self.segment, offset)
+
+    def _map(self, segment: int, end: int) -> mmap.mmap:
+        buffer = self.maps.get(segment)
+        if buffer == None or len(buffer) < end:
+            if buffer != None:
+                buffer.close()
+            with open(self._segment_path(segment), 'rb') as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = buffer
+        return buffer
+
+    def get(self, match_id: str) -> Optional[chessmenArchivedGame]:
+        if match_id not in self.offsets:
+            return None
+        segment, offset = self.offsets[match_id]
+        buffer = self._map(segment, offset + RECORD_HEADER.size)
+        buffer = self._map(segment, offset + chessmenArchivedGame.record_length(buffer, offset))
+        return chessmenArchivedGame.decode(buffer, offset)
+
+    def games_of(self, user_id: str) -> List[str]:
+        # match ids of the archived games of a user, oldest first
+        return list(self.players.get(user_id, []))
+
+    def __iter__(self) -> Iterator[chessmenArchivedGame]:
+        # every game in the order it was archived
+        for match_id in list(self.offsets):
+            yield self.get(match_id)
+
+    def close(self) -> None:
+        self.writer.close()
+        for buffer in self.maps.values():
+            buffer.close()
+        self.maps = {}
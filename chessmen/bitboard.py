@@ -0,0 +1,283 @@
+import random
+from typing import Dict, List, Tuple, Iterator, Optional
+
+BITBOARD = int
+SQUARE = int
+
+# square layout follows the board representation in engine.py
+# (0, 0) -> 0 (a8)    ->    (0, 7) -> 7 (h8)
+# (7, 0) -> 56 (a1)   ->    (7, 7) -> 63 (h1)
+
+PIECES = 'PNBRQKpnbrqk'
+WHITE_PIECES = 'PNBRQK'
+BLACK_PIECES = 'pnbrqk'
+FULL_BOARD: BITBOARD = (1 << 64) - 1
+SQUARE2COORD: List[Tuple[int, int]] = [(sq >> 3, sq & 7) for sq in range(64)]
+
+def square(row: int, col: int) -> SQUARE:
+    return (row << 3) | col
+
+def lsb(bb: BITBOARD) -> SQUARE:
+    return (bb & -bb).bit_length() - 1
+
+def msb(bb: BITBOARD) -> SQUARE:
+    return bb.bit_length() - 1
+
+def popcount(bb: BITBOARD) -> int:
+    return bin(bb).count('1')
+
+def iter_squares(bb: BITBOARD) -> Iterator[SQUARE]:
+    while bb:
+        bit = bb & -bb
+        yield bit.bit_length() - 1
+        bb ^= bit
+
+def _leaper_table(offsets: List[Tuple[int, int]]) -> List[BITBOARD]:
+    table = []
+    for row in range(8):
+        for col in range(8):
+            bb = 0
+            for drow, dcol in offsets:
+                r, c = row + drow, col + dcol
+                if r >= 0 and r <= 7 and c >= 0 and c <= 7:
+                    bb |= 1 << square(r, c)
+            table.append(bb)
+    return table
+
+def _ray_table(drow: int, dcol: int) -> List[BITBOARD]:
+    table = []
+    for row in range(8):
+        for col in range(8):
+            bb = 0
+            r, c = row + drow, col + dcol
+            while r >= 0 and r <= 7 and c >= 0 and c <= 7:
+                bb |= 1 << square(r, c)
+                r, c = r + drow, c + dcol
+            table.append(bb)
+    return table
+
+KNIGHT_ATTACKS = _leaper_table([(-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1)])
+KING_ATTACKS = _leaper_table([(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)])
+# white pawns move towards row 0, black pawns towards row 7
+PAWN_ATTACKS: Dict[str, List[BITBOARD]] = {
+    'white': _leaper_table([(-1, -1), (-1, 1)]),
+    'black': _leaper_table([(1, -1), (1, 1)]),
+}
+
+# a direction is positive if it walks towards higher square indices, the nearest blocker on a
+# positive ray is then its least significant bit and on a negative ray its most significant bit
+ROOK_DIRECTIONS = [(-1, 0), (0, -1), (0, 1), (1, 0)]
+BISHOP_DIRECTIONS = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+RAYS: Dict[Tuple[int, int], List[BITBOARD]] = {direction: _ray_table(*direction) for direction in ROOK_DIRECTIONS + BISHOP_DIRECTIONS}
+_ROOK_RAYS = [(RAYS[d], d[0] > 0 or (d[0] == 0 and d[1] > 0)) for d in ROOK_DIRECTIONS]
+_BISHOP_RAYS = [(RAYS[d], d[0] > 0) for d in BISHOP_DIRECTIONS]
+
+def _between_table() -> List[List[BITBOARD]]:
+    # tiles strictly between two squares on a common line (0 if they are not aligned)
+    table = [[0] * 64 for _ in range(64)]
+    for sq in range(64):
+        row, col = SQUARE2COORD[sq]
+        for drow, dcol in ROOK_DIRECTIONS + BISHOP_DIRECTIONS:
+            bb = 0
+            r, c = row + drow, col + dcol
+            while r >= 0 and r <= 7 and c >= 0 and c <= 7:
+                table[sq][square(r, c)] = bb
+                bb |= 1 << square(r, c)
+                r, c = r + drow, c + dcol
+    return table
+
+BETWEEN = _between_table()
+
+# zobrist keys (https://www.chessprogramming.org/Zobrist_Hashing), fixed seed so hashes are stable across processes
+_zobrist_random = random.Random(0x636865737373)
+ZOBRIST_PIECES: Dict[str, List[int]] = {piece: [_zobrist_random.getrandbits(64) for _ in range(64)] for piece in PIECES}
+ZOBRIST_CASTLING: Dict[str, int] = {right: _zobrist_random.getrandbits(64) for right in 'KQkq'}
+ZOBRIST_EN_PASSANT: List[int] = [_zobrist_random.getrandbits(64) for _ in range(8)] # per column
+ZOBRIST_BLACK_TO_MOVE: int = _zobrist_random.getrandbits(64)
+
+def _slider_attacks(sq: SQUARE, occupancy: BITBOARD, rays: List[Tuple[List[BITBOARD], bool]]) -> BITBOARD:
+    attacks = 0
+    for table, positive in rays:
+        ray = table[sq]
+        blockers = ray & occupancy
+        if blockers:
+            # cut the ray behind the nearest blocker (the blocker itself stays attacked)
+            if positive:
+                ray ^= table[(blockers & -blockers).bit_length() - 1]
+            else:
+                ray ^= table[blockers.bit_length() - 1]
+        attacks |= ray
+    return attacks
+
+def rook_attacks(sq: SQUARE, occupancy: BITBOARD) -> BITBOARD:
+    return _slider_attacks(sq, occupancy, _ROOK_RAYS)
+
+def bishop_attacks(sq: SQUARE, occupancy: BITBOARD) -> BITBOARD:
+    return _slider_attacks(sq, occupancy, _BISHOP_RAYS)
+
+def queen_attacks(sq: SQUARE, occupancy: BITBOARD) -> BITBOARD:
+    return _slider_attacks(sq, occupancy, _ROOK_RAYS) | _slider_attacks(sq, occupancy, _BISHOP_RAYS)
+
+class chessmenBitboard:
+    """ chessmenBitboard stores the position as twelve 64-bit piece masks plus occupancy masks """
+    def __init__(self) -> None:
+        self.pieces: Dict[str, BITBOARD] = {piece: 0 for piece in PIECES}
+        self.occupancy: Dict[str, BITBOARD] = {'white': 0, 'black': 0}
+        self.all: BITBOARD = 0
+        self.zobrist: int = 0 # hash of the piece placement
+
+    @staticmethod
+    def from_board(board: List[List[str]]) -> 'chessmenBitboard':
+        bitboard = chessmenBitboard()
+        for row in range(8):
+            for col in range(8):
+                if board[row][col] != ' ':
+                    bitboard.add_piece(square(row, col), board[row][col])
+        return bitboard
+
+    def copy(self) -> 'chessmenBitboard':
+        bitboard = chessmenBitboard.__new__(chessmenBitboard)
+        bitboard.pieces = self.pieces.copy()
+        bitboard.occupancy = self.occupancy.copy()
+        bitboard.all = self.all
+        bitboard.zobrist = self.zobrist
+        return bitboard
+
+    def add_piece(self, sq: SQUARE, piece: str) -> None:
+        bit = 1 << sq
+        self.pieces[piece] |= bit
+        self.occupancy['white' if piece.isupper() else 'black'] |= bit
+        self.all |= bit
+        self.zobrist ^= ZOBRIST_PIECES[piece][sq]
+
+    def remove_piece(self, sq: SQUARE, piece: str) -> None:
+        mask = ~(1 << sq)
+        self.pieces[piece] &= mask
+        self.occupancy['white' if piece.isupper() else 'black'] &= mask
+        self.all &= mask
+        self.zobrist ^= ZOBRIST_PIECES[piece][sq]
+
+    def key(self) -> int:
+        # identity of the piece placement
+        return self.zobrist
+
+    def piece_at(self, sq: SQUARE) -> Optional[str]:
+        if not (self.all >> sq) & 1:
+            return None
+        for piece, bb in self.pieces.items():
+            if (bb >> sq) & 1:
+                return piece
+
+    def attacks_from(self, sq: SQUARE, piece: str, occupancy: BITBOARD = None) -> BITBOARD:
+        if occupancy == None:
+            occupancy = self.all
+        kind = piece.lower()
+        if kind == 'p':
+            return PAWN_ATTACKS['white' if piece.isupper() else 'black'][sq]
+        elif kind == 'n':
+            return KNIGHT_ATTACKS[sq]
+        elif kind == 'b':
+            return bishop_attacks(sq, occupancy)
+        elif kind == 'r':
+            return rook_attacks(sq, occupancy)
+        elif kind == 'q':
+            return queen_attacks(sq, occupancy)
+        return KING_ATTACKS[sq]
+
+    def attackers_to(self, sq: SQUARE, color: str, occupancy: BITBOARD = None) -> BITBOARD:
+        # pieces of the given color that attack the square
+        if occupancy == None:
+            occupancy = self.all
+        pieces = self.pieces
+        if color == 'white':
+            knight, bishop, rook, queen, king = 'N', 'B', 'R', 'Q', 'K'
+            # a white pawn attacks sq exactly when a black pawn on sq would attack it
+            attackers = PAWN_ATTACKS['black'][sq] & pieces['P']
+        else:
+            knight, bishop, rook, queen, king = 'n', 'b', 'r', 'q', 'k'
+            attackers = PAWN_ATTACKS['white'][sq] & pieces['p']
+        attackers |= KNIGHT_ATTACKS[sq] & pieces[knight]
+        attackers |= KING_ATTACKS[sq] & pieces[king]
+        diagonal = pieces[bishop] | pieces[queen]
+        if diagonal:
+            attackers |= bishop_attacks(sq, occupancy) & diagonal
+        straight = pieces[rook] | pieces[queen]
+        if straight:
+            attackers |= rook_attacks(sq, occupancy) & straight
+        return attackers
+
+    def is_attacked(self, sq: SQUARE, color: str, occupancy: BITBOARD = None) -> bool:
+        # same as attackers_to, but stops at the first attacking piece type
+        if occupancy == None:
+            occupancy = self.all
+        pieces = self.pieces
+        if color == 'white':
+            if PAWN_ATTACKS['black'][sq] & pieces['P'] or KNIGHT_ATTACKS[sq] & pieces['N'] or KING_ATTACKS[sq] & pieces['K']:
+                return True
+            diagonal = pieces['B'] | pieces['Q']
+            straight = pieces['R'] | pieces['Q']
+        else:
+            if PAWN_ATTACKS['white'][sq] & pieces['p'] or KNIGHT_ATTACKS[sq] & pieces['n'] or KING_ATTACKS[sq] & pieces['k']:
+                return True
+            diagonal = pieces['b'] | pieces['q']
+            straight = pieces['r'] | pieces['q']
+        if diagonal and bishop_attacks(sq, occupancy) & diagonal:
+            return True
+        if straight and rook_attacks(sq, occupancy) & straight:
+            return True
+        return False
+
+class chessmenAttackMap:
+    """ chessmenAttackMap holds the tiles attacked by each color, built once per position """
+    # sliding attacks pass through the opposite king, so a tile behind the king (away from the
+    # attacker) also counts as attacked, which is what king moves need to be checked against
+
+    def __init__(self) -> None:
+        self.attacks: List[BITBOARD] = [0] * 64 # attacks of the piece on each square
+        self.by_color: Dict[str, BITBOARD] = {'white': 0, 'black': 0}
+        self.occupancy: BITBOARD = 0 # occupancy the map was built for
+
+    @staticmethod
+    def _piece_attacks(bitboard: chessmenBitboard, sq: SQUARE, piece: str) -> BITBOARD:
+        opposite_king = 'k' if piece.isupper() else 'K'
+        return bitboard.attacks_from(sq, piece, bitboard.all & ~bitboard.pieces[opposite_king])
+
+    def _merge(self, bitboard: chessmenBitboard) -> None:
+        for color in ('white', 'black'):
+            attacked = 0
+            for sq in iter_squares(bitboard.occupancy[color]):
+                attacked |= self.attacks[sq]
+            self.by_color[color] = attacked
+
+    @staticmethod
+    def from_bitboard(bitboard: chessmenBitboard) -> 'chessmenAttackMap':
+        attack_map = chessmenAttackMap()
+        attack_map.occupancy = bitboard.all
+        for piece, bb in bitboard.pieces.items():
+            for sq in iter_squares(bb):
+                attack_map.attacks[sq] = chessmenAttackMap._piece_attacks(bitboard, sq, piece)
+        attack_map._merge(bitboard)
+        return attack_map
+
+    def updated(self, bitboard: chessmenBitboard, changed: BITBOARD) -> 'chessmenAttackMap':
+        # new map for the position after the given squares changed, only the pieces on those squares
+        # and the sliders whose rays reach them are recomputed
+        pieces = bitboard.pieces
+        # kings are transparent to sliders, and a square only counts as a blocker if it was
+        # occupied both before and after, so every slider that could have changed is found
+        occupancy = self.occupancy & bitboard.all & ~(pieces['K'] | pieces['k'])
+        straight = pieces['R'] | pieces['Q'] | pieces['r'] | pieces['q']
+        diagonal = pieces['B'] | pieces['Q'] | pieces['b'] | pieces['q']
+        affected = changed
+        for sq in iter_squares(changed):
+            affected |= rook_attacks(sq, occupancy) & straight
+            affected |= bishop_attacks(sq, occupancy) & diagonal
+        attack_map = chessmenAttackMap.__new__(chessmenAttackMap)
+        attack_map.attacks = self.attacks.copy()
+        attack_map.by_color = {}
+        attack_map.occupancy = bitboard.all
+        for sq in iter_squares(affected):
+            piece = bitboard.piece_at(sq)
+            attack_map.attacks[sq] = 0 if piece == None else chessmenAttackMap._piece_attacks(bitboard, sq, piece)
+        attack_map._merge(bitboard)
+        return attack_map
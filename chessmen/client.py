@@ -1,14 +1,17 @@
 import socket
+import select
 from typing import Optional, Tuple, List
 
-from .engine import FEN, PIECE_COLOR
-from .utils import get_env, random_hash, string_hash
+from .engine import FEN, PIECE_COLOR, chessmenMove, chessmenBoardState, chessmenBoardUtility
+from .utils import get_env, random_hash, string_hash, send_frame, recv_frame
+from .protocol import NO_VERSION, MOVE, WAIT, REQUEST_OPCODES, REPLY_SUCCESS, REPLY_IN_QUEUE, REPLY_IN_MATCH, REPLY_UNCHANGED, REPLY_MOVES, REPLY_MATCH_OVER, FLAG_USER_TURN, FLAG_USER_WHITE
+from .protocol import encode_move, decode_move, encode_message, decode_message, decode_match, decode_moves, decode_match_over
 
 IP_ADDR, PORT, BUFFER_SIZE, SERVER_HASH = get_env()
 MAX_USERNAME_LEN = 20
 
 class chessmenClient:
-    def __init__(self, user_id: str = None, server_password: str = None) -> None:
+    def __init__(self, user_id: str = None, server_password: str = None, persistent: bool = False, binary: bool = False) -> None:
         if user_id:
             self.user_id = "player_" + user_id.replace(':', '').replace('|', '').replace(' ', '_')[: MAX_USERNAME_LEN]
         else:
@@ -16,6 +19,20 @@ class chessmenClient:
         self.is_admin = False
         if server_password and string_hash(server_password) == SERVER_HASH:
             self.is_admin = True
+        # persistent mode keeps one connection open and sends length-prefixed frames over it
+        # binary mode (always persistent) sends binary messages instead of text over those frames
+        self.persistent = persistent or binary
+        self.binary = binary
+        # binary status replies only carry the moves since the last version, applied to this board (with white, black user ids and version)
+        self.binary_match: Optional[Tuple[chessmenBoardState, str, str, int]] = None
+        self.connection: Optional[socket.socket] = None
+        # separate persistent connection on which the server pushes match updates
+        self.subscription: Optional[socket.socket] = None
+        # last match version seen and its parsed status (served again when the server answers "unchanged")
+        self.match_version: Optional[int] = None
+        self.last_match_status: Optional[Tuple[str, Optional[Tuple[FEN, Tuple[str, str], PIECE_COLOR, bool]]]] = None
+        # score of white and the reason the match ended, once the status is match_over
+        self.match_result: Optional[Tuple[float, str]] = None
 
     def kill_server(self) -> bool:
         if self.is_admin:
@@ -26,25 +43,92 @@ class chessmenClient:
             print("client does not have access to kill server")
             return False
 
+    def dump_state(self) -> bool:
+        if self.is_admin:
+            status, payload = self.request("DUMP_STATE")
+            print(payload)
+            return True if status == "success" else False
+        else:
+            print("client does not have access to dump server state")
+            return False
+
     def find_match(self) -> bool:
         status, payload = self.request("FIND_MATCH")
         if status == "success":
+            # versions start over in the new match
+            self.match_version = None
+            self.last_match_status = None
+            self.binary_match = None
+            self.match_result = None
             return True
         else:
             print(payload)
             return False
 
-    def status_match(self) -> Optional[Tuple[str, Optional[Tuple[FEN, Tuple[str, str], PIECE_COLOR, bool]]]]:
-        status, payload = self.request("STATUS_MATCH")
+    def _parse_match_status(self, payload: str) -> Tuple[str, Optional[Tuple[FEN, Tuple[str, str], PIECE_COLOR, bool]]]:
+        payload = payload.split("|")
+        if payload[0] == "unchanged" and self.last_match_status != None:
+            return self.last_match_status
+        if payload[0] == "in_queue":
+            self.match_version = 0
+            self.last_match_status = payload[0], None
+        elif payload[0] == "match_over":
+            fen, white_user_id, black_user_id, white_score, version, reason = payload[1: ]
+            user_color = 'white' if white_user_id == self.user_id else 'black'
+            users = (white_user_id, black_user_id) if user_color == 'white' else (black_user_id, white_user_id)
+            self.match_version = int(version)
+            self.match_result = float(white_score), reason
+            self.last_match_status = payload[0], (fen, users, user_color, False)
+        else:
+            fen, white_user_id, black_user_id, user_turn, version = payload[1: ]
+            user_color = 'white' if white_user_id == self.user_id else 'black'
+            users = (white_user_id, black_user_id) if user_color == 'white' else (black_user_id, white_user_id)
+            self.match_version = int(version)
+            self.last_match_status = payload[0], (fen, users, user_color, bool(int(user_turn)))
+        return self.last_match_status
+
+    def status_match(self, wait: float = 0) -> Optional[Tuple[str, Optional[Tuple[FEN, Tuple[str, str], PIECE_COLOR, bool]]]]:
+        # with wait > 0 the server holds the request until the match changes from the last seen version (or wait runs out)
+        args = [] if self.match_version == None else [str(self.match_version), str(wait)]
+        status, payload = self.request("STATUS_MATCH", args)
         if status == "success":
-            payload = payload.split("|")
-            if payload[0] == "in_queue":
-                return payload[0], None
+            return self._parse_match_status(payload)
+        else:
+            print(payload)
+            return None
+
+    def subscribe_match(self) -> bool:
+        try:
+            self.subscription = self._open_connection()
+            if self.binary:
+                self.subscription.sendall(encode_message(REQUEST_OPCODES["SUBSCRIBE_MATCH"]))
             else:
-                fen, white_user_id, black_user_id, user_turn = payload[1: ]
-                user_color = 'white' if white_user_id == self.user_id else 'black'
-                users = (white_user_id, black_user_id) if user_color == 'white' else (black_user_id, white_user_id)
-                return payload[0], (fen, users, user_color, bool(int(user_turn)))
+                send_frame(self.subscription, f"SUBSCRIBE_MATCH::{self.user_id}::".encode())
+            return True
+        except socket.error as e:
+            self.subscription = None
+            print(e)
+            return False
+
+    def wait_match_update(self, timeout: Optional[float] = None) -> Optional[Tuple[str, Optional[Tuple[FEN, Tuple[str, str], PIECE_COLOR, bool]]]]:
+        # next pushed status (same as status_match), ('no_update', None) if nothing arrives within timeout
+        if self.subscription == None:
+            return None
+        try:
+            readable, _, _ = select.select([self.subscription], [], [], timeout)
+            if not readable:
+                return "no_update", None
+            message = recv_frame(self.subscription)
+            if message == None:
+                raise socket.error("server closed the subscription")
+        except socket.error as e:
+            self.subscription.close()
+            self.subscription = None
+            print(e)
+            return None
+        status, payload = self._decode_reply(message)
+        if status == "success":
+            return self._parse_match_status(payload)
         else:
             print(payload)
             return None
@@ -57,7 +141,43 @@ class chessmenClient:
             print(payload)
             return False
 
+    def make_move(self, move: chessmenMove) -> bool:
+        # the server validates and applies the move itself
+        args = [chessmenBoardUtility.coord2notation(move.start_coord), chessmenBoardUtility.coord2notation(move.target_coord), move.promotion or '']
+        status, payload = self.request("MAKE_MOVE", args)
+        if status == "success":
+            return True
+        else:
+            print(payload)
+            return False
+
+    def _open_connection(self) -> socket.socket:
+        connection = socket.socket()
+        connection.connect((IP_ADDR, PORT))
+        # handshake in the one-shot text format, every message after it is framed
+        connection.send(f"PERSIST::{self.user_id}::{'binary' if self.binary else ''}".encode())
+        status, payload = connection.recv(BUFFER_SIZE).decode().split("::")
+        if status != "success":
+            connection.close()
+            raise socket.error(payload)
+        return connection
+
+    def connect(self) -> None:
+        self.connection = self._open_connection()
+
+    def close(self) -> None:
+        if self.connection != None:
+            self.connection.close()
+            self.connection = None
+        if self.subscription != None:
+            self.subscription.close()
+            self.subscription = None
+
     def request(self, request_type: str, args: List[str] = []) -> Tuple[str, str]:
+        if self.binary:
+            return self._binary_request(request_type, args)
+        if self.persistent:
+            return self._persistent_request(request_type, args)
         server = socket.socket()
         try:
             server.connect((IP_ADDR, PORT)) # connect to server
@@ -71,3 +191,92 @@ class chessmenClient:
         except socket.error as e:
             print(e)
             return "error", str(e)
+
+    def _persistent_request(self, request_type: str, args: List[str] = []) -> Tuple[str, str]:
+        try:
+            if self.connection == None:
+                self.connect()
+            args = '|'.join(args)
+            send_frame(self.connection, f"{request_type}::{self.user_id}::{args}".encode())
+            response = recv_frame(self.connection)
+            if response == None:
+                raise socket.error("server closed the connection")
+            status, payload = response.decode().split("::")
+            return status, payload
+        except socket.error as e:
+            if self.connection != None: # reconnect on the next request
+                self.connection.close()
+                self.connection = None
+            print(e)
+            return "error", str(e)
+
+    def _binary_request(self, request_type: str, args: List[str] = []) -> Tuple[str, str]:
+        # same arguments and result as the text protocol
+        version, body = NO_VERSION, b''
+        if request_type == "STATUS_MATCH":
+            if args: # known version and wait
+                version, body = int(args[0]), WAIT.pack(float(args[1]))
+        elif request_type == "MAKE_MOVE":
+            start_coord, target_coord = chessmenBoardUtility.notation2coord(args[0]), chessmenBoardUtility.notation2coord(args[1])
+            body = MOVE.pack(encode_move(start_coord, target_coord, args[2] or None))
+        elif args:
+            body = args[0].encode()
+        try:
+            if self.connection == None:
+                self.connect()
+            self.connection.sendall(encode_message(REQUEST_OPCODES[request_type], version, body))
+            response = recv_frame(self.connection)
+            if response == None:
+                raise socket.error("server closed the connection")
+            return self._decode_reply(response)
+        except socket.error as e:
+            if self.connection != None: # reconnect on the next request
+                self.connection.close()
+                self.connection = None
+            print(e)
+            return "error", str(e)
+
+    def _decode_reply(self, message: bytes) -> Tuple[str, str]:
+        # (status, payload) in the text protocol format, from either protocol
+        if not self.binary:
+            status, payload = message.decode().split("::")
+            return status, payload
+        _, opcode, version, body = decode_message(message)
+        if opcode == REPLY_SUCCESS:
+            return "success", body.decode()
+        elif opcode == REPLY_IN_QUEUE:
+            return "success", "in_queue"
+        elif opcode == REPLY_UNCHANGED:
+            return "success", f"unchanged|{version}"
+        elif opcode == REPLY_MATCH_OVER:
+            flags, white_score, fen, reason, opponent_user_id = decode_match_over(body)
+            users = (self.user_id, opponent_user_id) if flags & FLAG_USER_WHITE else (opponent_user_id, self.user_id)
+            self.binary_match = None
+            return "success", '|'.join(['match_over', fen, *users, f"{white_score:g}", str(version), reason])
+        elif opcode == REPLY_IN_MATCH:
+            flags, fen, opponent_user_id = decode_match(body)
+            users = (self.user_id, opponent_user_id) if flags & FLAG_USER_WHITE else (opponent_user_id, self.user_id)
+            self.binary_match = (chessmenBoardUtility.fen2board_state(fen), *users, version)
+        elif opcode == REPLY_MOVES:
+            flags, moves = decode_moves(body)
+            if self.binary_match == None or version - self.binary_match[3] > len(moves):
+                # cannot catch up from here, ask for the full status next time
+                self.binary_match, self.match_version = None, None
+                return "error", "match status out of sync"
+            board_state, white_user_id, black_user_id, board_version = self.binary_match
+            # the moves lead up to version, skip the ones this board already has
+            for value in moves[len(moves) - (version - board_version): ]:
+                start_coord, target_coord, promotion = decode_move(value)
+                for move in chessmenBoardUtility.get_valid_moves(start_coord, board_state):
+                    if move.target_coord == target_coord and move.promotion == promotion:
+                        board_state.update(move)
+                        break
+                else: # the board went wrong somewhere, start over from the full status
+                    self.binary_match, self.match_version = None, None
+                    return "error", "match status out of sync"
+            self.binary_match = (board_state, white_user_id, black_user_id, max(version, board_version))
+        else: # REPLY_ERROR
+            return "error", body.decode()
+        board_state, white_user_id, black_user_id, board_version = self.binary_match
+        fen = chessmenBoardUtility.board_state2fen(board_state)
+        return "success", '|'.join(['in_match', fen, white_user_id, black_user_id, str(int(bool(flags & FLAG_USER_TURN))), str(board_version)])
@@ -0,0 +1,445 @@
+import os
+import time
+import bisect
+import random
+import socket
+import selectors
+import multiprocessing
+from collections import deque
+from typing import Dict, List, Set, Tuple, Optional, Callable, Deque
+
+from .server import chessmenServer, SELECT_TIMEOUT
+from .matchmaking import chessmenMatchQueue
+from .store import chessmenWALStore
+from .archive import chessmenArchive
+from .protocol import PROTOCOL_VERSION, REQUEST_OPCODES, REQUEST_TYPES, REPLY_SUCCESS, REPLY_ERROR, encode_message, decode_message
+from .logger import get_logger, start_logging, stop_logging
+from .utils import get_env, string_hash, encode_frame, decode_frames, send_frame, recv_frame
+
+IP_ADDR, PORT, BUFFER_SIZE, SERVER_HASH = get_env()
+SHARD_HOST = "127.0.0.1" # shards listen on PORT + 1, PORT + 2, ... of this host
+HASH_RING_REPLICAS = 64 # points per shard on the hash ring
+SHARD_START_TIMEOUT = 10 # seconds
+DISPATCHER_USER_ID = "dispatcher"
+
+logger = get_logger("cluster")
+
+class chessmenHashRing:
+    """ chessmenHashRing maps keys to shards by consistent hashing """
+    def __init__(self, shards: int, replicas: int = HASH_RING_REPLICAS) -> None:
+        points = sorted((self.hash(f"shard_{shard}_{replica}"), shard) for shard in range(shards) for replica in range(replicas))
+        self.points = [point for point, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    @staticmethod
+    def hash(key: str) -> int:
+        return int(string_hash(key)[: 16], 16)
+
+    def lookup(self, key: str) -> int:
+        # first point clockwise from the key
+        return self.shards[bisect.bisect(self.points, self.hash(key)) % len(self.points)]
+
+CONTROL_CALLBACK = Callable[[str, str], None] # status and payload of the reply
+
+class chessmenProxyConnection:
+    """ chessmenProxyConnection is a socket of the dispatcher event loop, from a client or to a shard """
+    def __init__(self, skt: socket.socket, address: Tuple[str, int], shard: Optional[int] = None, client: Optional['chessmenProxyConnection'] = None,
+                 control: bool = False) -> None:
+        self.skt = skt
+        self.address = address
+        self.in_buffer = bytearray()
+        self.out_buffer = bytearray()
+        self.close_after_write = False
+        self.closed = False
+        # shard connections: the shard and the client connection they carry requests for
+        self.shard = shard
+        self.client = client
+        # client connections: protocol ('oneshot', 'text' or 'binary'), user and its connection to each shard
+        self.mode: Optional[str] = None
+        self.user_id: Optional[str] = None
+        self.backends: Dict[int, chessmenProxyConnection] = {}
+        self.pending: Optional[Tuple[str, bytes, int]] = None # request type, message and shard of the request waiting for its reply
+        self.subscription: Optional[bytes] = None # SUBSCRIBE_MATCH message, sent again when the user moves to another shard
+        # control connections (one per shard): replies come back in request order, each goes to the callback of its request
+        self.control = control
+        self.callbacks: Deque[CONTROL_CALLBACK] = deque()
+
+def run_shard(server_password: str, shard: int, authoritative: bool, log_level: str, log_file: Optional[str], data_dir: Optional[str], archive_dir: Optional[str]) -> None:
+    # entry point of a shard process, every shard keeps its own store and archive
+    store = chessmenWALStore(os.path.join(data_dir, f"shard_{shard}")) if data_dir else None
+    archive = chessmenArchive(os.path.join(archive_dir, f"shard_{shard}")) if archive_dir else None
+    server = chessmenServer(server_password, authoritative=authoritative, log_level=log_level, log_file=log_file, sharded=True, address=(SHARD_HOST, PORT + 1 + shard), store=store, archive=archive)
+    server.run()
+
+class chessmenDispatcher:
+    """ chessmenDispatcher fronts a cluster of shard processes, routing requests by the shard that owns the user """
+    def __init__(self, server_password: str, shards: int, authoritative: bool = False, log_level: str = "INFO", log_file: Optional[str] = None,
+                 data_dir: Optional[str] = None, archive_dir: Optional[str] = None) -> None:
+        if string_hash(server_password) != SERVER_HASH:
+            print("incorrect server password")
+            exit()
+
+        # shards are started before anything (logging, sockets) is set up here, so forked ones inherit none of it
+        self.shards = shards
+        self.workers = [multiprocessing.Process(target=run_shard, args=(server_password, shard, authoritative, log_level, log_file, data_dir, archive_dir)) for shard in range(shards)]
+        for worker in self.workers:
+            worker.start()
+        start_logging(log_level, log_file)
+        self.ring = chessmenHashRing(shards)
+        # queued users live on the shard of their user id, users in match on the shard of their match id
+        self.routes: Dict[str, int] = {}
+        self.user_connections: Dict[str, Set[chessmenProxyConnection]] = {}
+        self.match_queue = chessmenMatchQueue()
+        self.control: List[chessmenProxyConnection] = [] # connection per shard for handoffs, never waited on
+        # users between their release and the adoption of their match, their requests are held until they are on their new shard
+        self.handoffs: Set[str] = set()
+
+        self.skt = socket.socket()
+        self.skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.skt.bind((IP_ADDR, PORT))
+        self.skt.listen(socket.SOMAXCONN)
+        self.skt.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.running = False
+
+    def route(self, user_id: str) -> int:
+        return self.routes.get(user_id, self.ring.lookup(user_id))
+
+    def _connect_shard(self, shard: int, user_id: str, binary: bool = False) -> socket.socket:
+        # blocking persistent connection (shards are on this host, so this is quick)
+        skt = socket.create_connection((SHARD_HOST, PORT + 1 + shard))
+        skt.sendall(f"PERSIST::{user_id}::{'binary' if binary else ''}".encode())
+        skt.recv(BUFFER_SIZE)
+        return skt
+
+    def _control_request(self, shard: int, request_type: str, user_id: str, args: List[str] = [], callback: Optional[CONTROL_CALLBACK] = None) -> None:
+        # the reply is handed to the callback by the event loop, so a slow shard never holds up the others
+        connection = self.control[shard]
+        connection.callbacks.append(callback or (lambda status, payload: None))
+        self._send(connection, encode_frame(f"{request_type}::{user_id}::{'|'.join(args)}".encode()))
+
+    def _on_control(self, connection: chessmenProxyConnection, message: bytes) -> None:
+        status, payload = message.decode().split("::", 1)
+        if status == "removed": # pushed by the shard, not a reply
+            self._on_removed(connection.shard, payload.split('|'))
+        else:
+            connection.callbacks.popleft()(status, payload)
+
+    def _on_removed(self, shard: int, user_ids: List[str]) -> None:
+        # users that went idle, left or finished their match on the shard are neither paired nor routed there any more
+        for user_id in user_ids:
+            if self.route(user_id) == shard:
+                self.match_queue.remove(user_id)
+                self.routes.pop(user_id, None)
+
+    def _backend(self, connection: chessmenProxyConnection, shard: int) -> chessmenProxyConnection:
+        # the client's connection to a shard, opened on first use
+        if shard not in connection.backends:
+            skt = self._connect_shard(shard, connection.user_id, connection.mode == 'binary')
+            skt.setblocking(False)
+            backend = chessmenProxyConnection(skt, skt.getpeername(), shard=shard, client=connection)
+            connection.backends[shard] = backend
+            self.selector.register(skt, selectors.EVENT_READ, backend)
+        return connection.backends[shard]
+
+    def _reply(self, connection: chessmenProxyConnection, success: bool, payload: str) -> None:
+        # reply from the dispatcher itself
+        if connection.mode == 'binary':
+            message = encode_message(REPLY_SUCCESS if success else REPLY_ERROR, body=payload.encode())
+        else:
+            message = f"{'success' if success else 'error'}::{payload}".encode()
+            if connection.mode == 'text':
+                message = encode_frame(message)
+        if connection.mode == 'oneshot':
+            connection.close_after_write = True
+        self._send(connection, message)
+
+    def _forward(self, connection: chessmenProxyConnection, request_type: Optional[str], user_id: Optional[str], message: bytes) -> None:
+        logger.debug("request type=%s user=%s address=%s", request_type, user_id, connection.address)
+        if request_type not in REQUEST_OPCODES: # shard admin requests are not for clients
+            self._reply(connection, False, "unsupported request")
+            return
+        if request_type == "KILLSWITCH": # the killswitch requests go out with the rest of the pending writes at shutdown
+            for shard in range(self.shards):
+                self._control_request(shard, "KILLSWITCH", DISPATCHER_USER_ID)
+            self.running = False
+            self._reply(connection, True, "killing server")
+            return
+        if request_type == "DUMP_STATE": # answered once every shard has dumped
+            remaining = [self.shards]
+            def on_dumped(status: str, payload: str) -> None:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    self._reply(connection, True, f"dumped state on {self.shards} shards to the server log")
+            for shard in range(self.shards):
+                self._control_request(shard, "DUMP_STATE", DISPATCHER_USER_ID, callback=on_dumped)
+            return
+        if connection.user_id != user_id:
+            self.user_connections.get(connection.user_id, set()).discard(connection)
+            connection.user_id = user_id
+        self.user_connections.setdefault(user_id, set()).add(connection)
+        if request_type == "SUBSCRIBE_MATCH":
+            connection.subscription = message
+        if user_id in self.handoffs: # sent by _migrate once the handoff is over
+            connection.pending = (request_type, message, None)
+            return
+        shard = self.route(user_id)
+        connection.pending = (request_type, message, shard)
+        self._send(self._backend(connection, shard), encode_frame(message))
+
+    def _relay(self, backend: chessmenProxyConnection, message: bytes) -> None:
+        # reply or push from a shard, passed on to the client as it is
+        connection = backend.client
+        if connection.pending != None and connection.pending[2] == backend.shard:
+            request_type, request, _ = connection.pending
+            if connection.user_id in self.handoffs and not self._succeeded(connection, message) and message.endswith(b"user is not online"):
+                # released by the shard before its match is adopted, asked again once it is
+                connection.pending = (request_type, request, None)
+                return
+            connection.pending = None
+            self._on_reply(connection, request_type, message)
+        if connection.mode == 'oneshot':
+            connection.close_after_write = True
+            self._send(connection, message)
+        else:
+            self._send(connection, encode_frame(message))
+
+    def _succeeded(self, connection: chessmenProxyConnection, message: bytes) -> bool:
+        if connection.mode == 'binary':
+            return decode_message(message)[1] != REPLY_ERROR
+        return message.startswith(b"success::")
+
+    def _on_reply(self, connection: chessmenProxyConnection, request_type: str, message: bytes) -> None:
+        success = self._succeeded(connection, message)
+        if request_type == "FIND_MATCH" and success:
+            self.match_queue.push(connection.user_id)
+            self.create_matches()
+        elif not success and message.endswith(b"user is not online"):
+            self.match_queue.remove(connection.user_id)
+            self.routes.pop(connection.user_id, None)
+
+    def create_matches(self) -> None:
+        while True:
+            user_ids = self.match_queue.pop_pair()
+            if user_ids == None:
+                break
+            self._handoff(*user_ids)
+
+    def _handoff(self, user_id_1: str, user_id_2: str) -> None:
+        # move two queued users (on their own shards) into a match on the shard of the match id
+        # release both, then adopt the match once both replies are in (see _adopt)
+        user_ids = (user_id_1, user_id_2)
+        self.handoffs.update(user_ids)
+        released: Dict[str, bool] = {}
+        def on_released(user_id: str, status: str) -> None:
+            released[user_id] = status == "success"
+            if len(released) == len(user_ids):
+                self._adopt(user_ids, released)
+        for user_id in user_ids:
+            self._control_request(self.route(user_id), "RELEASE_USER", user_id, callback=lambda status, payload, user_id=user_id: on_released(user_id, status))
+
+    def _adopt(self, user_ids: Tuple[str, str], released: Dict[str, bool]) -> None:
+        if not all(released.values()):
+            for user_id in user_ids:
+                if released[user_id]: # back into its shard's queue, and into the queue here once it is
+                    self._control_request(self.route(user_id), "FIND_MATCH", user_id, callback=lambda status, payload, user_id=user_id: self._requeue(user_id))
+                else: # went idle on its shard
+                    self.routes.pop(user_id, None)
+                    self._end_handoff(user_id)
+            return
+        white_user_id, black_user_id = random.sample(user_ids, k=2)
+        match_id = string_hash(white_user_id + black_user_id + str(time.time()))
+        shard = self.ring.lookup(match_id)
+        def on_adopted(status: str, payload: str) -> None:
+            logger.info("match created match=%s shard=%d white=%s black=%s", match_id, shard, white_user_id, black_user_id)
+            for user_id in user_ids:
+                self.routes[user_id] = shard
+                self._end_handoff(user_id)
+        self._control_request(shard, "ADOPT_MATCH", DISPATCHER_USER_ID, [match_id, white_user_id, black_user_id], callback=on_adopted)
+
+    def _requeue(self, user_id: str) -> None:
+        self._end_handoff(user_id)
+        self.match_queue.push(user_id)
+        self.create_matches()
+
+    def _end_handoff(self, user_id: str) -> None:
+        # the user is on its shard again (maybe a new one), its connections follow it there
+        self.handoffs.discard(user_id)
+        for connection in list(self.user_connections.get(user_id, ())):
+            self._migrate(connection, self.route(user_id))
+
+    def _migrate(self, connection: chessmenProxyConnection, shard: int) -> None:
+        # drop the client's connections to other shards, and repeat what was waiting on them (or held during the handoff) on the new shard
+        for backend_shard, backend in list(connection.backends.items()):
+            if backend_shard != shard:
+                self._close(backend)
+        if connection.pending != None and connection.pending[2] != shard:
+            request_type, message, _ = connection.pending
+            connection.pending = (request_type, message, shard)
+            self._send(self._backend(connection, shard), encode_frame(message))
+        elif connection.subscription != None and shard not in connection.backends:
+            self._send(self._backend(connection, shard), encode_frame(connection.subscription))
+
+    def _accept(self) -> None:
+        try:
+            (client, address) = self.skt.accept()
+        except BlockingIOError:
+            return
+        client.setblocking(False)
+        self.selector.register(client, selectors.EVENT_READ, chessmenProxyConnection(client, address))
+
+    def _close(self, connection: chessmenProxyConnection) -> None:
+        if connection.closed:
+            return
+        connection.closed = True
+        self.selector.unregister(connection.skt)
+        connection.skt.close()
+        if connection.control: # without it, the users of the shard can no longer be paired
+            if self.running:
+                logger.error("shard control connection lost shard=%d", connection.shard)
+                self.running = False
+        elif connection.client != None: # shard connection
+            connection.client.backends.pop(connection.shard, None)
+        else:
+            self.user_connections.get(connection.user_id, set()).discard(connection)
+            for backend in list(connection.backends.values()):
+                self._close(backend)
+
+    def _send(self, connection: chessmenProxyConnection, data: bytes) -> None:
+        if connection.closed:
+            return
+        connection.out_buffer += data
+        self._write(connection)
+
+    def _write(self, connection: chessmenProxyConnection) -> None:
+        try:
+            sent = connection.skt.send(connection.out_buffer)
+            del connection.out_buffer[: sent]
+        except BlockingIOError:
+            pass
+        except socket.error:
+            self._close(connection)
+            return
+        if connection.out_buffer:
+            self.selector.modify(connection.skt, selectors.EVENT_READ | selectors.EVENT_WRITE, connection)
+        elif connection.close_after_write:
+            self._close(connection)
+        else:
+            self.selector.modify(connection.skt, selectors.EVENT_READ, connection)
+
+    def _frames(self, connection: chessmenProxyConnection, data: bytes) -> List[bytes]:
+        # complete frames of the connection, which is dropped (with its client or shard connections) if it announces a frame over the size limit
+        connection.in_buffer += data
+        try:
+            return decode_frames(connection.in_buffer)
+        except ValueError as e:
+            logger.warning("connection dropped address=%s error=%s", connection.address, e)
+            if connection.client != None:
+                self._close(connection.client)
+            self._close(connection)
+            return []
+
+    def _read(self, connection: chessmenProxyConnection) -> None:
+        try:
+            data = connection.skt.recv(BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        except socket.error:
+            data = b''
+        if not data:
+            if connection.client != None: # shard went away, so does the client
+                self._close(connection.client)
+            self._close(connection)
+            return
+        if connection.control:
+            for message in self._frames(connection, data):
+                self._on_control(connection, message)
+        elif connection.client != None:
+            for message in self._frames(connection, data):
+                self._relay(connection, message)
+        elif connection.mode == None:
+            request = data.decode()
+            if request.startswith("PERSIST::"):
+                _, user_id, args = request.split("::")
+                connection.user_id = user_id
+                if args == "binary":
+                    connection.mode = 'binary'
+                    self._send(connection, f"success::binary protocol v{PROTOCOL_VERSION}".encode())
+                else:
+                    connection.mode = 'text'
+                    self._send(connection, "success::persistent connection".encode())
+            else:
+                connection.mode = 'oneshot'
+                request_type, user_id, _ = request.split("::")
+                self._forward(connection, request_type, user_id, data)
+        else:
+            for message in self._frames(connection, data):
+                if connection.mode == 'binary':
+                    self._forward(connection, REQUEST_TYPES.get(decode_message(message)[1]), connection.user_id, message)
+                else:
+                    request_type, user_id, _ = message.decode().split("::")
+                    self._forward(connection, request_type, user_id, message)
+
+    def run(self) -> None:
+        try:
+            self._run()
+        finally:
+            for worker in self.workers: # shards that did not get the killswitch
+                worker.join(timeout=SHARD_START_TIMEOUT)
+                if worker.is_alive():
+                    worker.terminate()
+            logger.info("dispatcher stopped")
+            stop_logging()
+
+    def _run(self) -> None:
+        # wait for the shards to listen
+        deadline = time.time() + SHARD_START_TIMEOUT
+        for shard in range(self.shards):
+            while True:
+                try:
+                    skt = self._connect_shard(shard, DISPATCHER_USER_ID)
+                    break
+                except ConnectionRefusedError:
+                    if time.time() > deadline:
+                        raise
+                    time.sleep(0.1)
+            # before the loop runs there is nothing to hold up, so startup requests wait for their replies:
+            # the users of matches the shard recovered from its store, and removals from now on
+            for request_type in ("LIST_USERS", "WATCH_USERS"):
+                send_frame(skt, f"{request_type}::{DISPATCHER_USER_ID}::".encode())
+                status, payload = recv_frame(skt).decode().split("::", 1)
+                if request_type == "LIST_USERS" and status == "success" and payload:
+                    for user_id in payload.split('|'):
+                        self.routes[user_id] = shard
+            skt.setblocking(False)
+            connection = chessmenProxyConnection(skt, skt.getpeername(), shard=shard, control=True)
+            self.control.append(connection)
+            self.selector.register(skt, selectors.EVENT_READ, connection)
+        logger.info("dispatcher started address=%s:%d shards=%d", IP_ADDR, PORT, self.shards)
+        self.running = True
+        self.selector.register(self.skt, selectors.EVENT_READ, None)
+        while self.running:
+            for key, events in self.selector.select(timeout=SELECT_TIMEOUT):
+                if key.data == None:
+                    self._accept()
+                    continue
+                connection: chessmenProxyConnection = key.data
+                if events & selectors.EVENT_WRITE:
+                    self._write(connection)
+                if events & selectors.EVENT_READ and not connection.closed:
+                    try:
+                        self._read(connection)
+                    except Exception: # a malformed request costs the client its connections, never the dispatcher
+                        logger.exception("request failed, connection dropped address=%s", connection.address)
+                        self._close(connection.client if connection.client != None else connection)
+                if not self.running:
+                    break
+        # flush pending replies (like the killswitch response) before shutting down
+        for key in list(self.selector.get_map().values()):
+            if key.data != None:
+                if key.data.out_buffer:
+                    key.data.skt.setblocking(True)
+                    key.data.skt.sendall(key.data.out_buffer)
+                key.data.skt.close()
+        self.selector.close()
+        self.skt.close()
@@ -1,6 +1,8 @@
-from copy import deepcopy
-from dataclasses import dataclass
-from typing import List, Tuple, Optional, Literal, Union, Dict, Callable
+from dataclasses import dataclass, field
+from typing import List, Tuple, Optional, Literal, Union, Dict
+
+from .bitboard import chessmenBitboard, chessmenAttackMap, BITBOARD, FULL_BOARD, SQUARE2COORD, BETWEEN, ZOBRIST_CASTLING, ZOBRIST_EN_PASSANT, ZOBRIST_BLACK_TO_MOVE, KNIGHT_ATTACKS, KING_ATTACKS, PAWN_ATTACKS, square, lsb, popcount, iter_squares, rook_attacks, bishop_attacks, queen_attacks
+from .utils import LRUCache
 
 FEN = str
 BOARD = List[List[str]]
@@ -11,6 +13,12 @@ START_FEN: FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
 PIECE_COLOR = Literal['black', 'white']
 PIECE_COLOR_MAP = {'b': 'black', 'w': 'white'}
 MOVE_TYPE = Literal['normal', 'enable_en_passant', 'en_passant', 'disable_castling', 'castling']
+GAME_STATUS = Literal['ongoing', 'checkmate', 'stalemate', 'fifty_move_rule', 'threefold_repetition']
+PROMOTION_PIECES = ['n', 'b', 'r', 'q'] # queen last, so picking the last move on a tile promotes to queen
+CASTLING_CORNERS = {(7, 0): 'Q', (7, 7): 'K', (0, 0): 'q', (0, 7): 'k'}
+ATTACK_MAP_CACHE = LRUCache(max_size=4096)
+FEN_PARSE_CACHE = LRUCache(max_size=1024)
+FEN_SERIALIZE_CACHE = LRUCache(max_size=1024)
 
 @dataclass
 class chessmenMove:
@@ -18,10 +26,25 @@ class chessmenMove:
     start_coord: Optional[COORD] = None
     move_type: MOVE_TYPE = 'normal'
     extra_coord: Optional[COORD] = None
+    promotion: Optional[str] = None
 
     def notation(self) -> str:
         return chessmenBoardUtility.coord2notation(self.target_coord)
 
+@dataclass
+class chessmenUndo:
+    # everything make_move overwrites, so unmake_move can restore the state in place
+    move: chessmenMove
+    moved_piece: str
+    captured_piece: str
+    captured_coord: COORD
+    castling_rook: str
+    castling_availability: str
+    en_passant_target: NOTATION
+    half_moves: int
+    full_moves: int
+    state_hash: int
+
 @dataclass
 class chessmenBoardState:
     # FEN: Forsyth–Edwards Notation (https://en.wikipedia.org/wiki/Forsyth–Edwards_Notation)
@@ -33,13 +56,68 @@ class chessmenBoardState:
     half_moves: int
     full_moves: int
 
+    bitboard: chessmenBitboard = field(init=False, repr=False, compare=False)
+    # last attack map computed for this state, and the squares changed since then
+    attack_map: Optional[chessmenAttackMap] = field(default=None, init=False, repr=False, compare=False)
+    attack_map_changes: BITBOARD = field(default=0, init=False, repr=False, compare=False)
+    # zobrist hash of active color, castling availability and en passant (the pieces are hashed by the bitboard)
+    state_hash: int = field(default=0, init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        self.bitboard = chessmenBitboard.from_board(self.board)
+        if self.active_color == 'black':
+            self.state_hash ^= ZOBRIST_BLACK_TO_MOVE
+        for piece in self.castling_availability.replace('-', ''):
+            self.state_hash ^= ZOBRIST_CASTLING[piece]
+        if self.en_passant_target != '-':
+            self.state_hash ^= ZOBRIST_EN_PASSANT[ord(self.en_passant_target[0]) - ord('a')]
+
+    def copy(self) -> 'chessmenBoardState':
+        # cheaper than deepcopy, the bitboard is the only mutable member besides the board
+        board_state = chessmenBoardState.__new__(chessmenBoardState)
+        board_state.board = [row.copy() for row in self.board]
+        board_state.active_color = self.active_color
+        board_state.castling_availability = self.castling_availability
+        board_state.en_passant_target = self.en_passant_target
+        board_state.half_moves = self.half_moves
+        board_state.full_moves = self.full_moves
+        board_state.bitboard = self.bitboard.copy()
+        board_state.attack_map = self.attack_map
+        board_state.attack_map_changes = self.attack_map_changes
+        board_state.state_hash = self.state_hash
+        return board_state
+
+    @property
+    def position_hash(self) -> int:
+        # 64-bit zobrist hash, maintained incrementally by update (https://www.chessprogramming.org/Zobrist_Hashing)
+        return self.bitboard.zobrist ^ self.state_hash
+
+    def set_piece(self, coord: COORD, piece: str) -> None:
+        # every board write goes through here to keep the bitboard in sync
+        sq = square(coord[0], coord[1])
+        current_piece = self.board[coord[0]][coord[1]]
+        if current_piece != ' ':
+            self.bitboard.remove_piece(sq, current_piece)
+        if piece != ' ':
+            self.bitboard.add_piece(sq, piece)
+        self.board[coord[0]][coord[1]] = piece
+        self.attack_map_changes |= 1 << sq
+
     def update(self, move: chessmenMove) -> None:
         # check validity of start coord (piece that is moved)
         assert move.start_coord != None
         assert chessmenBoardUtility._get_color(move.start_coord, self.board) == self.active_color
+        # pawn moves and captures reset the fifty move rule clock (en passant is a pawn move)
+        irreversible = self.board[move.start_coord[0]][move.start_coord[1]] in 'Pp' or self.board[move.target_coord[0]][move.target_coord[1]] != ' '
+        self.half_moves = 0 if irreversible else self.half_moves + 1
         # move the main piece
-        self.board[move.target_coord[0]][move.target_coord[1]] = self.board[move.start_coord[0]][move.start_coord[1]]
-        self.board[move.start_coord[0]][move.start_coord[1]] = ' '
+        self.set_piece(move.target_coord, self.board[move.start_coord[0]][move.start_coord[1]])
+        self.set_piece(move.start_coord, ' ')
+        if move.promotion != None: # pawn reached the last row
+            self.set_piece(move.target_coord, move.promotion.upper() if self.active_color == 'white' else move.promotion.lower())
+        # capturing a rook on its corner also removes the castling availability of that side
+        if move.target_coord in CASTLING_CORNERS:
+            self.update_castling_availability(CASTLING_CORNERS[move.target_coord])
         # handle extra piece (en passant or castling) and set state flags
         piece = self.board[move.target_coord[0]][move.target_coord[1]].lower()
         self.update_en_passant_target() # always reset en passant at every move
@@ -48,7 +126,7 @@ class chessmenBoardState:
                 self.update_en_passant_target(move.extra_coord)
             else:
                 if move.move_type == 'en_passant': # kill the opponent pawn
-                    self.board[move.extra_coord[0]][move.extra_coord[1]] = ' '
+                    self.set_piece(move.extra_coord, ' ')
         elif piece == 'r': # handling castling
             if move.move_type == 'disable_castling':
                 if 'Q' in self.castling_availability and move.extra_coord == (7, 0):
@@ -69,31 +147,70 @@ class chessmenBoardState:
                     self.update_castling_availability('k')
             if move.move_type == 'castling':
                 if 'Q' in self.castling_availability and move.extra_coord == (7, 3):
-                    self.board[7][0] = ' '
-                    self.board[7][3] = 'R'
+                    self.set_piece((7, 0), ' ')
+                    self.set_piece((7, 3), 'R')
                     self.update_castling_availability('Q')
                     self.update_castling_availability('K')
                 elif 'K' in self.castling_availability and move.extra_coord == (7, 5):
-                    self.board[7][7] = ' '
-                    self.board[7][5] = 'R'
+                    self.set_piece((7, 7), ' ')
+                    self.set_piece((7, 5), 'R')
                     self.update_castling_availability('Q')
                     self.update_castling_availability('K')
                 elif 'q' in self.castling_availability and move.extra_coord == (0, 3):
-                    self.board[0][0] = ' '
-                    self.board[0][3] = 'r'
+                    self.set_piece((0, 0), ' ')
+                    self.set_piece((0, 3), 'r')
                     self.update_castling_availability('q')
                     self.update_castling_availability('k')
                 elif 'k' in self.castling_availability and move.extra_coord == (0, 5):
-                    self.board[0][7] = ' '
-                    self.board[0][5] = 'r'
+                    self.set_piece((0, 7), ' ')
+                    self.set_piece((0, 5), 'r')
                     self.update_castling_availability('q')
                     self.update_castling_availability('k')
 
         # switch the active color
         self.switch_active_color()
 
+    def make_move(self, move: chessmenMove) -> chessmenUndo:
+        # same as update, but returns an undo record (cheaper than deepcopy + update for trial moves)
+        captured_coord = move.extra_coord if move.move_type == 'en_passant' else move.target_coord
+        castling_rook = ' '
+        if move.move_type == 'castling':
+            castling_rook = self.board[move.extra_coord[0]][0 if move.extra_coord[1] == 3 else 7]
+        undo = chessmenUndo(
+            move=move,
+            moved_piece=self.board[move.start_coord[0]][move.start_coord[1]],
+            captured_piece=self.board[captured_coord[0]][captured_coord[1]],
+            captured_coord=captured_coord,
+            castling_rook=castling_rook,
+            castling_availability=self.castling_availability,
+            en_passant_target=self.en_passant_target,
+            half_moves=self.half_moves,
+            full_moves=self.full_moves,
+            state_hash=self.state_hash
+        )
+        self.update(move)
+        return undo
+
+    def unmake_move(self, undo: chessmenUndo) -> None:
+        move = undo.move
+        # castling only moves through empty tiles, so the extra coord was empty before the move
+        if move.move_type == 'castling':
+            self.set_piece(move.extra_coord, ' ')
+            self.set_piece((move.extra_coord[0], 0 if move.extra_coord[1] == 3 else 7), undo.castling_rook)
+        self.set_piece(move.target_coord, ' ')
+        self.set_piece(move.start_coord, undo.moved_piece)
+        if undo.captured_piece != ' ':
+            self.set_piece(undo.captured_coord, undo.captured_piece)
+        self.active_color = 'black' if self.active_color == 'white' else 'white'
+        self.castling_availability = undo.castling_availability
+        self.en_passant_target = undo.en_passant_target
+        self.half_moves = undo.half_moves
+        self.full_moves = undo.full_moves
+        self.state_hash = undo.state_hash
+
     def switch_active_color(self) -> None:
         self.active_color = 'black' if self.active_color == 'white' else 'white'
+        self.state_hash ^= ZOBRIST_BLACK_TO_MOVE
         if self.active_color == 'white': # update full move after black's move
             self.full_moves += 1
     
@@ -101,17 +218,21 @@ class chessmenBoardState:
         castling_availability = list(self.castling_availability)
         if piece in castling_availability:
             castling_availability.remove(piece)
+            self.state_hash ^= ZOBRIST_CASTLING[piece]
         if len(castling_availability) == 0:
             castling_availability = ['-']
         self.castling_availability = ''.join(castling_availability)
 
     def update_en_passant_target(self, pos: Optional[Union[NOTATION, COORD]] = None) -> None:
+        if self.en_passant_target != '-': # hash out the previous en passant column
+            self.state_hash ^= ZOBRIST_EN_PASSANT[ord(self.en_passant_target[0]) - ord('a')]
         if pos == None:
             self.en_passant_target = '-'
         else:
             if not isinstance(pos, NOTATION):
                 pos = chessmenBoardUtility.coord2notation(pos)
             self.en_passant_target = pos
+            self.state_hash ^= ZOBRIST_EN_PASSANT[ord(pos[0]) - ord('a')]
 
 class chessmenBoardUtility:
     @staticmethod
@@ -145,28 +266,51 @@ class chessmenBoardUtility:
             board_str.append('/')
         return ''.join(board_str[: -1])
 
+    @staticmethod
+    def _fen2board_state_snapshot(fen: FEN) -> chessmenBoardState:
+        # cached parse, the returned state is shared and should never be modified
+        board_state = FEN_PARSE_CACHE.get(fen)
+        if board_state == None:
+            board_str, active_color, castling_availability, en_passant_target, half_moves, full_moves = fen.split()
+            board_state = chessmenBoardState(
+                board=chessmenBoardUtility.board_string2board(board_str=board_str),
+                active_color=PIECE_COLOR_MAP[active_color],
+                castling_availability=castling_availability,
+                en_passant_target=en_passant_target,
+                half_moves=int(half_moves),
+                full_moves=int(full_moves)
+            )
+            FEN_PARSE_CACHE.put(fen, board_state)
+        return board_state
+
     @staticmethod
     def fen2board_state(fen: FEN) -> chessmenBoardState:
-        board_str, active_color, castling_availability, en_passant_target, half_moves, full_moves = fen.split()
-        return chessmenBoardState(
-            board=chessmenBoardUtility.board_string2board(board_str=board_str),
-            active_color=PIECE_COLOR_MAP[active_color],
-            castling_availability=castling_availability,
-            en_passant_target=en_passant_target,
-            half_moves=int(half_moves),
-            full_moves=int(full_moves)
-        )
+        return chessmenBoardUtility._fen2board_state_snapshot(fen).copy()
+
+    @staticmethod
+    def fen2active_color(fen: FEN) -> PIECE_COLOR:
+        return chessmenBoardUtility._fen2board_state_snapshot(fen).active_color
 
     @staticmethod
     def board_state2fen(board_state: chessmenBoardState) -> FEN:
-        return ' '.join([
-            chessmenBoardUtility.board2board_string(board=board_state.board),
-            board_state.active_color[0],
-            board_state.castling_availability,
-            board_state.en_passant_target,
-            str(board_state.half_moves),
-            str(board_state.full_moves)
-        ])
+        # the zobrist hash covers everything in the FEN except the move clocks
+        key = (board_state.position_hash, board_state.half_moves, board_state.full_moves)
+        fen = FEN_SERIALIZE_CACHE.get(key)
+        if fen == None:
+            fen = ' '.join([
+                chessmenBoardUtility.board2board_string(board=board_state.board),
+                board_state.active_color[0],
+                board_state.castling_availability,
+                board_state.en_passant_target,
+                str(board_state.half_moves),
+                str(board_state.full_moves)
+            ])
+            FEN_SERIALIZE_CACHE.put(key, fen)
+        return fen
+
+    @staticmethod
+    def fen_cache_info() -> Dict[str, Dict[str, int]]:
+        return {'fen2board_state': FEN_PARSE_CACHE.info(), 'board_state2fen': FEN_SERIALIZE_CACHE.info()}
     
     # standard notation
     # 8 r n b q k b n r    ->    BLACK
@@ -203,6 +347,47 @@ class chessmenBoardUtility:
     def verify_notation(pos: NOTATION) -> bool:
         return len(pos) == 2 and pos[0] >= 'a' and pos[0] <= 'h' and pos[1] >= '1' and pos[1] <= '8'
     
+    @staticmethod
+    def verify_fen(fen: FEN) -> bool:
+        # a fen move generation can work with: 8 rows of 8 squares, one king per side, no pawns on the back ranks,
+        # castling rights backed by the king and rook on their squares, an en passant target behind a pawn that just moved two squares
+        # and no check on the side that is not to move
+        fields = fen.split(' ')
+        if len(fields) != 6:
+            return False
+        board_str, active_color, castling_availability, en_passant_target, half_moves, full_moves = fields
+        rows = board_str.split('/')
+        if len(rows) != 8 or any(col not in 'pnbrqkPNBRQK12345678' for row in rows for col in row):
+            return False
+        if any(sum(int(col) if col.isdigit() else 1 for col in row) != 8 for row in rows):
+            return False
+        if board_str.count('K') != 1 or board_str.count('k') != 1 or active_color not in PIECE_COLOR_MAP:
+            return False
+        if any(pawn in rows[0] + rows[7] for pawn in 'pP'):
+            return False
+        board = chessmenBoardUtility.board_string2board(board_str)
+        if castling_availability != '-':
+            if not castling_availability or any(right not in 'KQkq' or castling_availability.count(right) > 1 for right in castling_availability):
+                return False
+            for right in castling_availability:
+                king_coord = (7, 4) if right.isupper() else (0, 4)
+                rook_coord = next(coord for coord, corner in CASTLING_CORNERS.items() if corner == right)
+                king, rook = ('K', 'R') if right.isupper() else ('k', 'r')
+                if board[king_coord[0]][king_coord[1]] != king or board[rook_coord[0]][rook_coord[1]] != rook:
+                    return False
+        if en_passant_target != '-':
+            if not chessmenBoardUtility.verify_notation(en_passant_target) or en_passant_target[1] != ('6' if active_color == 'w' else '3'):
+                return False
+            row, col = chessmenBoardUtility.notation2coord(en_passant_target)
+            pawn_row = row + 1 if active_color == 'w' else row - 1
+            if board[row][col] != ' ' or board[pawn_row][col] != ('p' if active_color == 'w' else 'P'):
+                return False
+        if not (half_moves.isdecimal() and full_moves.isdecimal()):
+            return False
+        # the king of the side that just moved cannot be left in check
+        board_state = chessmenBoardUtility._fen2board_state_snapshot(fen)
+        return not chessmenBoardUtility.is_in_check(board_state, 'black' if board_state.active_color == 'white' else 'white')
+
     @staticmethod
     def verify_coord(coord: COORD) -> bool:
         return coord[0] >= 0 and coord[0] <= 7 and coord[1] >= 0 and coord[1] <= 7
@@ -241,261 +426,167 @@ class chessmenBoardUtility:
             return False
         return c1 != c2
     
+    @staticmethod
+    def _moves_to_targets(coord: COORD, targets: BITBOARD, move_type: MOVE_TYPE = 'normal', extra_coord: Optional[COORD] = None) -> List[chessmenMove]:
+        return [chessmenMove(SQUARE2COORD[sq], coord, move_type, extra_coord) for sq in iter_squares(targets)]
+
+    @staticmethod
+    def _pawn_moves_to_targets(coord: COORD, targets: BITBOARD) -> List[chessmenMove]:
+        valid_moves = []
+        for sq in iter_squares(targets):
+            target_coord = SQUARE2COORD[sq]
+            if target_coord[0] == 0 or target_coord[0] == 7: # promotion
+                valid_moves += [chessmenMove(target_coord, coord, promotion=piece) for piece in PROMOTION_PIECES]
+            else:
+                valid_moves.append(chessmenMove(target_coord, coord))
+        return valid_moves
+
     @staticmethod
     def moves_for_pawn(coord: COORD, board_state: chessmenBoardState) -> List[chessmenMove]:
         row, col = coord
-        board = board_state.board
-        get_color = lambda r, c: chessmenBoardUtility._get_color((r, c), board)
-        is_inside = lambda r, c: chessmenBoardUtility._is_inside((r, c))
-        is_empty = lambda r, c: chessmenBoardUtility._is_empty((r, c), board)
-        is_opposite = lambda r, c: chessmenBoardUtility._is_opposite(coord, (r, c), board)
-        valid_moves: List[chessmenMove] = []
-        get_color = lambda r, c: chessmenBoardUtility._get_color((r, c), board)
-        color = get_color(row, col)
+        bitboard = board_state.bitboard
+        sq = square(row, col)
+        color = chessmenBoardUtility._get_color(coord, board_state.board)
+        # only the direction differs, white pawns move towards row 0 and black pawns towards row 7
         if color == 'white':
-            if row == 6 and is_empty(row - 1, col) and is_empty(row - 2, col): # first double move -> enable en passant
-                valid_moves.append(chessmenMove((row - 2, col), move_type='enable_en_passant', extra_coord=(row - 1, col)))
-            if board_state.en_passant_target != '-' and row == 3: # possible en passant
-                en_passant_target = chessmenBoardUtility.notation2coord(board_state.en_passant_target)
-                if is_inside(row - 1, col - 1) and is_empty(row - 1, col - 1) and en_passant_target == (row - 1, col - 1):
-                    valid_moves.append(chessmenMove((row - 1, col - 1), move_type='en_passant', extra_coord=(row, col - 1)))
-                if is_inside(row - 1, col + 1) and is_empty(row - 1, col + 1) and en_passant_target == (row - 1, col + 1):
-                    valid_moves.append(chessmenMove((row - 1, col + 1), move_type='en_passant', extra_coord=(row, col + 1)))
-            if is_inside(row - 1, col) and is_empty(row - 1, col): # straight
-                valid_moves.append(chessmenMove((row - 1, col)))
-            if is_inside(row - 1, col - 1) and is_opposite(row - 1, col - 1): # kill
-                valid_moves.append(chessmenMove((row - 1, col - 1)))
-            if is_inside(row - 1, col + 1) and is_opposite(row - 1, col + 1): # kill
-                valid_moves.append(chessmenMove((row - 1, col + 1)))
+            step, start_row, en_passant_row, opposite_color = -8, 6, 3, 'black'
         else:
-            # only black pawn needs to be handled based on color as it moves in different direction than standard
-            if row == 1 and is_empty(row + 1, col) and is_empty(row + 2, col): # first double move -> enable en passant
-                valid_moves.append(chessmenMove((row + 2, col), move_type='enable_en_passant', extra_coord=(row + 1, col)))
-            if board_state.en_passant_target != '-' and row == 4: # possible en passant
-                en_passant_target = chessmenBoardUtility.notation2coord(board_state.en_passant_target)
-                if is_inside(row + 1, col - 1) and is_empty(row + 1, col - 1) and en_passant_target == (row + 1, col - 1):
-                    valid_moves.append(chessmenMove((row + 1, col - 1), move_type='en_passant', extra_coord=(row, col - 1)))
-                if is_inside(row + 1, col + 1) and is_empty(row + 1, col + 1) and en_passant_target == (row + 1, col + 1):
-                    valid_moves.append(chessmenMove((row + 1, col + 1), move_type='en_passant', extra_coord=(row, col + 1)))
-            if is_inside(row + 1, col) and is_empty(row + 1, col): # straight
-                valid_moves.append(chessmenMove((row + 1, col)))
-            if is_inside(row + 1, col - 1) and is_opposite(row + 1, col - 1): # kill
-                valid_moves.append(chessmenMove((row + 1, col - 1)))
-            if is_inside(row + 1, col + 1) and is_opposite(row + 1, col + 1): # kill
-                valid_moves.append(chessmenMove((row + 1, col + 1)))
-        for move in valid_moves:
-            move.start_coord = (row, col)
-        return valid_moves
-    
-    @staticmethod
-    def moves_for_knight(coord: COORD, board_state: chessmenBoardState) -> List[chessmenMove]:
-        row, col = coord
-        board = board_state.board
-        is_inside = lambda r, c: chessmenBoardUtility._is_inside((r, c))
-        is_empty = lambda r, c: chessmenBoardUtility._is_empty((r, c), board)
-        is_opposite = lambda r, c: chessmenBoardUtility._is_opposite(coord, (r, c), board)
+            step, start_row, en_passant_row, opposite_color = 8, 1, 4, 'white'
         valid_moves: List[chessmenMove] = []
-        if is_inside(row - 2, col - 1) and (is_empty(row - 2, col - 1) or is_opposite(row - 2, col - 1)):
-            valid_moves.append(chessmenMove((row - 2, col - 1)))
-        if is_inside(row - 2, col + 1) and (is_empty(row - 2, col + 1) or is_opposite(row - 2, col + 1)):
-            valid_moves.append(chessmenMove((row - 2, col + 1)))
-        if is_inside(row - 1, col - 2) and (is_empty(row - 1, col - 2) or is_opposite(row - 1, col - 2)):
-            valid_moves.append(chessmenMove((row - 1, col - 2)))
-        if is_inside(row - 1, col + 2) and (is_empty(row - 1, col + 2) or is_opposite(row - 1, col + 2)):
-            valid_moves.append(chessmenMove((row - 1, col + 2)))
-        if is_inside(row + 1, col - 2) and (is_empty(row + 1, col - 2) or is_opposite(row + 1, col - 2)):
-            valid_moves.append(chessmenMove((row + 1, col - 2)))
-        if is_inside(row + 1, col + 2) and (is_empty(row + 1, col + 2) or is_opposite(row + 1, col + 2)):
-            valid_moves.append(chessmenMove((row + 1, col + 2)))
-        if is_inside(row + 2, col - 1) and (is_empty(row + 2, col - 1) or is_opposite(row + 2, col - 1)):
-            valid_moves.append(chessmenMove((row + 2, col - 1)))
-        if is_inside(row + 2, col + 1) and (is_empty(row + 2, col + 1) or is_opposite(row + 2, col + 1)):
-            valid_moves.append(chessmenMove((row + 2, col + 1)))
-        for move in valid_moves:
-            move.start_coord = (row, col)
+        forward = sq + step
+        if forward >= 0 and forward < 64 and not (bitboard.all >> forward) & 1: # straight
+            valid_moves += chessmenBoardUtility._pawn_moves_to_targets(coord, 1 << forward)
+            if row == start_row and not (bitboard.all >> (forward + step)) & 1: # first double move -> enable en passant
+                valid_moves.append(chessmenMove(SQUARE2COORD[forward + step], coord, 'enable_en_passant', SQUARE2COORD[forward]))
+        attacks = PAWN_ATTACKS[color][sq]
+        # kill
+        valid_moves += chessmenBoardUtility._pawn_moves_to_targets(coord, attacks & bitboard.occupancy[opposite_color])
+        if board_state.en_passant_target != '-' and row == en_passant_row: # possible en passant
+            en_passant_target = chessmenBoardUtility.notation2coord(board_state.en_passant_target)
+            en_passant_sq = square(en_passant_target[0], en_passant_target[1])
+            if (attacks >> en_passant_sq) & 1 and not (bitboard.all >> en_passant_sq) & 1:
+                valid_moves.append(chessmenMove(en_passant_target, coord, 'en_passant', (row, en_passant_target[1])))
         return valid_moves
-    
+
     @staticmethod
-    def _moves_linear_unblocked(coords: List[COORD], is_inside: Callable, is_empty: Callable, is_opposite: Callable) -> List[chessmenMove]:
-        valid_moves = []
-        for row, col in coords:
-            if is_inside(row, col):
-                if is_empty(row, col): # empty to move
-                    valid_moves.append(chessmenMove((row, col)))
-                else:
-                    if is_opposite(row, col): # kill
-                        valid_moves.append(chessmenMove((row, col)))
-                    break
-            else:
-                break
-        return valid_moves
-    
+    def moves_for_knight(coord: COORD, board_state: chessmenBoardState) -> List[chessmenMove]:
+        bitboard = board_state.bitboard
+        color = chessmenBoardUtility._get_color(coord, board_state.board)
+        targets = KNIGHT_ATTACKS[square(coord[0], coord[1])] & ~bitboard.occupancy[color]
+        return chessmenBoardUtility._moves_to_targets(coord, targets)
+
     @staticmethod
     def moves_for_bishop(coord: COORD, board_state: chessmenBoardState) -> List[chessmenMove]:
-        row, col = coord
-        board = board_state.board
-        is_inside = lambda r, c: chessmenBoardUtility._is_inside((r, c))
-        is_empty = lambda r, c: chessmenBoardUtility._is_empty((r, c), board)
-        is_opposite = lambda r, c: chessmenBoardUtility._is_opposite(coord, (r, c), board)
-        valid_moves: List[chessmenMove] = []
-        valid_moves += chessmenBoardUtility._moves_linear_unblocked([(row - i, col - i) for i in range(1, min(row, col) + 1)], is_inside, is_empty, is_opposite) # left top
-        valid_moves += chessmenBoardUtility._moves_linear_unblocked([(row - i, col + i) for i in range(1, min(row, 7 - col) + 1)], is_inside, is_empty, is_opposite) # right top
-        valid_moves += chessmenBoardUtility._moves_linear_unblocked([(row + i, col - i) for i in range(1, min(7 - row, col) + 1)], is_inside, is_empty, is_opposite) # bottom left
-        valid_moves += chessmenBoardUtility._moves_linear_unblocked([(row + i, col + i) for i in range(1, min(7 - row, 7 - col) + 1)], is_inside, is_empty, is_opposite) # bottom right
-        for move in valid_moves:
-            move.start_coord = (row, col)
-        return valid_moves
-    
+        bitboard = board_state.bitboard
+        color = chessmenBoardUtility._get_color(coord, board_state.board)
+        targets = bishop_attacks(square(coord[0], coord[1]), bitboard.all) & ~bitboard.occupancy[color]
+        return chessmenBoardUtility._moves_to_targets(coord, targets)
+
     @staticmethod
     def moves_for_rook(coord: COORD, board_state: chessmenBoardState, for_queen: bool = False) -> List[chessmenMove]:
-        row, col = coord
-        board = board_state.board
-        is_inside = lambda r, c: chessmenBoardUtility._is_inside((r, c))
-        is_empty = lambda r, c: chessmenBoardUtility._is_empty((r, c), board)
-        is_opposite = lambda r, c: chessmenBoardUtility._is_opposite(coord, (r, c), board)
-        valid_moves: List[chessmenMove] = []
-        valid_moves += chessmenBoardUtility._moves_linear_unblocked([(row, col - i) for i in range(1, col + 1)], is_inside, is_empty, is_opposite) # left
-        valid_moves += chessmenBoardUtility._moves_linear_unblocked([(row - i, col) for i in range(1, row + 1)], is_inside, is_empty, is_opposite) # top
-        valid_moves += chessmenBoardUtility._moves_linear_unblocked([(row, col + i) for i in range(1, (7 - col) + 1)], is_inside, is_empty, is_opposite) # right
-        valid_moves += chessmenBoardUtility._moves_linear_unblocked([(row + i, col) for i in range(1, (7 - row) + 1)], is_inside, is_empty, is_opposite) # bottom
-        if not for_queen:
-            # disable castling after moving the rook
-            for move in valid_moves:
-                move.move_type = 'disable_castling'
-                move.extra_coord = (row, col)
-        for move in valid_moves:
-            move.start_coord = (row, col)
-        return valid_moves
-    
+        bitboard = board_state.bitboard
+        color = chessmenBoardUtility._get_color(coord, board_state.board)
+        targets = rook_attacks(square(coord[0], coord[1]), bitboard.all) & ~bitboard.occupancy[color]
+        if for_queen:
+            return chessmenBoardUtility._moves_to_targets(coord, targets)
+        # disable castling after moving the rook
+        return chessmenBoardUtility._moves_to_targets(coord, targets, 'disable_castling', coord)
+
     @staticmethod
     def moves_for_queen(coord: COORD, board_state: chessmenBoardState) -> List[chessmenMove]:
-        valid_moves = chessmenBoardUtility.moves_for_bishop(coord, board_state)
-        valid_moves += chessmenBoardUtility.moves_for_rook(coord, board_state, for_queen=True)
-        return valid_moves
-    
+        bitboard = board_state.bitboard
+        color = chessmenBoardUtility._get_color(coord, board_state.board)
+        targets = queen_attacks(square(coord[0], coord[1]), bitboard.all) & ~bitboard.occupancy[color]
+        return chessmenBoardUtility._moves_to_targets(coord, targets)
+
     @staticmethod
     def _get_castling_move(color: PIECE_COLOR, board_state: chessmenBoardState, queen_side: bool = True) -> Optional[chessmenMove]:
         board = board_state.board
         row = 7 if color == 'white' else 0
-        cols = [0, 1, 2, 3, 4] if queen_side else [4, 5, 6, 7]
-        for i, col in enumerate(cols):
-            # all tiles between rook and king (exclusive) should be empty
-            if i > 0 and i < len(cols) - 1:
-                if not chessmenBoardUtility._is_empty((row, col), board):
-                    return None
-            # all tiles between rook and king (inclusive) should not be under check
-            if chessmenBoardUtility.can_color_reach_location((row, col), board_state, color):
+        # the rook should still be on its corner
+        if board[row][0 if queen_side else 7] != ('R' if color == 'white' else 'r'):
+            return None
+        # all tiles between rook and king (exclusive) should be empty
+        for col in ([1, 2, 3] if queen_side else [5, 6]):
+            if not chessmenBoardUtility._is_empty((row, col), board):
+                return None
+        # the king should not start on, pass through or land on a tile under check
+        attacked = chessmenBoardUtility.get_attack_map(board_state).by_color['black' if color == 'white' else 'white']
+        for col in ([4, 3, 2] if queen_side else [4, 5, 6]):
+            if (attacked >> square(row, col)) & 1:
                 return None
         # only king can initiate castling
         if queen_side:
             return chessmenMove((row, 2), move_type='castling', extra_coord=(row, 3))
         else:
             return chessmenMove((row, 6), move_type='castling', extra_coord=(row, 5))
-    
+
     @staticmethod
     def moves_for_king(coord: COORD, board_state: chessmenBoardState, check_castling: bool = True) -> List[chessmenMove]:
-        row, col = coord
-        board = board_state.board
-        is_inside = lambda r, c: chessmenBoardUtility._is_inside((r, c))
-        is_empty = lambda r, c: chessmenBoardUtility._is_empty((r, c), board)
-        is_opposite = lambda r, c: chessmenBoardUtility._is_opposite(coord, (r, c), board)
-        valid_moves: List[chessmenMove] = []
-        if is_inside(row - 1, col - 1) and (is_empty(row - 1, col - 1) or is_opposite(row - 1, col - 1)):
-            valid_moves.append(chessmenMove((row - 1, col - 1)))
-        if is_inside(row - 1, col)and (is_empty(row - 1, col) or is_opposite(row - 1, col)):
-            valid_moves.append(chessmenMove((row - 1, col)))
-        if is_inside(row - 1, col + 1) and (is_empty(row - 1, col + 1) or is_opposite(row - 1, col + 1)):
-            valid_moves.append(chessmenMove((row - 1, col + 1)))
-        if is_inside(row, col - 1) and (is_empty(row, col - 1) or is_opposite(row, col - 1)):
-            valid_moves.append(chessmenMove((row, col - 1)))
-        if is_inside(row, col + 1) and (is_empty(row, col + 1) or is_opposite(row, col + 1)):
-            valid_moves.append(chessmenMove((row, col + 1)))
-        if is_inside(row + 1, col - 1) and (is_empty(row + 1, col - 1) or is_opposite(row + 1, col - 1)):
-            valid_moves.append(chessmenMove((row + 1, col - 1)))
-        if is_inside(row + 1, col) and (is_empty(row + 1, col) or is_opposite(row + 1, col)):
-            valid_moves.append(chessmenMove((row + 1, col)))
-        if is_inside(row + 1, col + 1) and (is_empty(row + 1, col + 1) or is_opposite(row + 1, col + 1)):
-            valid_moves.append(chessmenMove((row + 1, col + 1)))
+        bitboard = board_state.bitboard
+        color = chessmenBoardUtility._get_color(coord, board_state.board)
+        targets = KING_ATTACKS[square(coord[0], coord[1])] & ~bitboard.occupancy[color]
         # disable castling after moving the king
-        for move in valid_moves:
-            move.move_type = 'disable_castling'
-            move.extra_coord = (row, col)
+        valid_moves = chessmenBoardUtility._moves_to_targets(coord, targets, 'disable_castling', coord)
         # for castling
         if check_castling:
-            get_color = lambda r, c: chessmenBoardUtility._get_color((r, c), board)
-            color = get_color(row, col)
-            if color == 'white':
-                if 'Q' in board_state.castling_availability:
-                    move = chessmenBoardUtility._get_castling_move(color, board_state, queen_side=True)
-                    if move != None:
-                        valid_moves.append(move)
-                if 'K' in board_state.castling_availability:
-                    move = chessmenBoardUtility._get_castling_move(color, board_state, queen_side=False)
-                    if move != None:
-                        valid_moves.append(move)
-            else:
-                if 'q' in board_state.castling_availability:
-                    move = chessmenBoardUtility._get_castling_move(color, board_state, queen_side=True)
-                    if move != None:
-                        valid_moves.append(move)
-                if 'k' in board_state.castling_availability:
-                    move = chessmenBoardUtility._get_castling_move(color, board_state, queen_side=False)
-                    if move != None:
-                        valid_moves.append(move)
-        for move in valid_moves:
-            move.start_coord = (row, col)
+            queen_side, king_side = ('Q', 'K') if color == 'white' else ('q', 'k')
+            if queen_side in board_state.castling_availability:
+                move = chessmenBoardUtility._get_castling_move(color, board_state, queen_side=True)
+                if move != None:
+                    move.start_coord = coord
+                    valid_moves.append(move)
+            if king_side in board_state.castling_availability:
+                move = chessmenBoardUtility._get_castling_move(color, board_state, queen_side=False)
+                if move != None:
+                    move.start_coord = coord
+                    valid_moves.append(move)
         return valid_moves
-    
+
     @staticmethod
     def can_color_reach_location(coord: COORD, board_state: chessmenBoardState, target_color: PIECE_COLOR = 'white') -> bool:
         opposite_color = 'black' if target_color == 'white' else 'white'
-        # we do reverse check, based on reversibilty of active attack
-        # by putting each piece in the coord and checking possible positions
-        target_moves = []
-        original_tile = board_state.board[coord[0]][coord[1]]
-        board_state.board[coord[0]][coord[1]] = 'P' if target_color == 'white' else 'p'
-        for move in chessmenBoardUtility.moves_for_pawn(coord, board_state):
-            if move.move_type == 'normal' and chessmenBoardUtility._get_color(move.target_coord, board_state.board) == opposite_color and board_state.board[move.target_coord[0]][move.target_coord[1]].lower() == 'p':
-                target_moves.append(move)
-        board_state.board[coord[0]][coord[1]] = 'N' if target_color == 'white' else 'n'
-        for move in chessmenBoardUtility.moves_for_knight(coord, board_state):
-            if move.move_type == 'normal' and chessmenBoardUtility._get_color(move.target_coord, board_state.board) == opposite_color and board_state.board[move.target_coord[0]][move.target_coord[1]].lower() == 'n':
-                target_moves.append(move)
-        board_state.board[coord[0]][coord[1]] = 'B' if target_color == 'white' else 'b'
-        for move in chessmenBoardUtility.moves_for_bishop(coord, board_state):
-            if move.move_type == 'normal' and chessmenBoardUtility._get_color(move.target_coord, board_state.board) == opposite_color and board_state.board[move.target_coord[0]][move.target_coord[1]].lower() in ['b', 'q']:
-                target_moves.append(move)
-        board_state.board[coord[0]][coord[1]] = 'R' if target_color == 'white' else 'r'
-        for move in chessmenBoardUtility.moves_for_rook(coord, board_state):
-            if move.move_type == 'normal' and chessmenBoardUtility._get_color(move.target_coord, board_state.board) == opposite_color and board_state.board[move.target_coord[0]][move.target_coord[1]].lower() in ['r', 'q']:
-                target_moves.append(move)
-        board_state.board[coord[0]][coord[1]] = 'K' if target_color == 'white' else 'k'
-        for move in chessmenBoardUtility.moves_for_king(coord, board_state, check_castling=False):
-            if move.move_type == 'normal' and chessmenBoardUtility._get_color(move.target_coord, board_state.board) == opposite_color and board_state.board[move.target_coord[0]][move.target_coord[1]].lower() == 'k':
-                target_moves.append(move)
-        board_state.board[coord[0]][coord[1]] = original_tile
-        return len(target_moves) > 0
+        # the location is reachable if any opposite piece attacks it, which is read off the attack tables
+        return board_state.bitboard.is_attacked(square(coord[0], coord[1]), opposite_color)
+
+    @staticmethod
+    def get_attack_map(board_state: chessmenBoardState) -> chessmenAttackMap:
+        key = board_state.bitboard.key()
+        attack_map = ATTACK_MAP_CACHE.get(key)
+        if attack_map == None:
+            if board_state.attack_map != None: # derive it from the last map of this state
+                attack_map = board_state.attack_map.updated(board_state.bitboard, board_state.attack_map_changes)
+            else:
+                attack_map = chessmenAttackMap.from_bitboard(board_state.bitboard)
+            ATTACK_MAP_CACHE.put(key, attack_map)
+        board_state.attack_map = attack_map
+        board_state.attack_map_changes = 0
+        return attack_map
+
+    @staticmethod
+    def is_in_check(board_state: chessmenBoardState, color: PIECE_COLOR) -> bool:
+        king = board_state.bitboard.pieces['K' if color == 'white' else 'k']
+        return bool(chessmenBoardUtility.get_attack_map(board_state).by_color['black' if color == 'white' else 'white'] & king)
 
     @staticmethod
     def filter_moves_on_king_check(moves: List[chessmenMove], board_state: chessmenBoardState, target_color: PIECE_COLOR = 'white') -> List[chessmenMove]:
         def get_king_location(board_state: chessmenBoardState, color: PIECE_COLOR) -> COORD:
-            target = 'K' if color == 'white' else 'k'
-            for row in range(8):
-                for col in range(8):
-                    if board_state.board[row][col] == target:
-                        return row, col
-        def updated_board_state(board_state: chessmenBoardState, move: chessmenMove) -> chessmenBoardState:
-            board_state = deepcopy(board_state)
-            board_state.update(move)
-            return board_state
+            return SQUARE2COORD[lsb(board_state.bitboard.pieces['K' if color == 'white' else 'k'])]
         valid_moves = []
+        king_coord = get_king_location(board_state, target_color)
+        attacked = chessmenBoardUtility.get_attack_map(board_state).by_color['black' if target_color == 'white' else 'white']
         # a move is valid, only if the king is not on check after making it
         for move in moves:
-            # how will the board look after making that move
-            new_board_state = updated_board_state(board_state, move)
-            king_pos = get_king_location(new_board_state, target_color)
-            # verify in the new state if it is a check
-            king_check = chessmenBoardUtility.can_color_reach_location(king_pos, new_board_state, target_color)
+            # the king itself can only move to tiles that are not attacked (castling is checked when generated)
+            if move.start_coord == king_coord:
+                if move.move_type == 'castling' or not (attacked >> square(move.target_coord[0], move.target_coord[1])) & 1:
+                    valid_moves.append(move)
+                continue
+            # make the move in place, verify if it is a check and take it back
+            undo = board_state.make_move(move)
+            king_pos = get_king_location(board_state, target_color)
+            king_check = chessmenBoardUtility.can_color_reach_location(king_pos, board_state, target_color)
+            board_state.unmake_move(undo)
             if not king_check:
                 valid_moves.append(move)
         # if no moves possible, game over
@@ -525,6 +616,118 @@ class chessmenBoardUtility:
             valid_moves = chessmenBoardUtility.filter_moves_on_king_check(valid_moves, board_state, color)
         return valid_moves
     
+    @staticmethod
+    def generate_legal_moves(board_state: chessmenBoardState) -> List[chessmenMove]:
+        # all legal moves for the active color, with checkers and pins worked out once for the position
+        bitboard = board_state.bitboard
+        pieces = bitboard.pieces
+        color = board_state.active_color
+        if color == 'white':
+            opposite_color, step, start_row = 'black', -8, 6
+            pawn, knight, bishop, rook, queen, king = 'P', 'N', 'B', 'R', 'Q', 'K'
+            opposite_bishop, opposite_rook, opposite_queen = 'b', 'r', 'q'
+        else:
+            opposite_color, step, start_row = 'white', 8, 1
+            pawn, knight, bishop, rook, queen, king = 'p', 'n', 'b', 'r', 'q', 'k'
+            opposite_bishop, opposite_rook, opposite_queen = 'B', 'R', 'Q'
+        own = bitboard.occupancy[color]
+        opposite = bitboard.occupancy[opposite_color]
+        occupied = bitboard.all
+        king_sq = lsb(pieces[king])
+        king_coord = SQUARE2COORD[king_sq]
+        checkers = bitboard.attackers_to(king_sq, opposite_color)
+
+        # king moves (the attack map already sees through the king for the tiles behind it)
+        attacked = chessmenBoardUtility.get_attack_map(board_state).by_color[opposite_color]
+        valid_moves = chessmenBoardUtility._moves_to_targets(king_coord, KING_ATTACKS[king_sq] & ~own & ~attacked, 'disable_castling', king_coord)
+        if checkers & (checkers - 1): # double check, only the king can move
+            return valid_moves
+        if checkers: # single check, either capture the checker or block it
+            target_mask = (BETWEEN[king_sq][lsb(checkers)] | checkers) & ~own
+        else:
+            target_mask = ~own & FULL_BOARD
+            queen_side, king_side = ('Q', 'K') if color == 'white' else ('q', 'k')
+            for side, is_queen_side in ((queen_side, True), (king_side, False)):
+                if side in board_state.castling_availability:
+                    move = chessmenBoardUtility._get_castling_move(color, board_state, queen_side=is_queen_side)
+                    if move != None:
+                        move.start_coord = king_coord
+                        valid_moves.append(move)
+
+        # pinned pieces can only move along the line between the king and the pinning piece
+        pins: Dict[int, BITBOARD] = {}
+        snipers = rook_attacks(king_sq, opposite) & (pieces[opposite_rook] | pieces[opposite_queen])
+        snipers |= bishop_attacks(king_sq, opposite) & (pieces[opposite_bishop] | pieces[opposite_queen])
+        for sniper_sq in iter_squares(snipers):
+            blockers = BETWEEN[king_sq][sniper_sq] & occupied
+            if blockers & own and not blockers & (blockers - 1):
+                pins[lsb(blockers)] = BETWEEN[king_sq][sniper_sq] | (1 << sniper_sq)
+
+        for sq in iter_squares(pieces[knight]):
+            if sq not in pins: # a pinned knight can never move
+                valid_moves += chessmenBoardUtility._moves_to_targets(SQUARE2COORD[sq], KNIGHT_ATTACKS[sq] & target_mask)
+        for sq in iter_squares(pieces[bishop]):
+            targets = bishop_attacks(sq, occupied) & target_mask & pins.get(sq, FULL_BOARD)
+            valid_moves += chessmenBoardUtility._moves_to_targets(SQUARE2COORD[sq], targets)
+        for sq in iter_squares(pieces[rook]):
+            coord = SQUARE2COORD[sq]
+            targets = rook_attacks(sq, occupied) & target_mask & pins.get(sq, FULL_BOARD)
+            valid_moves += chessmenBoardUtility._moves_to_targets(coord, targets, 'disable_castling', coord)
+        for sq in iter_squares(pieces[queen]):
+            targets = queen_attacks(sq, occupied) & target_mask & pins.get(sq, FULL_BOARD)
+            valid_moves += chessmenBoardUtility._moves_to_targets(SQUARE2COORD[sq], targets)
+        for sq in iter_squares(pieces[pawn]):
+            coord = SQUARE2COORD[sq]
+            mask = target_mask & pins.get(sq, FULL_BOARD)
+            forward = sq + step
+            if not (occupied >> forward) & 1: # straight
+                if (mask >> forward) & 1:
+                    valid_moves += chessmenBoardUtility._pawn_moves_to_targets(coord, 1 << forward)
+                if coord[0] == start_row and not (occupied >> (forward + step)) & 1 and (mask >> (forward + step)) & 1: # first double move
+                    valid_moves.append(chessmenMove(SQUARE2COORD[forward + step], coord, 'enable_en_passant', SQUARE2COORD[forward]))
+            # kill
+            valid_moves += chessmenBoardUtility._pawn_moves_to_targets(coord, PAWN_ATTACKS[color][sq] & opposite & mask)
+        if board_state.en_passant_target != '-':
+            # en passant removes two pawns from a row, so it is verified by making it
+            en_passant_target = chessmenBoardUtility.notation2coord(board_state.en_passant_target)
+            en_passant_sq = square(en_passant_target[0], en_passant_target[1])
+            if not (occupied >> en_passant_sq) & 1:
+                for sq in iter_squares(PAWN_ATTACKS[opposite_color][en_passant_sq] & pieces[pawn]):
+                    coord = SQUARE2COORD[sq]
+                    move = chessmenMove(en_passant_target, coord, 'en_passant', (coord[0], en_passant_target[1]))
+                    undo = board_state.make_move(move)
+                    if not bitboard.is_attacked(king_sq, opposite_color):
+                        valid_moves.append(move)
+                    board_state.unmake_move(undo)
+        return valid_moves
+
+    @staticmethod
+    def game_status(board_state: chessmenBoardState, repetitions: Optional[Dict[int, int]] = None) -> GAME_STATUS:
+        # mate and stalemate take one legal move generation, the draw rules are read off the clock and the repetition table
+        # repetitions counts the occurrences of every position (by position hash) of the game
+        if not chessmenBoardUtility.generate_legal_moves(board_state):
+            return 'checkmate' if chessmenBoardUtility.is_in_check(board_state, board_state.active_color) else 'stalemate'
+        if board_state.half_moves >= 100:
+            return 'fifty_move_rule'
+        if repetitions != None and repetitions.get(board_state.position_hash, 0) >= 3:
+            return 'threefold_repetition'
+        return 'ongoing'
+
+    @staticmethod
+    def perft(board_state: chessmenBoardState, depth: int) -> int:
+        # number of leaf positions reachable in exactly depth moves (https://www.chessprogramming.org/Perft)
+        if depth == 0:
+            return 1
+        valid_moves = chessmenBoardUtility.generate_legal_moves(board_state)
+        if depth == 1:
+            return len(valid_moves)
+        nodes = 0
+        for move in valid_moves:
+            undo = board_state.make_move(move)
+            nodes += chessmenBoardUtility.perft(board_state, depth - 1)
+            board_state.unmake_move(undo)
+        return nodes
+
     @staticmethod
     def get_target_moves(valid_moves: List[chessmenMove], board_state: chessmenBoardState) -> List[chessmenMove]:
         board = board_state.board
@@ -541,10 +744,8 @@ class chessmenBoardUtility:
             missing_pieces = {'P': 0, 'R': 0, 'N': 0, 'B': 0, 'Q': 0, 'K': 0}
         else:
             missing_pieces = {'p': 0, 'r': 0, 'n': 0, 'b': 0, 'q': 0, 'k': 0}
-        for row in board_state.board:
-            for col in row:
-                if col in missing_pieces:
-                    missing_pieces[col] += 1
+        for piece in missing_pieces:
+            missing_pieces[piece] = popcount(board_state.bitboard.pieces[piece])
         for piece in missing_pieces:
             if piece.lower() == 'p':
                 missing_pieces[piece] = 8 - missing_pieces[piece]
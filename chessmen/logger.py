@@ -0,0 +1,41 @@
+import sys
+import queue
+import logging
+import logging.handlers
+from typing import Optional
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s %(message)s"
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"chessmen.{name}")
+
+def start_logging(level: str = "INFO", log_file: Optional[str] = None) -> None:
+    # callers only put records on a queue, formatting and writing happens on the listener thread
+    global _listener
+    if _listener != None:
+        return
+    handler = logging.FileHandler(log_file) if log_file else logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger("chessmen")
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.propagate = False
+    _listener = logging.handlers.QueueListener(log_queue, handler)
+    _listener.start()
+
+def stop_logging() -> None:
+    # writes out the queued records
+    global _listener
+    if _listener == None:
+        return
+    _listener.stop()
+    root = logging.getLogger("chessmen")
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
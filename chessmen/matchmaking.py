@@ -0,0 +1,147 @@
+import time
+import heapq
+import bisect
+import itertools
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional, Tuple, Deque
+
+DEFAULT_RATING = 1200
+ELO_K_FACTOR = 32
+RATING_BUCKET_SIZE = 50 # rating points per bucket
+RATING_BASE_WINDOW = 1 # buckets on each side a new user can be paired across
+RATING_WINDOW_STEP_TIME = 5 # seconds of waiting per extra bucket of window
+RATING_MAX_WAIT_TIME = 60 # seconds, after which a user is paired with anyone
+
+class chessmenMatchQueue:
+    """ chessmenMatchQueue is the FIFO of users waiting for a match, all operations are O(1) """
+    def __init__(self) -> None:
+        # insertion ordered, so the oldest waiting user is first (and removal from the middle is O(1))
+        self.waiting: OrderedDict[str, None] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.waiting)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self.waiting
+
+    def push(self, user_id: str) -> None:
+        self.waiting[user_id] = None
+
+    def remove(self, user_id: str) -> None:
+        self.waiting.pop(user_id, None)
+
+    def pop_pair(self) -> Optional[Tuple[str, str]]:
+        # two longest waiting users (if any)
+        if len(self.waiting) < 2:
+            return None
+        user_id_1, _ = self.waiting.popitem(last=False)
+        user_id_2, _ = self.waiting.popitem(last=False)
+        return user_id_1, user_id_2
+
+    def record_result(self, white_user_id: str, black_user_id: str, white_score: float) -> None:
+        # unrated queue, results do not matter
+        pass
+
+class chessmenRatedMatchQueue:
+    """ chessmenRatedMatchQueue pairs users within a rating window that widens the longer they wait """
+    def __init__(self) -> None:
+        self.ratings: Dict[str, float] = {} # kept after users leave the queue
+        # bucket -> waiting users (oldest first), and the sorted non-empty buckets
+        self.buckets: Dict[int, OrderedDict[str, None]] = {}
+        self.bucket_index: List[int] = []
+        self.waiting: Dict[str, Tuple[int, float]] = {} # user -> (bucket, join time)
+        # users past RATING_MAX_WAIT_TIME, paired with the next user that is searched
+        self.unbounded: OrderedDict[str, None] = OrderedDict()
+        # users to search a partner for: new ones, and ones whose window widened (by due time)
+        self.unsearched: Deque[str] = deque()
+        self.widen_heap: List[Tuple[float, int, str, float]] = []
+        self.widen_counter = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self.waiting)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self.waiting
+
+    def rating(self, user_id: str) -> float:
+        return self.ratings.get(user_id, DEFAULT_RATING)
+
+    def push(self, user_id: str) -> None:
+        bucket = int(self.rating(user_id) // RATING_BUCKET_SIZE)
+        if bucket not in self.buckets:
+            self.buckets[bucket] = OrderedDict()
+            bisect.insort(self.bucket_index, bucket)
+        self.buckets[bucket][user_id] = None
+        self.waiting[user_id] = (bucket, time.time())
+        self.unsearched.append(user_id)
+
+    def remove(self, user_id: str) -> None:
+        if user_id not in self.waiting:
+            return
+        bucket, _ = self.waiting.pop(user_id)
+        del self.buckets[bucket][user_id]
+        if not self.buckets[bucket]:
+            del self.buckets[bucket]
+            del self.bucket_index[bisect.bisect_left(self.bucket_index, bucket)]
+        self.unbounded.pop(user_id, None)
+
+    def window(self, user_id: str) -> Optional[int]:
+        # window in buckets (None is unbounded)
+        wait_time = time.time() - self.waiting[user_id][1]
+        if wait_time >= RATING_MAX_WAIT_TIME:
+            return None
+        return RATING_BASE_WINDOW + int(wait_time // RATING_WINDOW_STEP_TIME)
+
+    def _find_partner(self, user_id: str, window: Optional[int]) -> Optional[str]:
+        for partner_id in self.unbounded:
+            if partner_id != user_id:
+                return partner_id
+        # walk the non-empty buckets outwards from the user's own bucket, nearest first
+        bucket = self.waiting[user_id][0]
+        left = bisect.bisect_left(self.bucket_index, bucket) - 1
+        right = left + 1
+        while left >= 0 or right < len(self.bucket_index):
+            if right >= len(self.bucket_index) or (left >= 0 and bucket - self.bucket_index[left] < self.bucket_index[right] - bucket):
+                candidate_bucket = self.bucket_index[left]
+                left -= 1
+            else:
+                candidate_bucket = self.bucket_index[right]
+                right += 1
+            if window != None and abs(candidate_bucket - bucket) > window:
+                break
+            for partner_id in self.buckets[candidate_bucket]:
+                if partner_id != user_id:
+                    return partner_id
+        return None
+
+    def pop_pair(self) -> Optional[Tuple[str, str]]:
+        # only new users and users whose window widened are searched, so the cost does not grow with the queue
+        now = time.time()
+        while self.widen_heap and self.widen_heap[0][0] <= now:
+            _, _, user_id, join_time = heapq.heappop(self.widen_heap)
+            if user_id in self.waiting and self.waiting[user_id][1] == join_time: # not a stale entry
+                self.unsearched.append(user_id)
+        while self.unsearched:
+            user_id = self.unsearched.popleft()
+            if user_id not in self.waiting:
+                continue
+            window = self.window(user_id)
+            partner_id = self._find_partner(user_id, window)
+            if partner_id != None:
+                self.remove(user_id)
+                self.remove(partner_id)
+                return partner_id, user_id # longer waiting user first
+            join_time = self.waiting[user_id][1]
+            if window == None:
+                self.unbounded[user_id] = None
+            else: # search again once the window widens
+                next_time = join_time + min(RATING_MAX_WAIT_TIME, (window - RATING_BASE_WINDOW + 1) * RATING_WINDOW_STEP_TIME)
+                heapq.heappush(self.widen_heap, (next_time, next(self.widen_counter), user_id, join_time))
+        return None
+
+    def record_result(self, white_user_id: str, black_user_id: str, white_score: float) -> None:
+        # elo update, white_score is 1 (white won), 0.5 (draw) or 0 (black won)
+        white_rating, black_rating = self.rating(white_user_id), self.rating(black_user_id)
+        white_expected = 1 / (1 + 10 ** ((black_rating - white_rating) / 400))
+        self.ratings[white_user_id] = white_rating + ELO_K_FACTOR * (white_score - white_expected)
+        self.ratings[black_user_id] = black_rating - ELO_K_FACTOR * (white_score - white_expected)
@@ -0,0 +1,238 @@
+import re
+import multiprocessing
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Union, Iterable, Iterator, TextIO
+
+from .engine import FEN, START_FEN, chessmenMove, chessmenBoardState, chessmenBoardUtility
+from .archive import chessmenArchivedGame
+from .protocol import encode_move
+from .utils import string_hash, imap_bounded
+from .logger import get_logger
+
+# PGN: Portable Game Notation (https://www.chessprogramming.org/Portable_Game_Notation)
+SEVEN_TAG_ROSTER = ["Event", "Site", "Date", "Round", "White", "Black", "Result"]
+RESULTS = {"1-0": 1.0, "0-1": 0.0, "1/2-1/2": 0.5, "*": None}
+PGN_LINE_WIDTH = 80
+PGN_CHUNK_SIZE = 64 # games per task of a parallel read
+PGN_MAX_IN_FLIGHT = 4 # tasks per process a parallel read runs ahead of its consumer
+
+TAG_PATTERN = re.compile(r'\[\s*(\w+)\s+"((?:[^"\\]|\\.)*)"\s*\]')
+# comments, variations and annotations are skipped, what is left are move numbers, moves and the result
+MOVETEXT_SKIP_PATTERN = re.compile(r'\{[^}]*\}|;[^\n]*|\$\d+')
+SAN_PATTERN = re.compile(r'^([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?$')
+
+logger = get_logger("pgn")
+
+@dataclass
+class chessmenPGNGame:
+    headers: Dict[str, str] = field(default_factory=dict)
+    moves: List[chessmenMove] = field(default_factory=list, repr=False)
+
+    @property
+    def start_fen(self) -> FEN:
+        return self.headers.get("FEN", START_FEN)
+
+    @property
+    def result(self) -> Optional[float]:
+        # score of white, None if the game has no result
+        return RESULTS.get(self.headers.get("Result", "*"))
+
+    def to_archived(self, match_id: Optional[str] = None) -> chessmenArchivedGame:
+        # imported games get a match id from their headers and moves, unless given one
+        moves = [encode_move(move.start_coord, move.target_coord, move.promotion) for move in self.moves]
+        if match_id == None:
+            match_id = string_hash(repr(sorted(self.headers.items())) + repr(moves))
+        return chessmenArchivedGame(match_id, self.headers.get("White", "?"), self.headers.get("Black", "?"), self.result, self.start_fen, moves)
+
+    @staticmethod
+    def from_archived(game: chessmenArchivedGame) -> 'chessmenPGNGame':
+        result = {score: result for result, score in RESULTS.items()}[game.result]
+        headers = {"Event": "chessmen online", "Site": "?", "Date": "????.??.??", "Round": "-", "White": game.white_user_id, "Black": game.black_user_id, "Result": result}
+        if game.start_fen != START_FEN:
+            headers.update(SetUp="1", FEN=game.start_fen)
+        return chessmenPGNGame(headers, [move for _, move in game.replay()])
+
+def _gives_check(move: chessmenMove, board_state: chessmenBoardState) -> str:
+    # '#' for mate, '+' for check, '' otherwise
+    undo = board_state.make_move(move)
+    suffix = ''
+    if chessmenBoardUtility.is_in_check(board_state, board_state.active_color):
+        suffix = '#' if not chessmenBoardUtility.generate_legal_moves(board_state) else '+'
+    board_state.unmake_move(undo)
+    return suffix
+
+def move2san(move: chessmenMove, board_state: chessmenBoardState, legal_moves: Optional[List[chessmenMove]] = None) -> str:
+    # SAN: Standard Algebraic Notation, the move has to be legal in board_state (which is left as it was)
+    if move.move_type == 'castling':
+        return ('O-O' if move.target_coord[1] == 6 else 'O-O-O') + _gives_check(move, board_state)
+    board = board_state.board
+    piece = board[move.start_coord[0]][move.start_coord[1]]
+    target = chessmenBoardUtility.coord2notation(move.target_coord)
+    capture = move.move_type == 'en_passant' or board[move.target_coord[0]][move.target_coord[1]] != ' '
+    if piece.lower() == 'p':
+        san = (chessmenBoardUtility.coord2notation(move.start_coord)[0] + 'x' if capture else '') + target
+        if move.promotion != None:
+            san += '=' + move.promotion.upper()
+    else:
+        if legal_moves == None:
+            legal_moves = chessmenBoardUtility.generate_legal_moves(board_state)
+        # other pieces of the same kind that can reach the target
+        rivals = [other.start_coord for other in legal_moves if other.target_coord == move.target_coord and other.start_coord != move.start_coord
+                  and board[other.start_coord[0]][other.start_coord[1]] == piece]
+        start = chessmenBoardUtility.coord2notation(move.start_coord)
+        if not rivals:
+            disambiguation = ''
+        elif all(rival[1] != move.start_coord[1] for rival in rivals):
+            disambiguation = start[0]
+        elif all(rival[0] != move.start_coord[0] for rival in rivals):
+            disambiguation = start[1]
+        else:
+            disambiguation = start
+        san = piece.upper() + disambiguation + ('x' if capture else '') + target
+    return san + _gives_check(move, board_state)
+
+def san2move(san: str, board_state: chessmenBoardState, legal_moves: Optional[List[chessmenMove]] = None) -> chessmenMove:
+    # the legal move of board_state written as san, ValueError if there is none or more than one
+    if legal_moves == None:
+        legal_moves = chessmenBoardUtility.generate_legal_moves(board_state)
+    board = board_state.board
+    token = san.rstrip('+#!?')
+    if token in ('O-O', '0-0', 'O-O-O', '0-0-0'):
+        target_col = 6 if len(token) == 3 else 2
+        candidates = [move for move in legal_moves if move.move_type == 'castling' and move.target_coord[1] == target_col]
+    else:
+        match = SAN_PATTERN.match(token)
+        if match == None:
+            raise ValueError(f"invalid san {san}")
+        piece, file, rank, target, promotion = match.groups()
+        piece = (piece or 'P').lower()
+        target_coord = chessmenBoardUtility.notation2coord(target)
+        promotion = promotion.lower() if promotion else None
+        candidates = []
+        for move in legal_moves:
+            if move.target_coord != target_coord or move.promotion != promotion or board[move.start_coord[0]][move.start_coord[1]].lower() != piece:
+                continue
+            start = chessmenBoardUtility.coord2notation(move.start_coord)
+            if (file and start[0] != file) or (rank and start[1] != rank):
+                continue
+            candidates.append(move)
+    if len(candidates) != 1:
+        raise ValueError(f"{'ambiguous' if candidates else 'illegal'} san {san} in {chessmenBoardUtility.board_state2fen(board_state)}")
+    return candidates[0]
+
+def iter_pgn_records(lines: Iterable[str]) -> Iterator[str]:
+    # splits a stream of lines into the text of its games, one game in memory at a time
+    record: List[str] = []
+    in_movetext = False
+    comment_depth = 0
+    for line in lines:
+        stripped = line.strip()
+        if stripped.startswith('[') and comment_depth == 0:
+            if in_movetext: # tags after movetext start the next game
+                yield ''.join(record)
+                record, in_movetext = [], False
+        elif stripped and not stripped.startswith('%'):
+            in_movetext = True
+            comment_depth += stripped.count('{') - stripped.count('}')
+        record.append(line)
+    if any(line.strip() for line in record):
+        yield ''.join(record)
+
+def _movetext_tokens(movetext: str) -> Iterator[str]:
+    movetext = MOVETEXT_SKIP_PATTERN.sub(' ', movetext)
+    depth = 0 # variations can nest
+    for token in movetext.replace('(', ' ( ').replace(')', ' ) ').split():
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+        elif depth == 0:
+            token = token.split('.')[-1] # "12.e4" and "12..." (which leaves '')
+            if token and token not in RESULTS:
+                yield token
+
+def parse_pgn(record: str) -> chessmenPGNGame:
+    # one game as split by iter_pgn_records
+    game = chessmenPGNGame()
+    movetext = []
+    for line in record.splitlines():
+        match = TAG_PATTERN.match(line.strip())
+        if match != None and not movetext:
+            game.headers[match.group(1)] = match.group(2).replace('\\"', '"').replace('\\\\', '\\')
+        else:
+            movetext.append(line)
+    board_state = chessmenBoardUtility.fen2board_state(game.start_fen)
+    for san in _movetext_tokens('\n'.join(movetext)):
+        move = san2move(san, board_state)
+        game.moves.append(move)
+        board_state.update(move)
+    return game
+
+def _parse_pgn_or_error(record: str) -> Union[chessmenPGNGame, str]:
+    # the error of a game that does not parse is returned, so it never leaves a pool worker (and the rest of its chunk) behind
+    try:
+        return parse_pgn(record)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+
+def _skip_errors(results: Iterable[Union[chessmenPGNGame, str]]) -> Iterator[chessmenPGNGame]:
+    for index, result in enumerate(results):
+        if isinstance(result, str):
+            logger.warning("pgn game skipped index=%d error=%s", index, result)
+            continue
+        yield result
+
+def read_pgn(source: TextIO, processes: int = 0, chunk_size: int = PGN_CHUNK_SIZE, strict: bool = False) -> Iterator[chessmenPGNGame]:
+    # games of a pgn file in file order, with processes > 0 the games are parsed on a pool of that many processes
+    # games that do not parse (an illegal move, a broken fen) are skipped with a warning naming their index, strict raises their error instead
+    records = iter_pgn_records(source)
+    parse = parse_pgn if strict else _parse_pgn_or_error
+    if processes <= 0:
+        yield from _skip_errors(map(parse, records))
+        return
+    with multiprocessing.Pool(processes) as pool:
+        yield from _skip_errors(imap_bounded(pool, parse, records, chunk_size, processes * PGN_MAX_IN_FLIGHT))
+
+def _format_tag(name: str, value: str) -> str:
+    value = value.replace('\\', '\\\\').replace('"', '\\"')
+    return f'[{name} "{value}"]'
+
+def format_pgn(game: chessmenPGNGame) -> str:
+    # the seven tag roster first (with '?' for missing tags), then the other tags and the movetext
+    headers = {name: game.headers.get(name, "*" if name == "Result" else "?") for name in SEVEN_TAG_ROSTER}
+    headers.update(game.headers)
+    lines = [_format_tag(name, value) for name, value in headers.items()]
+    lines.append('')
+    board_state = chessmenBoardUtility.fen2board_state(game.start_fen)
+    tokens = []
+    for index, move in enumerate(game.moves):
+        if board_state.active_color == 'white':
+            tokens.append(f"{board_state.full_moves}.")
+        elif index == 0:
+            tokens.append(f"{board_state.full_moves}...")
+        tokens.append(move2san(move, board_state))
+        board_state.update(move)
+    tokens.append(headers["Result"])
+    line = ''
+    for token in tokens:
+        if line and len(line) + 1 + len(token) > PGN_LINE_WIDTH:
+            lines.append(line)
+            line = token
+        else:
+            line = f"{line} {token}" if line else token
+    lines.append(line)
+    return '\n'.join(lines) + '\n\n'
+
+def write_pgn(games: Iterable[chessmenPGNGame], target: TextIO, processes: int = 0, chunk_size: int = PGN_CHUNK_SIZE) -> int:
+    # writes the games as they come (so a generator is never held in memory), returns the number of games written
+    count = 0
+    if processes <= 0:
+        for game in games:
+            target.write(format_pgn(game))
+            count += 1
+        return count
+    with multiprocessing.Pool(processes) as pool:
+        for text in imap_bounded(pool, format_pgn, games, chunk_size, processes * PGN_MAX_IN_FLIGHT):
+            target.write(text)
+            count += 1
+    return count
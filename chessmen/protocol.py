@@ -0,0 +1,98 @@
+import struct
+from typing import Dict, List, Optional, Tuple
+
+from .engine import FEN, COORD
+from .utils import encode_frame
+
+# binary protocol, negotiated with a "PERSIST::<user_id>::binary" handshake
+# every message is a length-prefixed frame (see utils.encode_frame) holding a header and a body
+PROTOCOL_VERSION = 1
+NO_VERSION = 0xFFFFFFFF # match version field of messages that do not refer to one
+HEADER = struct.Struct('!BBI') # protocol version, opcode, match version
+MOVE = struct.Struct('!H')
+WAIT = struct.Struct('!f') # seconds, body of a long-poll STATUS_MATCH
+MATCH_HEADER = struct.Struct('!BH') # flags, fen length (then fen and opponent user id)
+MATCH_OVER_HEADER = struct.Struct('!BBHB') # flags, twice the score of white, fen length, reason length (then fen, reason and opponent user id)
+
+# request opcodes (bodies: UPDATE_MATCH -> fen, MAKE_MOVE -> move, STATUS_MATCH -> optional wait, others empty)
+REQUEST_OPCODES: Dict[str, int] = {
+    "FIND_MATCH": 1,
+    "STATUS_MATCH": 2,
+    "UPDATE_MATCH": 3,
+    "MAKE_MOVE": 4,
+    "SUBSCRIBE_MATCH": 5,
+    "KILLSWITCH": 6,
+    "DUMP_STATE": 7,
+}
+REQUEST_TYPES: Dict[int, str] = {opcode: request_type for request_type, opcode in REQUEST_OPCODES.items()}
+
+# reply opcodes
+REPLY_SUCCESS = 0x80 # body: message
+REPLY_ERROR = 0x81 # body: message
+REPLY_IN_QUEUE = 0x82
+REPLY_IN_MATCH = 0x83 # body: flags, fen and opponent user id
+REPLY_UNCHANGED = 0x84
+REPLY_MOVES = 0x85 # body: flags, then the moves since the version the client knows (oldest first)
+REPLY_MATCH_OVER = 0x86 # body: flags, result, final fen, reason and opponent user id
+
+# match flags
+FLAG_USER_TURN = 1
+FLAG_USER_WHITE = 2
+
+PROMOTION_CODES: List[Optional[str]] = [None, 'n', 'b', 'r', 'q']
+
+def encode_move(start_coord: COORD, target_coord: COORD, promotion: Optional[str]) -> int:
+    # 6 bits start square, 6 bits target square, 3 bits promotion piece
+    start_square = start_coord[0] * 8 + start_coord[1]
+    target_square = target_coord[0] * 8 + target_coord[1]
+    return (start_square << 9) | (target_square << 3) | PROMOTION_CODES.index(promotion)
+
+def valid_move(value: int) -> bool:
+    # every start and target square decodes, only some promotion codes do
+    return value & 7 < len(PROMOTION_CODES)
+
+def decode_move(value: int) -> Tuple[COORD, COORD, Optional[str]]:
+    if not valid_move(value):
+        raise ValueError(f"invalid promotion code in move {value}")
+    start_square, target_square = (value >> 9) & 63, (value >> 3) & 63
+    return divmod(start_square, 8), divmod(target_square, 8), PROMOTION_CODES[value & 7]
+
+def encode_message(opcode: int, version: int = NO_VERSION, body: bytes = b'') -> bytes:
+    # complete frame, ready to send
+    return encode_frame(HEADER.pack(PROTOCOL_VERSION, opcode, version) + body)
+
+def decode_message(message: bytes) -> Tuple[int, int, int, bytes]:
+    # message is a frame without its length prefix (as returned by utils.decode_frames / utils.recv_frame)
+    if len(message) < HEADER.size:
+        raise ValueError(f"message of {len(message)} bytes is shorter than its header")
+    protocol_version, opcode, version = HEADER.unpack_from(message)
+    return protocol_version, opcode, version, message[HEADER.size: ]
+
+def match_flags(user_turn: bool, user_white: bool) -> int:
+    return (FLAG_USER_TURN if user_turn else 0) | (FLAG_USER_WHITE if user_white else 0)
+
+def encode_match(flags: int, fen: FEN, opponent_user_id: str) -> bytes:
+    fen = fen.encode()
+    return MATCH_HEADER.pack(flags, len(fen)) + fen + opponent_user_id.encode()
+
+def decode_match(body: bytes) -> Tuple[int, FEN, str]:
+    flags, fen_length = MATCH_HEADER.unpack_from(body)
+    fen = body[MATCH_HEADER.size: MATCH_HEADER.size + fen_length].decode()
+    return flags, fen, body[MATCH_HEADER.size + fen_length: ].decode()
+
+def encode_match_over(flags: int, white_score: float, fen: FEN, reason: str, opponent_user_id: str) -> bytes:
+    fen, reason = fen.encode(), reason.encode()
+    return MATCH_OVER_HEADER.pack(flags, int(white_score * 2), len(fen), len(reason)) + fen + reason + opponent_user_id.encode()
+
+def decode_match_over(body: bytes) -> Tuple[int, float, FEN, str, str]:
+    flags, result, fen_length, reason_length = MATCH_OVER_HEADER.unpack_from(body)
+    fen_end = MATCH_OVER_HEADER.size + fen_length
+    fen = body[MATCH_OVER_HEADER.size: fen_end].decode()
+    reason = body[fen_end: fen_end + reason_length].decode()
+    return flags, result / 2, fen, reason, body[fen_end + reason_length: ].decode()
+
+def encode_moves(flags: int, moves: List[int]) -> bytes:
+    return bytes([flags]) + struct.pack(f'!{len(moves)}H', *moves)
+
+def decode_moves(body: bytes) -> Tuple[int, List[int]]:
+    return body[0], list(struct.unpack(f'!{(len(body) - 1) // 2}H', body[1: ]))
@@ -0,0 +1,52 @@
+import time
+from typing import Any, List, Tuple
+
+class chessmenTimerWheel:
+    """ chessmenTimerWheel is a hierarchical timer wheel, scheduling is O(1) and expiring is O(1) per timer (plus cascading) """
+    def __init__(self, tick: float, slots: int = 64, levels: int = 4) -> None:
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        # wheels[level][slot] holds (expiry tick, item), a level covers slots ** (level + 1) ticks
+        self.wheels: List[List[List[Tuple[int, Any]]]] = [[[] for _ in range(slots)] for _ in range(levels)]
+        self.current_tick = int(time.time() / tick)
+
+    def __len__(self) -> int:
+        return sum(len(slot) for wheel in self.wheels for slot in wheel)
+
+    def _insert(self, expiry_tick: int, item: Any) -> None:
+        delta = expiry_tick - self.current_tick
+        for level in range(self.levels):
+            span = self.slots ** level
+            if delta < span * self.slots or level == self.levels - 1:
+                self.wheels[level][(expiry_tick // span) % self.slots].append((expiry_tick, item))
+                return
+
+    def schedule(self, deadline: float, item: Any) -> None:
+        # fires on the first advance past the deadline (rounded up to a tick)
+        self._insert(max(int(deadline / self.tick) + 1, self.current_tick + 1), item)
+
+    def advance(self, now: float) -> List[Any]:
+        # move the wheel up to now and return the expired items
+        expired = []
+        target_tick = int(now / self.tick)
+        while self.current_tick < target_tick:
+            self.current_tick += 1
+            # when a lower wheel wraps, the next slot of the wheel above is spread over the levels below (highest first)
+            level = 1
+            while level < self.levels and self.current_tick % (self.slots ** level) == 0:
+                level += 1
+            for cascade_level in range(level - 1, 0, -1):
+                span = self.slots ** cascade_level
+                slot = (self.current_tick // span) % self.slots
+                entries, self.wheels[cascade_level][slot] = self.wheels[cascade_level][slot], []
+                for expiry_tick, item in entries:
+                    self._insert(expiry_tick, item)
+            slot = self.current_tick % self.slots
+            entries, self.wheels[0][slot] = self.wheels[0][slot], []
+            for expiry_tick, item in entries:
+                if expiry_tick <= self.current_tick:
+                    expired.append(item)
+                else: # beyond the top level, goes around again
+                    self._insert(expiry_tick, item)
+        return expired
@@ -0,0 +1,357 @@
+import os
+import time
+import struct
+import multiprocessing
+from multiprocessing import shared_memory
+from dataclasses import dataclass
+from typing import Dict, List, Tuple, Optional, Iterable
+
+from .engine import FEN, chessmenMove, chessmenBoardState, chessmenBoardUtility
+from .bitboard import iter_squares
+from .protocol import encode_move, decode_move
+
+SEARCH_TIME = 1.0 # seconds per move
+MAX_DEPTH = 32
+MAX_PLY = 64
+MATE_SCORE = 100000 # mate in n plies scores MATE_SCORE - n
+INFINITY = MATE_SCORE + 1
+TIME_CHECK_NODES = 64 # nodes between deadline checks
+TT_SIZE = 1 << 18 # entries
+SEARCH_PROCESSES = os.cpu_count() or 1
+
+# transposition table bounds
+EXACT, LOWER_BOUND, UPPER_BOUND = 0, 1, 2
+
+# material and piece-square tables (https://www.chessprogramming.org/Simplified_Evaluation_Function)
+# tables are from the side of white, indexed by square (a8 = 0), black reads them mirrored
+PIECE_VALUES: Dict[str, int] = {'p': 100, 'n': 320, 'b': 330, 'r': 500, 'q': 900, 'k': 0}
+PIECE_SQUARE_TABLES: Dict[str, List[int]] = {
+    'p': [
+        0, 0, 0, 0, 0, 0, 0, 0,
+        50, 50, 50, 50, 50, 50, 50, 50,
+        10, 10, 20, 30, 30, 20, 10, 10,
+        5, 5, 10, 25, 25, 10, 5, 5,
+        0, 0, 0, 20, 20, 0, 0, 0,
+        5, -5, -10, 0, 0, -10, -5, 5,
+        5, 10, 10, -20, -20, 10, 10, 5,
+        0, 0, 0, 0, 0, 0, 0, 0,
+    ],
+    'n': [
+        -50, -40, -30, -30, -30, -30, -40, -50,
+        -40, -20, 0, 0, 0, 0, -20, -40,
+        -30, 0, 10, 15, 15, 10, 0, -30,
+        -30, 5, 15, 20, 20, 15, 5, -30,
+        -30, 0, 15, 20, 20, 15, 0, -30,
+        -30, 5, 10, 15, 15, 10, 5, -30,
+        -40, -20, 0, 5, 5, 0, -20, -40,
+        -50, -40, -30, -30, -30, -30, -40, -50,
+    ],
+    'b': [
+        -20, -10, -10, -10, -10, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 10, 10, 5, 0, -10,
+        -10, 5, 5, 10, 10, 5, 5, -10,
+        -10, 0, 10, 10, 10, 10, 0, -10,
+        -10, 10, 10, 10, 10, 10, 10, -10,
+        -10, 5, 0, 0, 0, 0, 5, -10,
+        -20, -10, -10, -10, -10, -10, -10, -20,
+    ],
+    'r': [
+        0, 0, 0, 0, 0, 0, 0, 0,
+        5, 10, 10, 10, 10, 10, 10, 5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        0, 0, 0, 5, 5, 0, 0, 0,
+    ],
+    'q': [
+        -20, -10, -10, -5, -5, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 5, 5, 5, 0, -10,
+        -5, 0, 5, 5, 5, 5, 0, -5,
+        0, 0, 5, 5, 5, 5, 0, -5,
+        -10, 5, 5, 5, 5, 5, 0, -10,
+        -10, 0, 5, 0, 0, 0, 0, -10,
+        -20, -10, -10, -5, -5, -10, -10, -20,
+    ],
+    'k': [
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -20, -30, -30, -40, -40, -30, -30, -20,
+        -10, -20, -20, -20, -20, -20, -20, -10,
+        20, 20, 0, 0, 0, 0, 20, 20,
+        20, 30, 10, 0, 0, 10, 30, 20,
+    ],
+}
+# value of a piece on a square, white positive and black negative
+PIECE_SQUARE_VALUES: Dict[str, List[int]] = {}
+for _piece, _table in PIECE_SQUARE_TABLES.items():
+    PIECE_SQUARE_VALUES[_piece.upper()] = [PIECE_VALUES[_piece] + _table[sq] for sq in range(64)]
+    PIECE_SQUARE_VALUES[_piece] = [-(PIECE_VALUES[_piece] + _table[sq ^ 56]) for sq in range(64)]
+
+class chessmenSearchTimeout(Exception):
+    pass
+
+class chessmenTranspositionTable:
+    """ chessmenTranspositionTable is a fixed-size table of search results by position hash, a slot keeps the deeper result (replace-by-depth) """
+    # an entry is the position hash xor the data, and the data (https://www.chessprogramming.org/Shared_Hash_Table#Lockless)
+    # so an entry torn by two processes writing it at once reads as a miss
+    # data: score + SCORE_OFFSET (20 bits), move (16 bits), depth (8 bits), bound (2 bits), generation (8 bits)
+    ENTRY = struct.Struct('=QQ')
+    SCORE_OFFSET = 1 << 19
+
+    def __init__(self, size: int = TT_SIZE, buffer: Optional[memoryview] = None) -> None:
+        self.size = size
+        # any writable buffer of size * ENTRY.size bytes (zeroed means empty)
+        self.buffer = buffer if buffer != None else bytearray(size * self.ENTRY.size)
+        self.generation = 0
+
+    def new_search(self) -> None:
+        # entries of earlier searches are replaced regardless of their depth
+        self.generation = (self.generation + 1) & 0xFF
+
+    def probe(self, key: int) -> Optional[Tuple[int, int, int, int]]:
+        # score, move, depth and bound of the position, None if it is not in the table
+        checked_key, data = self.ENTRY.unpack_from(self.buffer, (key % self.size) * self.ENTRY.size)
+        if checked_key ^ data != key:
+            return None
+        return (data & 0xFFFFF) - self.SCORE_OFFSET, (data >> 20) & 0xFFFF, (data >> 36) & 0xFF, (data >> 44) & 3
+
+    def store(self, key: int, score: int, move: int, depth: int, bound: int) -> None:
+        offset = (key % self.size) * self.ENTRY.size
+        checked_key, data = self.ENTRY.unpack_from(self.buffer, offset)
+        if checked_key ^ data == key or (data >> 46) != self.generation or depth >= (data >> 36) & 0xFF:
+            data = (score + self.SCORE_OFFSET) | (move << 20) | (depth << 36) | (bound << 44) | (self.generation << 46)
+            self.ENTRY.pack_into(self.buffer, offset, key ^ data, data)
+
+class chessmenSharedTranspositionTable(chessmenTranspositionTable):
+    """ chessmenSharedTranspositionTable keeps its entries in shared memory, other processes attach to it by name """
+    def __init__(self, size: int = TT_SIZE, name: Optional[str] = None) -> None:
+        if name == None:
+            self.memory = shared_memory.SharedMemory(create=True, size=size * self.ENTRY.size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        super().__init__(size, self.memory.buf)
+
+    @property
+    def name(self) -> str:
+        return self.memory.name
+
+    def new_search(self) -> None:
+        # every process of a search has to use the same generation, so it is set by whoever starts the search
+        pass
+
+    def close(self) -> None:
+        self.buffer = None
+        self.memory.close()
+
+    def unlink(self) -> None:
+        self.memory.unlink()
+
+@dataclass
+class chessmenSearchResult:
+    move: Optional[chessmenMove]
+    score: int # centipawns for the side to move
+    depth: int # last completed iteration
+    nodes: int
+    time: float # seconds
+
+class chessmenSearch:
+    """ chessmenSearch is an iterative deepening alpha-beta search (https://www.chessprogramming.org/Alpha-Beta) """
+    def __init__(self, table: Optional[chessmenTranspositionTable] = None) -> None:
+        self.table = table if table != None else chessmenTranspositionTable()
+        # quiet moves that caused a cutoff, two per ply, and by (piece, target square) over the whole search
+        self.killers: List[List[int]] = [[0, 0] for _ in range(MAX_PLY)]
+        self.history: Dict[Tuple[str, int], int] = {}
+        self.path: List[int] = [] # position hashes of the game and the current line, for repetitions
+        self.nodes = 0
+        self.deadline = 0.0
+        self.root_move: Optional[chessmenMove] = None
+
+    @staticmethod
+    def evaluate(board_state: chessmenBoardState) -> int:
+        # static evaluation for the side to move
+        score = 0
+        for piece, bb in board_state.bitboard.pieces.items():
+            if bb:
+                values = PIECE_SQUARE_VALUES[piece]
+                for sq in iter_squares(bb):
+                    score += values[sq]
+        return score if board_state.active_color == 'white' else -score
+
+    def search(self, board_state: chessmenBoardState, time_budget: float = SEARCH_TIME, max_depth: int = MAX_DEPTH, history: Iterable[int] = (),
+               first_depth: int = 1) -> chessmenSearchResult:
+        # best move within the time budget, history holds the position hashes before board_state (which is not changed)
+        start_time = time.perf_counter()
+        self.deadline = start_time + time_budget
+        self.nodes = 0
+        self.table.new_search()
+        self.killers = [[0, 0] for _ in range(MAX_PLY)]
+        self.history = {key: value // 2 for key, value in self.history.items() if value > 1}
+        board_state = board_state.copy()
+        game_path = list(history)
+        legal_moves = chessmenBoardUtility.generate_legal_moves(board_state)
+        if not legal_moves:
+            score = -MATE_SCORE if chessmenBoardUtility.is_in_check(board_state, board_state.active_color) else 0
+            return chessmenSearchResult(None, score, 0, 0, 0.0)
+        best_move, best_score, completed_depth = legal_moves[0], 0, 0
+        for depth in range(first_depth, max_depth + 1):
+            self.path = game_path.copy()
+            self.root_move = None
+            try:
+                score = self._negamax(board_state, depth, -INFINITY, INFINITY, 0)
+            except chessmenSearchTimeout: # the board state is a copy, so the interrupted line is left on it
+                break
+            best_move, best_score, completed_depth = self.root_move, score, depth
+            elapsed = time.perf_counter() - start_time
+            # a found mate will not get better, and the next iteration takes longer than all before it
+            if abs(score) >= MATE_SCORE - MAX_PLY or len(legal_moves) == 1 or elapsed > time_budget / 2:
+                break
+        return chessmenSearchResult(best_move, best_score, completed_depth, self.nodes, time.perf_counter() - start_time)
+
+    def _tick(self) -> None:
+        self.nodes += 1
+        if self.nodes % TIME_CHECK_NODES == 0 and time.perf_counter() > self.deadline:
+            raise chessmenSearchTimeout()
+
+    def _order(self, board_state: chessmenBoardState, moves: List[chessmenMove], table_move: int, ply: int) -> List[chessmenMove]:
+        # table move, captures by MVV-LVA (and promotions), killers, then quiet moves by history
+        board = board_state.board
+        killers = self.killers[ply] if ply < MAX_PLY else ()
+        def priority(move: chessmenMove) -> int:
+            key = encode_move(move.start_coord, move.target_coord, move.promotion)
+            if key == table_move:
+                return 1 << 30
+            piece = board[move.start_coord[0]][move.start_coord[1]]
+            victim = 'p' if move.move_type == 'en_passant' else board[move.target_coord[0]][move.target_coord[1]].lower()
+            if victim != ' ' or move.promotion != None:
+                return (1 << 24) + 16 * PIECE_VALUES[victim if victim != ' ' else 'p'] - PIECE_VALUES[piece.lower()] + (PIECE_VALUES[move.promotion] if move.promotion else 0)
+            if key in killers:
+                return 1 << 23
+            return min(self.history.get((piece, move.target_coord[0] * 8 + move.target_coord[1]), 0), (1 << 23) - 1)
+        return sorted(moves, key=priority, reverse=True)
+
+    def _negamax(self, board_state: chessmenBoardState, depth: int, alpha: int, beta: int, ply: int) -> int:
+        self._tick()
+        key = board_state.position_hash
+        if ply > 0 and (key in self.path or board_state.half_moves >= 100): # any repetition is scored as the draw it can be forced into
+            return 0
+        in_check = chessmenBoardUtility.is_in_check(board_state, board_state.active_color)
+        if in_check: # check extension
+            depth += 1
+        if depth <= 0 or ply >= MAX_PLY - 1:
+            return self._quiescence(board_state, alpha, beta, ply)
+        table_move = 0
+        entry = self.table.probe(key)
+        if entry != None:
+            score, table_move, entry_depth, bound = entry
+            # mate scores are stored relative to the position
+            score = score - ply if score > MATE_SCORE - MAX_PLY else score + ply if score < -MATE_SCORE + MAX_PLY else score
+            if ply > 0 and entry_depth >= depth and (bound == EXACT or (bound == LOWER_BOUND and score >= beta) or (bound == UPPER_BOUND and score <= alpha)):
+                return score
+        legal_moves = chessmenBoardUtility.generate_legal_moves(board_state)
+        if not legal_moves:
+            return -MATE_SCORE + ply if in_check else 0
+        original_alpha = alpha
+        best_score, best_move = -INFINITY, 0
+        board = board_state.board
+        self.path.append(key)
+        for move in self._order(board_state, legal_moves, table_move, ply):
+            undo = board_state.make_move(move)
+            score = -self._negamax(board_state, depth - 1, -beta, -alpha, ply + 1)
+            board_state.unmake_move(undo)
+            if score > best_score:
+                best_score, best_move = score, encode_move(move.start_coord, move.target_coord, move.promotion)
+                if ply == 0:
+                    self.root_move = move
+            alpha = max(alpha, score)
+            if alpha >= beta:
+                if undo.captured_piece == ' ' and move.promotion == None: # quiet move
+                    if best_move not in self.killers[ply]:
+                        self.killers[ply] = [best_move, self.killers[ply][0]]
+                    history_key = (board[move.start_coord[0]][move.start_coord[1]], move.target_coord[0] * 8 + move.target_coord[1])
+                    self.history[history_key] = self.history.get(history_key, 0) + depth * depth
+                break
+        self.path.pop()
+        bound = UPPER_BOUND if best_score <= original_alpha else LOWER_BOUND if best_score >= beta else EXACT
+        table_score = best_score + ply if best_score > MATE_SCORE - MAX_PLY else best_score - ply if best_score < -MATE_SCORE + MAX_PLY else best_score
+        self.table.store(key, table_score, best_move, depth, bound)
+        return best_score
+
+    def _quiescence(self, board_state: chessmenBoardState, alpha: int, beta: int, ply: int) -> int:
+        # only captures and promotions are searched, so the evaluation is not taken in the middle of an exchange
+        self._tick()
+        stand_pat = self.evaluate(board_state)
+        if stand_pat >= beta or ply >= MAX_PLY - 1:
+            return stand_pat
+        alpha = max(alpha, stand_pat)
+        board = board_state.board
+        captures = [move for move in chessmenBoardUtility.generate_legal_moves(board_state)
+                    if move.promotion != None or move.move_type == 'en_passant' or board[move.target_coord[0]][move.target_coord[1]] != ' ']
+        for move in self._order(board_state, captures, 0, ply):
+            undo = board_state.make_move(move)
+            score = -self._quiescence(board_state, -beta, -alpha, ply + 1)
+            board_state.unmake_move(undo)
+            if score >= beta:
+                return score
+            alpha = max(alpha, score)
+        return alpha
+
+_search: Optional[chessmenSearch] = None
+
+def search_fen(fen: FEN, time_budget: float = SEARCH_TIME, history: Tuple[int, ...] = ()) -> Optional[int]:
+    # entry point of search processes, returns the encoded best move (see protocol.encode_move), the table is kept between calls
+    # history holds the position hashes of the game (see chessmenSearch.search), without it repetitions go unseen
+    global _search
+    if _search == None:
+        _search = chessmenSearch()
+    result = _search.search(chessmenBoardUtility.fen2board_state(fen), time_budget, history=history)
+    if result.move == None:
+        return None
+    return encode_move(result.move.start_coord, result.move.target_coord, result.move.promotion)
+
+# search processes of a parallel search, attached to the table of the search that started them
+_shared_search: Optional[chessmenSearch] = None
+
+def _attach_table(name: str, size: int) -> None:
+    global _shared_search
+    _shared_search = chessmenSearch(chessmenSharedTranspositionTable(size, name=name))
+
+def _lazy_smp_search(fen: FEN, time_budget: float, max_depth: int, history: Tuple[int, ...], generation: int, worker: int) -> Tuple[Optional[int], int, int, int]:
+    # every other process starts a depth deeper, so the processes do not all search the same iteration
+    _shared_search.table.generation = generation
+    result = _shared_search.search(chessmenBoardUtility.fen2board_state(fen), time_budget, max_depth, history, first_depth=1 + worker % 2)
+    move = None if result.move == None else encode_move(result.move.start_coord, result.move.target_coord, result.move.promotion)
+    return move, result.score, result.depth, result.nodes
+
+class chessmenParallelSearch:
+    """ chessmenParallelSearch runs a Lazy SMP search (https://www.chessprogramming.org/Lazy_SMP), every process searches the position and they share a table """
+    def __init__(self, processes: int = SEARCH_PROCESSES, table_size: int = TT_SIZE) -> None:
+        self.processes = processes
+        self.table = chessmenSharedTranspositionTable(table_size)
+        self.pool = multiprocessing.Pool(processes, initializer=_attach_table, initargs=(self.table.name, table_size))
+
+    def search(self, board_state: chessmenBoardState, time_budget: float = SEARCH_TIME, max_depth: int = MAX_DEPTH, history: Iterable[int] = ()) -> chessmenSearchResult:
+        # processes get the fen, not the board state, and the result of the deepest finished iteration wins
+        start_time = time.perf_counter()
+        fen = chessmenBoardUtility.board_state2fen(board_state)
+        self.table.generation = (self.table.generation + 1) & 0xFF
+        history = tuple(history)
+        tasks = [self.pool.apply_async(_lazy_smp_search, (fen, time_budget, max_depth, history, self.table.generation, worker)) for worker in range(self.processes)]
+        results = [task.get() for task in tasks]
+        move, score, depth, _ = max(results, key=lambda result: (result[0] != None, result[2]))
+        if move != None:
+            start_coord, target_coord, promotion = decode_move(move)
+            move = next(legal_move for legal_move in chessmenBoardUtility.get_valid_moves(start_coord, board_state)
+                        if legal_move.target_coord == target_coord and legal_move.promotion == promotion)
+        return chessmenSearchResult(move, score, depth, sum(result[3] for result in results), time.perf_counter() - start_time)
+
+    def close(self) -> None:
+        self.pool.terminate()
+        self.pool.join()
+        self.table.close()
+        self.table.unlink()
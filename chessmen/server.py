@@ -1,24 +1,47 @@
+import os
 import time
+import heapq
 import socket
 import random
-from datetime import datetime
-from dataclasses import dataclass
-from typing import Dict, List, Tuple, Optional, Literal
+import itertools
+import selectors
+import threading
+import multiprocessing
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple, Optional, Literal, Deque
 
-from .engine import FEN, START_FEN
-from .utils import get_env, string_hash
+from .engine import FEN, START_FEN, COORD, GAME_STATUS, chessmenBoardState, chessmenBoardUtility
+from .utils import get_env, string_hash, random_hash, sharedMem, encode_frame, decode_frames
+from .matchmaking import chessmenMatchQueue, chessmenRatedMatchQueue
+from .scheduler import chessmenTimerWheel
+from .store import chessmenMatchStore
+from .archive import chessmenArchive, chessmenArchivedGame
+from .search import search_fen
+from .logger import get_logger, start_logging, stop_logging
+from .protocol import PROTOCOL_VERSION, NO_VERSION, MOVE, WAIT, REQUEST_TYPES, REPLY_SUCCESS, REPLY_ERROR, REPLY_IN_QUEUE, REPLY_IN_MATCH, REPLY_UNCHANGED, REPLY_MOVES, REPLY_MATCH_OVER
+from .protocol import HEADER, valid_move, encode_move, decode_move, encode_message, decode_message, match_flags, encode_match, encode_moves, encode_match_over
 
 IP_ADDR, PORT, BUFFER_SIZE, SERVER_HASH = get_env()
-SERVER_MIN_REFRESH_TIME = 3 # seconds
 USER_MAX_IDLE_TIME = 30 # seconds
+FINISHED_MATCH_GRACE_TIME = USER_MAX_IDLE_TIME # seconds the users of a finished match can still read its result
+EXPIRY_TICK = 0.5 # seconds between runs of the expiry thread
+SELECT_TIMEOUT = 1 # seconds
+LONG_POLL_TIMEOUT = 20 # seconds (below USER_MAX_IDLE_TIME, so a long-polling user never goes idle)
+BOT_WAIT_TIME = 10 # seconds a user waits in queue before a bot takes the match
+BOT_MOVE_TIME = 1.0 # seconds of search per bot move
+BOT_USER_PREFIX = "bot_"
 USER_STATUS = Literal['in_queue', 'in_match']
 
+logger = get_logger("server")
+
 @dataclass
 class chessmenUser:
     user_id: str
     status: USER_STATUS = 'in_queue'
     match_id: Optional[str] = None
-    last_ping: float = time.time()
+    last_ping: float = field(default_factory=time.time)
+    bot: bool = False # played by the server, never goes idle
 
     def refresh_ping(self) -> None:
         self.last_ping = time.time()
@@ -32,10 +55,78 @@ class chessmenMatch:
     white_user_id: str
     black_user_id: str
     fen: FEN = START_FEN
+    version: int = 1 # increases with every change of the match
+    # parsed fen, kept resident so moves are validated and applied without parsing the fen again
+    board_state: Optional[chessmenBoardState] = field(default=None, repr=False)
+    # encoded moves that led from moves_base_version to version (binary clients get only the moves they miss)
+    moves: List[int] = field(default_factory=list, repr=False)
+    moves_base_version: int = field(default=1, repr=False)
+    moves_base_fen: FEN = field(default=START_FEN, repr=False)
+    # occurrences of the positions since the last pawn move or capture (earlier ones cannot come back), by position hash
+    repetitions: Dict[int, int] = field(default_factory=dict, repr=False)
+
+    def _board_state(self) -> chessmenBoardState:
+        # parses the fen on first use, and counts the position it gives
+        if self.board_state == None:
+            self.board_state = chessmenBoardUtility.fen2board_state(self.fen)
+            self._count_position()
+        return self.board_state
+
+    def _count_position(self) -> None:
+        if self.board_state.half_moves == 0:
+            self.repetitions.clear()
+        key = self.board_state.position_hash
+        self.repetitions[key] = self.repetitions.get(key, 0) + 1
+
+    def update_fen(self, fen: FEN) -> None:
+        self.fen = fen
+        self.board_state = None
+        self._board_state()
+        self.version += 1
+        self.moves = []
+        self.moves_base_version = self.version
+        self.moves_base_fen = fen
+
+    def moves_since(self, known_version: Optional[int]) -> Optional[List[int]]:
+        # None if the moves from known_version are not available
+        if known_version == None or not (self.moves_base_version <= known_version < self.version):
+            return None
+        return self.moves[known_version - self.moves_base_version: ]
+
+    def make_move(self, start_coord: COORD, target_coord: COORD, promotion: Optional[str]) -> bool:
+        # applies the move if it is legal for the side to move
+        board_state = self._board_state()
+        if chessmenBoardUtility._get_color(start_coord, board_state.board) != board_state.active_color:
+            return False
+        for move in chessmenBoardUtility.get_valid_moves(start_coord, board_state):
+            if move.target_coord == target_coord and move.promotion == promotion:
+                board_state.update(move)
+                self._count_position()
+                self.fen = chessmenBoardUtility.board_state2fen(self.board_state)
+                self.version += 1
+                self.moves.append(encode_move(start_coord, target_coord, promotion))
+                return True
+        return False
+
+    def game_status(self) -> GAME_STATUS:
+        return chessmenBoardUtility.game_status(self._board_state(), self.repetitions)
+
+    def position_history(self) -> Tuple[int, ...]:
+        # position hashes that can still repeat (see repetitions), so a search can avoid or aim for a repetition
+        self._board_state()
+        return tuple(self.repetitions)
+
+    def white_score(self, game_status: GAME_STATUS) -> float:
+        # result of a finished match, a mated side is the side to move
+        if game_status == 'checkmate':
+            return 0 if self.board_state.active_color == 'white' else 1
+        return 0.5
 
     def check_valid_turn(self, user_id: str) -> bool:
-        user_color = 'w' if user_id == self.white_user_id else 'b'
-        return self.fen.split()[1] == user_color
+        user_color = 'white' if user_id == self.white_user_id else 'black'
+        if self.board_state != None:
+            return self.board_state.active_color == user_color
+        return chessmenBoardUtility.fen2active_color(self.fen) == user_color
 
     @staticmethod
     def create_match(user_id_1: str, user_id_2: str) -> 'chessmenMatch':
@@ -46,67 +137,401 @@ class chessmenMatch:
             black_user_id=user_id_2
         )
 
+@dataclass
+class chessmenFinishedMatch:
+    # final position and result of a closed match, kept for its users until they look for a new match (or the grace time runs out)
+    match_id: str
+    white_user_id: str
+    black_user_id: str
+    fen: FEN
+    version: int # one past the last version of the match, so a long-poll on the final position is answered with the result
+    white_score: float
+    reason: str # game status, or the side that left
+
+    def opponent(self, user_id: str) -> str:
+        return self.black_user_id if user_id == self.white_user_id else self.white_user_id
+
+class chessmenConnection:
+    """ chessmenConnection is the per-socket state of the server event loop """
+    def __init__(self, skt: socket.socket, address: Tuple[str, int]) -> None:
+        self.skt = skt
+        self.address = address
+        self.persistent = False
+        self.in_buffer = bytearray()
+        self.out_buffer = bytearray()
+        self.close_after_write = False # one-shot connections close once the reply is out
+        self.closed = False
+        self.subscribed_user_id: Optional[str] = None
+        # binary connections are bound to the user of the handshake
+        self.binary = False
+        self.user_id: Optional[str] = None
+        self.sent_version: Optional[int] = None # last match version sent on a binary connection
+
+@dataclass
+class chessmenWaiter:
+    # a parked long-poll STATUS_MATCH request
+    connection: chessmenConnection
+    user_id: str
+    known_version: int
+    deadline: float
+    done: bool = False
+
 class chessmenServer:
-    def __init__(self, server_password: str) -> None:
+    def __init__(self, server_password: str, rated_matchmaking: bool = False, authoritative: bool = False, log_level: str = "INFO", log_file: Optional[str] = None,
+                 sharded: bool = False, address: Optional[Tuple[str, int]] = None, store: Optional[chessmenMatchStore] = None,
+                 archive: Optional[chessmenArchive] = None, bots: bool = False, bot_processes: int = 0) -> None:
         if string_hash(server_password) != SERVER_HASH:
             print("incorrect server password")
             exit()
 
+        # bots search on their own processes (one per core unless bot_processes is given), so a bot move never holds up the event loop
+        # and concurrent bot matches do not queue behind each other (started before logging and the socket, so the forked processes inherit neither)
+        self.bot_pool = multiprocessing.Pool(bot_processes or os.cpu_count()) if bots and not sharded else None
+        start_logging(log_level, log_file)
+        address = address or (IP_ADDR, PORT)
         self.skt = socket.socket()
         self.skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.skt.bind((IP_ADDR, PORT))
-        print(f"server started at {IP_ADDR}:{PORT}")
-        self.skt.listen(5)
+        self.skt.bind(address)
+        logger.info("server started address=%s:%d", *address)
+        self.skt.listen(socket.SOMAXCONN)
+        self.skt.setblocking(False)
 
-        self.last_refresh_time = time.time()
         self.users: Dict[str, chessmenUser] = {}
         self.matches: Dict[str, chessmenMatch] = {}
+        # users of closed matches (no longer in users), by the time their record is dropped
+        self.finished: Dict[str, chessmenFinishedMatch] = {}
+        self.finished_timers = chessmenTimerWheel(EXPIRY_TICK)
+        # every access to users and matches holds this lock
+        self.state = sharedMem((self.users, self.matches))
+        self.selector = selectors.DefaultSelector()
+        self.running = False
+        # persistent connections that get match updates pushed to them
+        self.subscribers: Dict[str, chessmenConnection] = {}
+        self.match_queue = chessmenRatedMatchQueue() if rated_matchmaking else chessmenMatchQueue()
+        # authoritative servers only accept moves (MAKE_MOVE), not client computed fens (UPDATE_MATCH)
+        self.authoritative = authoritative
+        # shards of a cluster (see cluster.py) do not pair users, the dispatcher pairs them across shards
+        self.sharded = sharded
+        # the dispatcher's control connection, told about users that left this shard (went idle, left or finished their match)
+        # so it does not pair or route them any more, removals are handed over to the event loop like notifications
+        self.cluster_connection: Optional[chessmenConnection] = None
+        self.removed_user_ids: Deque[str] = deque()
+        # users by the time they would go idle, a ping does not touch the wheel, stale timers are rescheduled when they fire
+        self.idle_timers = chessmenTimerWheel(EXPIRY_TICK)
+        # the expiry thread hands users to notify over to the event loop (the selector is not thread safe)
+        self.expiry_thread = threading.Thread(target=self._expiry_loop, daemon=True)
+        self.pending_notifications: Deque[str] = deque()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        # long-poll requests waiting for a change, by user and by deadline
+        self.waiters: Dict[str, List[chessmenWaiter]] = {}
+        self.waiter_deadlines: List[Tuple[float, int, chessmenWaiter]] = []
+        self.waiter_counter = itertools.count()
+        # users in queue by the time a bot would take their match, and bot moves handed over to the event loop
+        self.bot_timers = chessmenTimerWheel(EXPIRY_TICK)
+        self.pending_bot_moves: Deque[Tuple[str, int, Optional[int]]] = deque()
+        # every change of a match goes to the store, matches it kept are resumed (their users get a full idle time to come back)
+        self.store = store or chessmenMatchStore()
+        for match_id, record in self.store.recover().items():
+            self.matches[match_id] = chessmenMatch(match_id=match_id, white_user_id=record["white_user_id"], black_user_id=record["black_user_id"],
+                                                   fen=record["fen"], version=record["version"], moves_base_version=record["version"], moves_base_fen=record["fen"])
+            for user_id in (record["white_user_id"], record["black_user_id"]):
+                self.users[user_id] = chessmenUser(user_id, status='in_match', match_id=match_id, bot=user_id.startswith(BOT_USER_PREFIX) and self.bot_pool != None)
+                if not self.users[user_id].bot:
+                    self._track_idle(self.users[user_id])
+            self._bot_turn(self.matches[match_id])
+        if self.matches:
+            logger.info("matches recovered count=%d", len(self.matches))
+        # finished matches are kept here (if given) as their moves from the last position set by a fen
+        self.archive = archive
     
-    def refresh(self):
-        matches_to_remove = []
-        users_to_remove = []
-        users_in_queue = []
-        for user_id, user in self.users.items():
-            if user.time_since_last_ping() >= USER_MAX_IDLE_TIME: # user crosses idle time
-                if user.status == "in_match" and not user in users_to_remove: # remove match, and both users (if already not added)
-                    match = self.matches[user.match_id]
-                    users_to_remove.append(match.white_user_id)
-                    users_to_remove.append(match.black_user_id)
-                    matches_to_remove.append(match.match_id)
-                else:
-                    users_to_remove.append(user_id)
-            elif user.status == "in_queue": # add user to queue
-                users_in_queue.append(user_id)
-        
-        # remove matches
-        for match_id in matches_to_remove:
-            del self.matches[match_id]
-
-        # remove users
-        for user_id in users_to_remove:
-            del self.users[user_id]
-        
-        # create matches
-        while len(users_in_queue) >= 2: # 2 users at a time
-            user_id_1, user_id_2 = random.sample(users_in_queue, k=2)
-            match = chessmenMatch.create_match(user_id_1, user_id_2)
-            self.users[user_id_1].status = 'in_match'
-            self.users[user_id_1].match_id = match.match_id
-            users_in_queue.remove(user_id_1)
-            self.users[user_id_2].status = 'in_match'
-            self.users[user_id_2].match_id = match.match_id
-            users_in_queue.remove(user_id_2)
-            self.matches[match.match_id] = match
-        
-        print("\n" + "="*30)
-        print("SERVER REFRESH")
-        print(f"USERS: ({len(self.users)})")
+    def refresh(self) -> List[str]:
+        # expire idle users and pair waiting users, returns the users to notify
+        changed_user_ids = []
+        for user in self.idle_timers.advance(time.time()):
+            if self.users.get(user.user_id) is not user: # already removed (maybe along with its match)
+                continue
+            if user.user_id in self.subscribers: # an open subscription keeps the user alive
+                user.refresh_ping()
+            if user.time_since_last_ping() < USER_MAX_IDLE_TIME: # pinged since the timer was set
+                self._track_idle(user)
+                continue
+            changed_user_ids += self.remove_user(user.user_id)
+        # waiting users may be pairable now that their rating windows widened
+        changed_user_ids += self.create_matches()
+        # users still alone in queue play a bot
+        for user in self.bot_timers.advance(time.time()):
+            if self.users.get(user.user_id) is user and user.status == "in_queue":
+                changed_user_ids += self.create_bot_match(user.user_id)
+        # results nobody came back for (users that looked for a new match since have a newer record or none)
+        removed_user_ids = []
+        for user_id, record in self.finished_timers.advance(time.time()):
+            if self.finished.get(user_id) is record:
+                del self.finished[user_id]
+                removed_user_ids.append(user_id)
+        self._removed(removed_user_ids)
+        return changed_user_ids
+
+    def dump_state(self) -> str:
+        # full listing of users and matches (on demand only, it is O(users))
+        lines = [f"USERS: ({len(self.users)})"]
         for user_id, user in self.users.items():
-            print(f"\t{user_id} : {user} - {user.time_since_last_ping():.2f}")
-        print(f"MATCHES: ({len(self.matches)})")
+            lines.append(f"\t{user_id} : {user} - {user.time_since_last_ping():.2f}")
+        lines.append(f"MATCHES: ({len(self.matches)})")
         for match_id, match in self.matches.items():
-            print(f"\t{match_id} : {match}")
-        print("="*30 + "\n")
+            lines.append(f"\t{match_id} : {match}")
+        lines.append(f"FINISHED: ({len(self.finished)})")
+        for user_id, record in self.finished.items():
+            lines.append(f"\t{user_id} : {record}")
+        return "\n".join(lines)
+
+    def _track_idle(self, user: chessmenUser) -> None:
+        self.idle_timers.schedule(user.last_ping + USER_MAX_IDLE_TIME, user)
+
+    def _expiry_loop(self) -> None:
+        # runs on its own thread, so expiry is never paid for by a request
+        while self.running:
+            time.sleep(EXPIRY_TICK)
+            try:
+                with self.state:
+                    changed_user_ids = self.refresh()
+            except Exception: # only this tick is lost, the thread keeps expiring
+                logger.exception("expiry tick failed")
+                continue
+            if changed_user_ids:
+                self.pending_notifications.extend(changed_user_ids)
+                self._wakeup()
+
+    def _wakeup(self) -> None:
+        # called off the event loop thread, once whatever it hands over is queued
+        try:
+            self.wakeup_send.send(b'\0')
+        except BlockingIOError: # the loop has not drained earlier wakeups yet, it will see these too
+            pass
+
+    def _drain_notifications(self) -> None:
+        try:
+            while self.wakeup_recv.recv(BUFFER_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+        with self.state:
+            while self.pending_notifications:
+                self.notify(self.pending_notifications.popleft())
+            self._report_removed()
+            while self.pending_bot_moves:
+                match_id, version, move = self.pending_bot_moves.popleft()
+                match = self.matches.get(match_id)
+                if match == None or match.version != version or move == None: # the match ended or changed during the search
+                    continue
+                bot_user_id = match.white_user_id if match.check_valid_turn(match.white_user_id) else match.black_user_id
+                self.make_move(bot_user_id, *decode_move(move))
+
+    def add_user(self, user_id: str) -> None:
+        self.finished.pop(user_id, None) # looking for a new match acknowledges the result of the last one
+        user = chessmenUser(user_id)
+        self.users[user_id] = user
+        self._track_idle(user)
+        if self.bot_pool != None:
+            self.bot_timers.schedule(time.time() + BOT_WAIT_TIME, user)
+        self.match_queue.push(user_id)
+        for changed_user_id in self.create_matches():
+            self.notify(changed_user_id)
+
+    def remove_user(self, user_id: str) -> List[str]:
+        # returns the removed users to notify
+        # a match is removed along with both of its users
+        user = self.users[user_id]
+        if user.status == "in_match": # leaving counts as a loss
+            match = self.matches[user.match_id]
+            user_color = 'white' if user_id == match.white_user_id else 'black'
+            user_ids = self._close_match(match, 0 if user_color == 'white' else 1, f"{user_color} left")
+        else:
+            self.match_queue.remove(user_id)
+            del self.users[user_id]
+            user_ids = [user_id]
+            self._removed(user_ids)
+        logger.info("user removed user=%s status=%s", user_id, user.status)
+        return user_ids
+
+    def end_match(self, match: chessmenMatch, game_status: GAME_STATUS) -> None:
+        # a finished game is closed right away, its users get the final position along with the result
+        white_score = match.white_score(game_status)
+        for user_id in self._close_match(match, white_score, game_status.replace('_', ' ')):
+            self.notify(user_id)
+        logger.info("match over match=%s status=%s white_score=%s", match.match_id, game_status, white_score)
+
+    def _close_match(self, match: chessmenMatch, white_score: float, reason: str) -> List[str]:
+        # removes the match along with both of its users (their result stays readable for a while), returns them
+        del self.matches[match.match_id]
+        self.store.log_remove(match.match_id)
+        self.match_queue.record_result(match.white_user_id, match.black_user_id, white_score)
+        record = chessmenFinishedMatch(match.match_id, match.white_user_id, match.black_user_id, match.fen, match.version + 1, white_score, reason)
+        user_ids = [match.white_user_id, match.black_user_id]
+        for user_id in user_ids:
+            # the dispatcher keeps routing the user here until the record is dropped (see refresh)
+            if not self.users.pop(user_id).bot:
+                self.finished[user_id] = record
+                self.finished_timers.schedule(time.time() + FINISHED_MATCH_GRACE_TIME, (user_id, record))
+        # archived last, a game that fails to archive is lost but the match is still closed
+        if self.archive != None:
+            try:
+                self.archive.append(chessmenArchivedGame(match.match_id, match.white_user_id, match.black_user_id, white_score, match.moves_base_fen, match.moves))
+            except Exception:
+                logger.exception("archive append failed match=%s", match.match_id)
+        return user_ids
+
+    def _removed(self, user_ids: List[str]) -> None:
+        # may run on the expiry thread, the event loop sends them on
+        if self.sharded and user_ids:
+            self.removed_user_ids.extend(user_ids)
+            self._wakeup()
+
+    def _report_removed(self) -> None:
+        user_ids = []
+        while self.removed_user_ids:
+            user_ids.append(self.removed_user_ids.popleft())
+        if user_ids and self.cluster_connection != None:
+            self._reply(self.cluster_connection, "removed", '|'.join(user_ids))
+
+    def create_matches(self) -> List[str]:
+        # pair the queue as soon as two users are waiting, returns the paired users to notify
+        paired_user_ids = []
+        if self.sharded:
+            return paired_user_ids
+        while True:
+            user_ids = self.match_queue.pop_pair()
+            if user_ids == None:
+                break
+            self._start_match(*user_ids)
+            paired_user_ids += user_ids
+        return paired_user_ids
+
+    def create_bot_match(self, user_id: str) -> List[str]:
+        # takes the user out of the queue into a match against a new bot, returns the users to notify
+        self.match_queue.remove(user_id)
+        bot_user_id = BOT_USER_PREFIX + random_hash(16)
+        self.users[bot_user_id] = chessmenUser(bot_user_id, bot=True)
+        match = self._start_match(user_id, bot_user_id)
+        self._bot_turn(match)
+        return [user_id]
+
+    def _start_match(self, user_id_1: str, user_id_2: str) -> chessmenMatch:
+        user_id_1, user_id_2 = random.sample([user_id_1, user_id_2], k=2) # random colors
+        match = chessmenMatch.create_match(user_id_1, user_id_2)
+        self.users[user_id_1].status = 'in_match'
+        self.users[user_id_1].match_id = match.match_id
+        self.users[user_id_2].status = 'in_match'
+        self.users[user_id_2].match_id = match.match_id
+        self.matches[match.match_id] = match
+        self.store.log_create(match.match_id, match.white_user_id, match.black_user_id, match.fen, match.version)
+        logger.info("match created match=%s white=%s black=%s", match.match_id, user_id_1, user_id_2)
+        return match
+
+    def _bot_turn(self, match: chessmenMatch) -> None:
+        # starts the search for the move of a bot, if it is the turn of one
+        user_id = match.white_user_id if match.check_valid_turn(match.white_user_id) else match.black_user_id
+        if self.bot_pool == None or not self.users[user_id].bot:
+            return
+        match_id, version = match.match_id, match.version
+        self.bot_pool.apply_async(search_fen, (match.fen, BOT_MOVE_TIME, match.position_history()),
+                                  callback=lambda move: self._bot_move_ready(match_id, version, move),
+                                  error_callback=lambda error: logger.error("bot search failed match=%s error=%r", match_id, error))
+
+    def _bot_move_ready(self, match_id: str, version: int, move: Optional[int]) -> None:
+        # runs on the result thread of the bot pool
+        self.pending_bot_moves.append((match_id, version, move))
+        self._wakeup()
+
+    def match_version(self, user_id: str) -> int:
+        # 0 while the user is still in queue
+        if self.users[user_id].status == "in_match":
+            return self.matches[self.users[user_id].match_id].version
+        return 0
+
+    def status_match(self, user_id: str, known_version: Optional[int] = None) -> Tuple[str, str]:
+        if user_id in self.finished:
+            record = self.finished[user_id]
+            if record.version == known_version:
+                return "success", f"unchanged|{record.version}"
+            return_args = ['match_over', record.fen, record.white_user_id, record.black_user_id, f"{record.white_score:g}", str(record.version), record.reason]
+            return "success", '|'.join(return_args)
+        elif user_id in self.users:
+            version = self.match_version(user_id)
+            if version == known_version: # client already has this version
+                return "success", f"unchanged|{version}"
+            if self.users[user_id].status == "in_queue":
+                return "success", "in_queue"
+            elif self.users[user_id].status == "in_match":
+                match_id = self.users[user_id].match_id
+                match = self.matches[match_id]
+                return_args = ['in_match', match.fen, match.white_user_id, match.black_user_id, str(int(match.check_valid_turn(user_id))), str(match.version)]
+                return "success", '|'.join(return_args)
+        else:
+            return "error", "user is not online"
+
+    def binary_status(self, connection: chessmenConnection, user_id: str, known_version: Optional[int]) -> bytes:
+        # same as status_match, but in match only the moves after known_version are sent (if the server has them)
+        if user_id in self.finished:
+            record = self.finished[user_id]
+            connection.sent_version = record.version
+            if record.version == known_version:
+                return encode_message(REPLY_UNCHANGED, record.version)
+            flags = match_flags(False, user_id == record.white_user_id)
+            return encode_message(REPLY_MATCH_OVER, record.version, encode_match_over(flags, record.white_score, record.fen, record.reason, record.opponent(user_id)))
+        if user_id not in self.users:
+            return encode_message(REPLY_ERROR, body=b"user is not online")
+        version = self.match_version(user_id)
+        connection.sent_version = version
+        if version == known_version:
+            return encode_message(REPLY_UNCHANGED, version)
+        if self.users[user_id].status == "in_queue":
+            return encode_message(REPLY_IN_QUEUE, version)
+        match = self.matches[self.users[user_id].match_id]
+        flags = match_flags(match.check_valid_turn(user_id), user_id == match.white_user_id)
+        moves = match.moves_since(known_version)
+        if moves != None:
+            return encode_message(REPLY_MOVES, version, encode_moves(flags, moves))
+        opponent_user_id = match.black_user_id if user_id == match.white_user_id else match.white_user_id
+        return encode_message(REPLY_IN_MATCH, version, encode_match(flags, match.fen, opponent_user_id))
+
+    def _reply_status(self, connection: chessmenConnection, user_id: str, known_version: Optional[int]) -> None:
+        if connection.binary:
+            self._send(connection, self.binary_status(connection, user_id, known_version))
+        else:
+            self._reply(connection, *self.status_match(user_id, known_version))
+
+    def notify(self, user_id: str) -> None:
+        # push the current match status to the user's subscription and parked long-polls (if any)
+        for waiter in self.waiters.pop(user_id, []):
+            if not waiter.done:
+                waiter.done = True
+                self._reply_status(waiter.connection, user_id, waiter.known_version)
+        connection = self.subscribers.get(user_id)
+        if connection == None:
+            return
+        if user_id not in self.users: # user is gone (the last push is the result of its match), end the subscription
+            del self.subscribers[user_id]
+        # binary subscriptions get the moves since the last push, text ones the full status
+        self._reply_status(connection, user_id, connection.sent_version if connection.binary else None)
+
+    def _park(self, connection: chessmenConnection, user_id: str, known_version: int, wait: float) -> None:
+        waiter = chessmenWaiter(connection, user_id, known_version, time.time() + wait)
+        self.waiters.setdefault(user_id, []).append(waiter)
+        heapq.heappush(self.waiter_deadlines, (waiter.deadline, next(self.waiter_counter), waiter))
+
+    def _expire_waiters(self) -> None:
+        # answer long-polls whose wait is over
+        now = time.time()
+        while self.waiter_deadlines and self.waiter_deadlines[0][0] <= now:
+            _, _, waiter = heapq.heappop(self.waiter_deadlines)
+            if not waiter.done:
+                waiter.done = True
+                self.waiters[waiter.user_id].remove(waiter)
+                if not self.waiters[waiter.user_id]:
+                    del self.waiters[waiter.user_id]
+                self._reply_status(waiter.connection, waiter.user_id, waiter.known_version)
 
     def handle_request(self, request_type: str, user_id: str, args: List[str]) -> Tuple[str, str]:
         if user_id in self.users:
@@ -118,54 +543,316 @@ class chessmenServer:
                 elif self.users[user_id].status == "in_match":
                     return "error", "user is already in match"
             else:
-                self.users[user_id] = chessmenUser(user_id)
+                self.add_user(user_id)
                 return "success", "user added to match queue"
         elif request_type == "STATUS_MATCH":
-            if user_id in self.users:
-                if self.users[user_id].status == "in_queue":
-                    return "success", "in_queue"
-                elif self.users[user_id].status == "in_match":
-                    match_id = self.users[user_id].match_id
-                    match = self.matches[match_id]
-                    return_args = ['in_match', match.fen, match.white_user_id, match.black_user_id, str(int(match.check_valid_turn(user_id)))]
-                    return "success", '|'.join(return_args)
-            else:
-                return "error", "user is not online"
+            return self.status_match(user_id, int(args[0]) if args else None)
         elif request_type == "UPDATE_MATCH":
+            if self.authoritative:
+                return "error", "server only accepts moves"
             if user_id in self.users:
                 if self.users[user_id].status == "in_queue":
                     return "error", "user not in match"
                 elif self.users[user_id].status == "in_match":
                     match_id = self.users[user_id].match_id
                     match = self.matches[match_id]
+                    if len(args) != 1 or not chessmenBoardUtility.verify_fen(args[0]): # checked before it is stored (or parsed)
+                        return "error", "invalid fen"
                     if match.check_valid_turn(user_id):
-                        match.fen = args[0]
+                        match.update_fen(args[0])
+                        self.store.log_update(match.match_id, match.fen, match.version)
+                        self._after_change(match)
                         return "success", "fen has been updated"
                     else:
                         return "error", "not user turn yet"
             else:
-                return "error", "user is not online"
+                return "error", "match is over" if user_id in self.finished else "user is not online"
+        elif request_type == "MAKE_MOVE":
+            # args: start notation, target notation, promotion piece (empty if none)
+            if len(args) != 3 or not chessmenBoardUtility.verify_notation(args[0]) or not chessmenBoardUtility.verify_notation(args[1]):
+                return "error", "invalid move format"
+            start_coord = chessmenBoardUtility.notation2coord(args[0])
+            target_coord = chessmenBoardUtility.notation2coord(args[1])
+            return self.make_move(user_id, start_coord, target_coord, args[2].lower() if args[2] else None)
+        # anything else (including the shard requests of a cluster on a server that is not a shard) is answered, never left hanging
+        return "error", "unknown request"
 
-    def run(self):
-        while True:
-            (client, address) = self.skt.accept()            
-            request_type, user_id, args = client.recv(BUFFER_SIZE).decode().split("::")
-            date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            args = args.split('|') if args else []
-            print(f"{request_type} [{date}] {user_id} ({address})")
+    def make_move(self, user_id: str, start_coord: COORD, target_coord: COORD, promotion: Optional[str]) -> Tuple[str, str]:
+        if user_id in self.users:
+            if self.users[user_id].status == "in_queue":
+                return "error", "user not in match"
+            elif self.users[user_id].status == "in_match":
+                match_id = self.users[user_id].match_id
+                match = self.matches[match_id]
+                if not match.check_valid_turn(user_id):
+                    return "error", "not user turn yet"
+                if match.make_move(start_coord, target_coord, promotion):
+                    self.store.log_update(match.match_id, match.fen, match.version)
+                    self._after_change(match)
+                    return "success", "move has been made"
+                else:
+                    return "error", "illegal move"
+        else:
+            return "error", "match is over" if user_id in self.finished else "user is not online"
 
-            # refresh the server before processing request
-            if time.time() - self.last_refresh_time >= SERVER_MIN_REFRESH_TIME:
-                self.last_refresh_time = time.time()
-                self.refresh()
+    def _after_change(self, match: chessmenMatch) -> None:
+        # ends the match if the game is over, otherwise pushes the change (and lets a bot reply)
+        game_status = match.game_status()
+        if game_status != 'ongoing':
+            self.end_match(match, game_status)
+            return
+        self.notify(match.white_user_id)
+        self.notify(match.black_user_id)
+        self._bot_turn(match)
 
+    def process_request(self, request: str, connection: chessmenConnection) -> Optional[Tuple[str, str]]:
+        # returns None if the request was parked and is answered later
+        request_type, user_id, args = request.split("::")
+        args = args.split('|') if args else []
+        logger.debug("request type=%s user=%s address=%s", request_type, user_id, connection.address)
+        return self.dispatch(request_type, user_id, args, connection)
+
+    def process_binary_request(self, message: bytes, connection: chessmenConnection) -> Optional[bytes]:
+        # binary counterpart of process_request, returns the reply frame (None if parked)
+        if len(message) < HEADER.size:
+            return encode_message(REPLY_ERROR, body=b"malformed message")
+        protocol_version, opcode, version, body = decode_message(message)
+        request_type = REQUEST_TYPES.get(opcode)
+        user_id = connection.user_id
+        if protocol_version != PROTOCOL_VERSION or request_type == None:
+            return encode_message(REPLY_ERROR, body=b"unsupported request")
+        logger.debug("request type=%s user=%s address=%s binary", request_type, user_id, connection.address)
+        if request_type not in ("STATUS_MATCH", "SUBSCRIBE_MATCH", "MAKE_MOVE"): # nothing binary specific
+            try:
+                args = [body.decode()] if body else []
+            except UnicodeDecodeError:
+                return encode_message(REPLY_ERROR, body=b"malformed message")
+            status, payload = self.dispatch(request_type, user_id, args, connection)
+            return encode_message(REPLY_SUCCESS if status == "success" else REPLY_ERROR, body=payload.encode())
+        with self.state:
+            if user_id in self.users:
+                self.users[user_id].refresh_ping()
+            if request_type == "MAKE_MOVE":
+                if len(body) != MOVE.size or not valid_move(MOVE.unpack(body)[0]):
+                    return encode_message(REPLY_ERROR, body=b"invalid move format")
+                status, payload = self.make_move(user_id, *decode_move(MOVE.unpack(body)[0]))
+                return encode_message(REPLY_SUCCESS if status == "success" else REPLY_ERROR, body=payload.encode())
+            elif request_type == "SUBSCRIBE_MATCH":
+                if user_id in self.users:
+                    self.subscribers[user_id] = connection
+                    connection.subscribed_user_id = user_id
+                return self.binary_status(connection, user_id, None)
+            # STATUS_MATCH, known version in the header and (optionally) how long to wait for a newer one in the body
+            known_version = None if version == NO_VERSION else version
+            wait = min(WAIT.unpack(body)[0], LONG_POLL_TIMEOUT) if len(body) == WAIT.size else 0
+            if known_version != None and wait > 0 and user_id in self.users and self.match_version(user_id) == known_version:
+                self._park(connection, user_id, known_version, wait)
+                return None
+            return self.binary_status(connection, user_id, known_version)
+
+    def dispatch(self, request_type: str, user_id: str, args: List[str], connection: chessmenConnection) -> Optional[Tuple[str, str]]:
+        with self.state:
             # special kill command to stop server remotely
             if request_type == "KILLSWITCH":
-                client.send("success::killing server".encode())
-                client.close()
-                break
+                self.running = False
+                logger.info("killswitch user=%s", user_id)
+                return "success", "killing server"
+            # full state goes to the server log, only the counts go back
+            elif request_type == "DUMP_STATE":
+                logger.info("state dump user=%s\n%s", user_id, self.dump_state())
+                return "success", f"dumped {len(self.users)} users and {len(self.matches)} matches to the server log"
+            # handoff between shards: the dispatcher takes a queued user off its shard (without notifying it) ...
+            elif request_type == "RELEASE_USER" and self.sharded:
+                if user_id in self.users and self.users[user_id].status == "in_queue":
+                    self.match_queue.remove(user_id)
+                    del self.users[user_id]
+                    return "success", "user released"
+                return "error", "user is not in queue"
+            # ... and hands the match of two released users to the shard that owns the match
+            elif request_type == "ADOPT_MATCH" and self.sharded:
+                match_id, white_user_id, black_user_id = args
+                match = chessmenMatch(match_id=match_id, white_user_id=white_user_id, black_user_id=black_user_id)
+                self.matches[match_id] = match
+                self.store.log_create(match.match_id, match.white_user_id, match.black_user_id, match.fen, match.version)
+                for adopted_user_id in (white_user_id, black_user_id):
+                    self.finished.pop(adopted_user_id, None)
+                    user = chessmenUser(adopted_user_id, status='in_match', match_id=match_id)
+                    self.users[adopted_user_id] = user
+                    self._track_idle(user)
+                # users that stay on this shard keep their subscription and parked long-polls, they are answered here
+                # (the dispatcher only repeats those on the new shard when the users move)
+                for adopted_user_id in (white_user_id, black_user_id):
+                    self.notify(adopted_user_id)
+                logger.info("match adopted match=%s white=%s black=%s", match_id, white_user_id, black_user_id)
+                return "success", "match adopted"
+            # the dispatcher is told about removed users on the connection it watches them with
+            elif request_type == "WATCH_USERS" and self.sharded:
+                self.cluster_connection = connection
+                return "success", "watching users"
+            # a restarted dispatcher rebuilds its routes from the users of the matches a shard recovered
+            elif request_type == "LIST_USERS" and self.sharded:
+                return "success", '|'.join(user_id for user_id, user in self.users.items() if user.status == "in_match")
+            # subscription replies with the current status, later updates are pushed on the same connection
+            elif request_type == "SUBSCRIBE_MATCH":
+                if not connection.persistent:
+                    return "error", "subscription needs a persistent connection"
+                if user_id in self.users:
+                    self.users[user_id].refresh_ping()
+                    self.subscribers[user_id] = connection
+                    connection.subscribed_user_id = user_id
+                return self.status_match(user_id)
+            # long-poll: args are the known version and (optionally) how long to wait for a newer one
+            elif request_type == "STATUS_MATCH" and len(args) > 1 and user_id in self.users:
+                self.users[user_id].refresh_ping()
+                known_version = int(args[0])
+                wait = min(float(args[1]), LONG_POLL_TIMEOUT)
+                if wait > 0 and self.match_version(user_id) == known_version:
+                    self._park(connection, user_id, known_version, wait)
+                    return None
+                return self.status_match(user_id, known_version)
             # handling client requests
             else:
-                status, payload = self.handle_request(request_type, user_id, args)
-                client.send(f"{status}::{payload}".encode())
-                client.close()
+                return self.handle_request(request_type, user_id, args)
+
+    def _accept(self) -> None:
+        try:
+            (client, address) = self.skt.accept()
+        except BlockingIOError:
+            return
+        client.setblocking(False)
+        self.selector.register(client, selectors.EVENT_READ, chessmenConnection(client, address))
+
+    def _close(self, connection: chessmenConnection) -> None:
+        if not connection.closed:
+            connection.closed = True
+            if self.subscribers.get(connection.subscribed_user_id) is connection:
+                del self.subscribers[connection.subscribed_user_id]
+            self.selector.unregister(connection.skt)
+            connection.skt.close()
+
+    def _send(self, connection: chessmenConnection, data: bytes) -> None:
+        if connection.closed:
+            return
+        connection.out_buffer += data
+        self._write(connection)
+
+    def _reply(self, connection: chessmenConnection, status: str, payload: str) -> None:
+        if connection.persistent:
+            self._send(connection, encode_frame(f"{status}::{payload}".encode()))
+        else:
+            connection.close_after_write = True
+            self._send(connection, f"{status}::{payload}".encode())
+
+    def _write(self, connection: chessmenConnection) -> None:
+        try:
+            sent = connection.skt.send(connection.out_buffer)
+            del connection.out_buffer[: sent]
+        except BlockingIOError:
+            pass
+        except socket.error:
+            self._close(connection)
+            return
+        if connection.out_buffer: # wait until the socket can take the rest
+            self.selector.modify(connection.skt, selectors.EVENT_READ | selectors.EVENT_WRITE, connection)
+        elif connection.close_after_write:
+            self._close(connection)
+        else:
+            self.selector.modify(connection.skt, selectors.EVENT_READ, connection)
+
+    def _frames(self, connection: chessmenConnection, data: bytes) -> List[bytes]:
+        # complete frames of a persistent connection, which is dropped if it announces a frame over the size limit
+        connection.in_buffer += data
+        try:
+            return decode_frames(connection.in_buffer)
+        except ValueError as e:
+            logger.warning("connection dropped address=%s error=%s", connection.address, e)
+            self._close(connection)
+            return []
+
+    def _read(self, connection: chessmenConnection) -> None:
+        try:
+            data = connection.skt.recv(BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        except socket.error:
+            data = b''
+        if not data: # client closed the connection
+            self._close(connection)
+            return
+        if connection.binary:
+            for message in self._frames(connection, data):
+                response = self.process_binary_request(message, connection)
+                if response != None:
+                    self._send(connection, response)
+        elif connection.persistent:
+            for request in self._frames(connection, data):
+                response = self.process_request(request.decode(), connection)
+                if response != None:
+                    self._reply(connection, *response)
+        else:
+            request = data.decode()
+            # persistent handshake, the connection then carries framed requests
+            if request.startswith("PERSIST::"):
+                _, user_id, args = request.split("::")
+                connection.persistent = True
+                if args == "binary": # binary messages from now on, for this user
+                    connection.binary = True
+                    connection.user_id = user_id
+                    self._send(connection, f"success::binary protocol v{PROTOCOL_VERSION}".encode())
+                else:
+                    self._send(connection, "success::persistent connection".encode())
+            # one-shot request
+            else:
+                response = self.process_request(request, connection)
+                if response != None:
+                    self._reply(connection, *response)
+
+    def run(self):
+        self.running = True
+        self.selector.register(self.skt, selectors.EVENT_READ, None)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, None)
+        self.expiry_thread.start()
+        while self.running:
+            with self.state:
+                self._expire_waiters()
+            timeout = SELECT_TIMEOUT
+            if self.waiter_deadlines: # wake up in time for the next long-poll deadline
+                timeout = max(0, min(timeout, self.waiter_deadlines[0][0] - time.time()))
+            for key, events in self.selector.select(timeout=timeout):
+                if key.fileobj is self.wakeup_recv:
+                    self._drain_notifications()
+                    continue
+                if key.data == None:
+                    self._accept()
+                    continue
+                connection: chessmenConnection = key.data
+                if events & selectors.EVENT_WRITE:
+                    self._write(connection)
+                if events & selectors.EVENT_READ and not connection.closed:
+                    try:
+                        self._read(connection)
+                    except Exception: # a malformed request costs the client its connection, never the server
+                        logger.exception("request failed, connection dropped address=%s", connection.address)
+                        self._close(connection)
+                if not self.running:
+                    break
+        # flush pending replies (like the killswitch response) before shutting down
+        for key in list(self.selector.get_map().values()):
+            if key.data != None:
+                if key.data.out_buffer:
+                    key.data.skt.setblocking(True)
+                    key.data.skt.sendall(key.data.out_buffer)
+                key.data.skt.close()
+        self.selector.close()
+        self.skt.close()
+        self.expiry_thread.join()
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
+        if self.bot_pool != None:
+            self.bot_pool.terminate()
+            self.bot_pool.join()
+        self.store.close()
+        if self.archive != None:
+            self.archive.close()
+        logger.info("server stopped")
+        stop_logging()
@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import threading
+from typing import Dict, List, Any
+
+from .engine import FEN
+from .logger import get_logger
+
+WAL_FLUSH_INTERVAL = 0.01 # seconds, records of all requests within it share one fsync
+WAL_SNAPSHOT_RECORDS = 10000 # records after which the log is compacted into a snapshot
+SNAPSHOT_FILE = "snapshot.json"
+SEGMENT_FILE = "wal_{:08d}.log"
+
+logger = get_logger("store")
+
+MATCH_RECORD = Dict[str, Any] # white_user_id, black_user_id, fen, version
+
+class chessmenMatchStore:
+    """ chessmenMatchStore is the persistence interface of the server, this one keeps nothing """
+    def recover(self) -> Dict[str, MATCH_RECORD]:
+        # matches that were live when the store was last closed (or crashed)
+        return {}
+
+    def log_create(self, match_id: str, white_user_id: str, black_user_id: str, fen: FEN, version: int) -> None:
+        pass
+
+    def log_update(self, match_id: str, fen: FEN, version: int) -> None:
+        pass
+
+    def log_remove(self, match_id: str) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+class chessmenWALStore(chessmenMatchStore):
+    """ chessmenWALStore appends match changes to a write-ahead log, flushed in batches and compacted into snapshots """
+    def __init__(self, directory: str, flush_interval: float = WAL_FLUSH_INTERVAL, snapshot_records: int = WAL_SNAPSHOT_RECORDS) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.snapshot_records = snapshot_records
+        # match state as of the flushed records (what a snapshot is written from)
+        self.matches: Dict[str, MATCH_RECORD] = {}
+        self.segment = self._replay()
+        # always continue in a new segment, the last one may end in a torn record
+        self.wal = open(self._segment_path(self.segment), 'a')
+        self.records_since_snapshot = 0
+        self.buffer: List[Dict[str, Any]] = []
+        self.mutex = threading.Lock()
+        self.running = True
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, SEGMENT_FILE.format(segment))
+
+    def _segments(self) -> List[int]:
+        return sorted(int(name[4: -4]) for name in os.listdir(self.directory) if name.startswith("wal_") and name.endswith(".log"))
+
+    @staticmethod
+    def _apply(matches: Dict[str, MATCH_RECORD], record: Dict[str, Any]) -> None:
+        if record["op"] == "create":
+            matches[record["match_id"]] = {key: record[key] for key in ("white_user_id", "black_user_id", "fen", "version")}
+        elif record["op"] == "update" and record["match_id"] in matches:
+            matches[record["match_id"]].update(fen=record["fen"], version=record["version"])
+        elif record["op"] == "remove":
+            matches.pop(record["match_id"], None)
+
+    def _replay(self) -> int:
+        # load the snapshot and the segments after it, returns the segment to write next
+        first_segment = 0
+        snapshot_path = os.path.join(self.directory, SNAPSHOT_FILE)
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path) as f:
+                snapshot = json.load(f)
+            self.matches = snapshot["matches"]
+            first_segment = snapshot["segment"]
+        segments = [segment for segment in self._segments() if segment >= first_segment]
+        for segment in segments:
+            with open(self._segment_path(segment)) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError: # torn write at the crash, nothing after it was flushed
+                        break
+                    self._apply(self.matches, record)
+        return max(segments + [first_segment - 1]) + 1
+
+    def recover(self) -> Dict[str, MATCH_RECORD]:
+        return {match_id: dict(record) for match_id, record in self.matches.items()}
+
+    def _append(self, record: Dict[str, Any]) -> None:
+        # request path: no io here, the flusher thread writes it
+        with self.mutex:
+            self.buffer.append(record)
+
+    def log_create(self, match_id: str, white_user_id: str, black_user_id: str, fen: FEN, version: int) -> None:
+        self._append({"op": "create", "match_id": match_id, "white_user_id": white_user_id, "black_user_id": black_user_id, "fen": fen, "version": version})
+
+    def log_update(self, match_id: str, fen: FEN, version: int) -> None:
+        self._append({"op": "update", "match_id": match_id, "fen": fen, "version": version})
+
+    def log_remove(self, match_id: str) -> None:
+        self._append({"op": "remove", "match_id": match_id})
+
+    def flush(self) -> None:
+        # group commit: every buffered record is written and synced with a single fsync
+        with self.mutex:
+            records, self.buffer = self.buffer, []
+        if not records:
+            return
+        self.wal.write(''.join(json.dumps(record) + '\n' for record in records))
+        self.wal.flush()
+        os.fsync(self.wal.fileno())
+        for record in records:
+            self._apply(self.matches, record)
+        self.records_since_snapshot += len(records)
+        if self.records_since_snapshot >= self.snapshot_records:
+            self.snapshot()
+
+    def snapshot(self) -> None:
+        # the snapshot covers every segment before the new one, so those can go
+        self.wal.close()
+        self.segment += 1
+        self.wal = open(self._segment_path(self.segment), 'a')
+        snapshot_path = os.path.join(self.directory, SNAPSHOT_FILE)
+        with open(snapshot_path + ".tmp", 'w') as f:
+            json.dump({"segment": self.segment, "matches": self.matches}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(snapshot_path + ".tmp", snapshot_path)
+        for segment in self._segments():
+            if segment < self.segment:
+                os.remove(self._segment_path(segment))
+        self.records_since_snapshot = 0
+        logger.info("store snapshot directory=%s matches=%d segment=%d", self.directory, len(self.matches), self.segment)
+
+    def _flush_loop(self) -> None:
+        while self.running:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def close(self) -> None:
+        self.running = False
+        self.flusher.join()
+        self.flush()
+        self.wal.close()
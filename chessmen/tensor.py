@@ -0,0 +1,85 @@
+from typing import Sequence, Optional
+
+import numpy as np # only needed for tensors, so not imported by the package itself
+
+from .engine import FEN
+from .bitboard import PIECES
+
+# planes follow bitboard.PIECES (white pieces then black ones), rows and cols follow the board (row 0 is rank 8)
+PLANES = len(PIECES)
+# side to move (1 for white), castling rights K Q k q, en passant file (1 to 8, 0 if there is none)
+FEATURES = 6
+START_COUNTS = np.array([8, 2, 2, 2, 1, 1] * 2, dtype=np.int16) # per plane
+
+# lookups by character code
+_CHAR_WIDTHS = np.zeros(256, dtype=np.int16) # squares covered by the character of a board string
+_CHAR_PLANES = np.full(256, PLANES, dtype=np.intp) # PLANES for characters that are not pieces
+for _digit in '12345678':
+    _CHAR_WIDTHS[ord(_digit)] = int(_digit)
+for _plane, _piece in enumerate(PIECES):
+    _CHAR_WIDTHS[ord(_piece)] = 1
+    _CHAR_PLANES[ord(_piece)] = _plane
+_SPACE, _SLASH = ord(' '), ord('/')
+
+def _fen_chars(fens: Sequence[FEN]) -> np.ndarray:
+    # (N, longest fen) character codes, padded with zeros
+    chars = np.array(fens, dtype=np.bytes_)
+    return chars.view(np.uint8).reshape(len(fens), chars.itemsize)
+
+def _check_out(out: Optional[np.ndarray], shape: tuple) -> np.ndarray:
+    if out is None:
+        return np.zeros(shape, dtype=np.uint8)
+    if out.shape != shape or out.dtype != np.uint8 or not out.flags.c_contiguous:
+        raise ValueError(f"out has to be a contiguous uint8 array of shape {shape}")
+    out[...] = 0
+    return out
+
+def fens2planes(fens: Sequence[FEN], out: Optional[np.ndarray] = None) -> np.ndarray:
+    # (N, 12, 8, 8) piece planes of the fens (or bare board strings), written into out if given (which can be a slice of a larger batch)
+    # the whole batch is decoded at once: a square is the running sum of the widths of the characters before it
+    planes = _check_out(out, (len(fens), PLANES, 8, 8))
+    if len(fens) == 0:
+        return planes
+    chars = _fen_chars(fens)
+    chars[np.cumsum(chars == _SPACE, axis=1) > 0] = 0 # only the board string, up to the first space
+    widths = _CHAR_WIDTHS[chars]
+    squares = np.cumsum(widths, axis=1) - widths
+    slashes = chars == _SLASH
+    # a board string covers 64 squares in 8 rows of 8, with nothing but pieces, digits and slashes
+    invalid = (widths.sum(axis=1) != 64) | (slashes.sum(axis=1) != 7)
+    invalid |= (slashes & (squares != 8 * np.cumsum(slashes, axis=1))).any(axis=1)
+    invalid |= ((widths == 0) & ~slashes & (chars != 0)).any(axis=1)
+    if invalid.any():
+        raise ValueError(f"invalid board string in fen {fens[int(np.argmax(invalid))]}")
+    piece_planes = _CHAR_PLANES[chars]
+    rows, cols = np.nonzero(piece_planes < PLANES)
+    planes.reshape(len(fens), PLANES * 64)[rows, piece_planes[rows, cols] * 64 + squares[rows, cols]] = 1
+    return planes
+
+def fens2features(fens: Sequence[FEN], out: Optional[np.ndarray] = None) -> np.ndarray:
+    # (N, FEATURES) side to move, castling and en passant of the fens, written into out if given
+    features = _check_out(out, (len(fens), FEATURES))
+    if len(fens) == 0:
+        return features
+    chars = _fen_chars(fens)
+    fields = np.cumsum(chars == _SPACE, axis=1) # field index of every character
+    invalid = fields[:, -1] != 5
+    if invalid.any():
+        raise ValueError(f"invalid fen {fens[int(np.argmax(invalid))]}")
+    batch = np.arange(len(fens))
+    features[:, 0] = chars[batch, np.argmax(fields == 1, axis=1) + 1] == ord('w') # first field char is the space before it
+    castling = np.where(fields == 2, chars, 0)
+    for column, right in enumerate('KQkq', start=1):
+        features[:, column] = (castling == ord(right)).any(axis=1)
+    en_passant = chars[batch, np.argmax(fields == 3, axis=1) + 1].astype(np.int16)
+    features[:, 5] = np.where(en_passant == ord('-'), 0, en_passant - ord('a') + 1)
+    return features
+
+def material_counts(planes: np.ndarray) -> np.ndarray:
+    # (N, 12) number of pieces on every plane
+    return planes.sum(axis=(2, 3), dtype=np.uint8)
+
+def missing_pieces(planes: np.ndarray) -> np.ndarray:
+    # (N, 12) pieces captured off every plane, same as chessmenBoardUtility.get_missing_pieces (promotions never count as negative)
+    missing = START_COUNTS - material_counts(planes).astype(np.int16)
+    return np.clip(missing, 0, None).astype(np.uint8)
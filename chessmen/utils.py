@@ -1,9 +1,14 @@
 import os
 import yaml
+import struct
 import random
+import socket
 import hashlib
+import itertools
 import threading
-from typing import Dict, Tuple, Union, Any
+import multiprocessing.pool
+from collections import OrderedDict, deque
+from typing import Dict, List, Tuple, Union, Any, Hashable, Optional, Callable, Iterable, Iterator
 
 class sharedMem:
     """ sharedMem is a small wrapper on threading mutex object """
@@ -16,10 +21,97 @@ class sharedMem:
 
     def unlock(self) -> None:
         self.mutex.release()
+
+    def __enter__(self) -> Any:
+        self.lock()
+        return self.data
+
+    def __exit__(self, *args) -> None:
+        self.unlock()
     
     def __str__(self) -> str:
         return str(self.data)
 
+class LRUCache:
+    """ LRUCache is a bounded mapping that evicts the least recently used entry """
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.data: OrderedDict = OrderedDict()
+        self.mutex = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.mutex:
+            value = self.data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.data.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self.mutex:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            if len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.mutex:
+            self.data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.data), 'max_size': self.max_size}
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+FRAME_HEADER = struct.Struct('!I') # 4 byte big-endian payload length
+MAX_FRAME_SIZE = 64 * 1024 # bytes, far above any request or reply (a fen is under 100 bytes)
+
+def recv_exact(skt: socket.socket, size: int) -> Optional[bytes]:
+    data = bytearray()
+    while len(data) < size:
+        chunk = skt.recv(size - len(data))
+        if not chunk: # connection closed
+            return None
+        data += chunk
+    return bytes(data)
+
+def encode_frame(payload: bytes) -> bytes:
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+def _frame_size(header: bytes) -> int:
+    (size, ) = FRAME_HEADER.unpack_from(header)
+    if size > MAX_FRAME_SIZE: # a peer announcing a huge frame would make the reader buffer without limit
+        raise ValueError(f"frame of {size} bytes is over the limit of {MAX_FRAME_SIZE}")
+    return size
+
+def decode_frames(buffer: bytearray) -> List[bytes]:
+    # pops every complete frame from the front of the buffer, partial frames stay in it
+    # ValueError if a frame is over MAX_FRAME_SIZE (the connection should be dropped)
+    frames = []
+    while len(buffer) >= FRAME_HEADER.size:
+        size = _frame_size(buffer)
+        if len(buffer) < FRAME_HEADER.size + size:
+            break
+        frames.append(bytes(buffer[FRAME_HEADER.size: FRAME_HEADER.size + size]))
+        del buffer[: FRAME_HEADER.size + size]
+    return frames
+
+def send_frame(skt: socket.socket, payload: bytes) -> None:
+    skt.sendall(encode_frame(payload))
+
+def recv_frame(skt: socket.socket) -> Optional[bytes]:
+    header = recv_exact(skt, FRAME_HEADER.size)
+    if header == None:
+        return None
+    return recv_exact(skt, _frame_size(header))
+
 def load_yaml(path: str) -> Dict:
     with open(path, 'r') as f:
         data = yaml.load(f, Loader=yaml.SafeLoader)
@@ -43,3 +135,17 @@ def random_hash(slen: int) -> str:
 
 def string_hash(val: str) -> str:
     return hashlib.md5(val.encode()).hexdigest()
+
+def _map_chunk(func: Callable[[Any], Any], chunk: List[Any]) -> List[Any]:
+    return [func(item) for item in chunk]
+
+def imap_bounded(pool: multiprocessing.pool.Pool, func: Callable[[Any], Any], iterable: Iterable[Any], chunk_size: int, max_in_flight: int) -> Iterator[Any]:
+    # pool.imap, but reading the input only as far as max_in_flight chunks ahead of the consumer (pool.imap reads all of it), results in input order
+    iterator = iter(iterable)
+    pending = deque()
+    for chunk in iter(lambda: list(itertools.islice(iterator, chunk_size)), []):
+        if len(pending) >= max_in_flight:
+            yield from pending.popleft().get()
+        pending.append(pool.apply_async(_map_chunk, (func, chunk)))
+    while pending:
+        yield from pending.popleft().get()
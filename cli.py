@@ -1,5 +1,4 @@
 import os
-import time
 import argparse
 from typing import Tuple
 
@@ -78,24 +77,35 @@ class chessmenCLILocal:
     def run(self) -> None:
         while True:
             display_board(self.board_state, black_side_view=(self.board_state.active_color == 'black'), flush=True)
+            game_status = CBU.game_status(self.board_state)
+            if game_status != 'ongoing':
+                print(f'game over: {game_status}')
+                break
             move = prompt_user(f"({self.board_state.active_color})", self.board_state, self.board_state.active_color)
             self.board_state.update(move)
 
 class chessmenCLI:
-    REFRESH_TIME = 1 # seconds
-
     def __init__(self, user_id: str) -> None:
-        self.client = chessmenClient(user_id=user_id)
+        self.client = chessmenClient(user_id=user_id, binary=True)
         self.user_id = self.client.user_id
         assert self.client.find_match()
+        assert self.client.subscribe_match()
     
     def run(self) -> None:
         while True:
-            status = self.client.status_match()
+            # blocks until the server pushes a change (opponent found or match updated)
+            status = self.client.wait_match_update()
             if status == None: # match does not exist / has stopped
                 break
             status, payload = status
-            # status: in_queue or in_match
+            # status: in_queue, in_match or match_over
+            if status == 'match_over':
+                fen, users, user_color, _ = payload
+                display_board(CBU.fen2board_state(fen), black_side_view=(user_color == 'black'), flush=True)
+                white_score, reason = self.client.match_result
+                result = "draw" if white_score == 0.5 else "white wins" if white_score == 1 else "black wins"
+                print(f"match over: {reason}, {result}")
+                break
             if status == 'in_match':
                 fen, users, user_color, user_turn = payload
                 board_state = CBU.fen2board_state(fen)
@@ -104,9 +114,7 @@ class chessmenCLI:
                     move = prompt_user(f"({self.user_id}-{user_color})", board_state, user_color)
                     board_state.update(move)
                     display_board(board_state, black_side_view=(user_color == 'black'), flush=True)
-                    fen = CBU.board_state2fen(board_state)
-                    self.client.update_match(fen)
-            time.sleep(self.REFRESH_TIME)
+                    self.client.make_move(move)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='chessmen client CLI interface')
@@ -70,6 +70,7 @@ class chessmenBoard:
         self.black_side_view = user_color == 'black'
         self.user_turn = user_turn
         self.response_ready = False
+        self.response_move: Optional[chessmenMove] = None
 
     def draw_wait_screen(self, avour: Avour) -> None:
         avour.color(self.C_WHITE)
@@ -275,6 +276,7 @@ class chessmenBoard:
             # then update server response
             self.user_turn = False
             self.response_ready = True
+            self.response_move = selected_move
             # then remove selection
             self._reset_piece_selection()
     
@@ -367,20 +369,18 @@ class chessmenGUILocal(Avour):
             self.board.response_ready = False
 
 class chessmenGUI(Avour):
-    REFRESH_TIME = 1 # seconds
-
     def __init__(self, user_id: str) -> None:
         super().__init__(screen_title='chessmen online', show_fps=True)
         self.set_frame_rate(80)
         screen_size = self.get_screen_size()
         self.translate((screen_size[0] / 2, screen_size[1] / 2))
         
-        self.client = chessmenClient(user_id=user_id)
+        self.client = chessmenClient(user_id=user_id, binary=True)
         self.board = chessmenBoard(screen_size)
         assert self.client.find_match()
+        assert self.client.subscribe_match()
 
         self.last_status = None
-        self.last_status_time = time.time()
 
     def on_keydown(self, key: str) -> None:
         if key == 'Q' or key == 'ESCAPE':
@@ -399,31 +399,30 @@ class chessmenGUI(Avour):
         self.board.draw(self, status=self.last_status)
 
     def loop(self, dt: float) -> None:
-        if time.time() - self.last_status_time > self.REFRESH_TIME:
-            status = self.client.status_match()
-            if status == None: # match does not exist / has stopped
-                self.exit()
-            status, payload = status
-            # status: in_queue or in_match
-            if status == 'in_match':
-                fen, users, user_color, user_turn = payload
-                # if it is the user's turn
-                # and if there is a waiting response from user
-                # send it to server and clear it
-                if user_turn and self.board.response_ready:
-                    fen = CBU.board_state2fen(self.board.board_state)
-                    self.client.update_match(fen)
-                    self.board.response_ready = False
-                    return
-                # set board variables (including user_turn, response_ready)
-                self.board.set_board(
-                    fen=fen,
-                    users=users,
-                    user_color=user_color,
-                    user_turn=user_turn
-                )
-            self.last_status = status
-            self.last_status_time = time.time()
+        # if there is a waiting response from user
+        # send it to server and clear it
+        if self.board.response_ready:
+            self.client.make_move(self.board.response_move)
+            self.board.response_ready = False
+        # pick up pushed updates without blocking the frame
+        status = self.client.wait_match_update(timeout=0)
+        if status == None: # match does not exist / has stopped
+            self.exit()
+            return
+        status, payload = status
+        if status == 'no_update':
+            return
+        # status: in_queue, in_match or match_over (final position, never the user's turn)
+        if status in ('in_match', 'match_over'):
+            fen, users, user_color, user_turn = payload
+            # set board variables (including user_turn, response_ready)
+            self.board.set_board(
+                fen=fen,
+                users=users,
+                user_color=user_color,
+                user_turn=user_turn
+            )
+        self.last_status = status
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='chessmen client GUI interface')
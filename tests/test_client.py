@@ -0,0 +1,20 @@
+from chessmen.client import chessmenClient
+from chessmen.engine import START_FEN
+from chessmen.utils import FRAME_HEADER
+from chessmen.protocol import REPLY_IN_MATCH, REPLY_MOVES, encode_move, encode_message, match_flags, encode_match, encode_moves
+
+def reply(opcode: int, version: int, body: bytes) -> bytes:
+    # message as the client reads it off a frame
+    return encode_message(opcode, version, body)[FRAME_HEADER.size: ]
+
+def test_moves_that_do_not_fit_the_board_resync():
+    client = chessmenClient("alice", binary=True)
+    status, payload = client._decode_reply(reply(REPLY_IN_MATCH, 1, encode_match(match_flags(True, True), START_FEN, "bob")))
+    assert status == "success" and payload.startswith("in_match|" + START_FEN)
+    e2e4 = encode_move((6, 4), (4, 4), None)
+    status, payload = client._decode_reply(reply(REPLY_MOVES, 2, encode_moves(match_flags(False, True), [e2e4])))
+    assert status == "success" and payload.split('|')[5] == "2"
+    e2e5 = encode_move((6, 4), (3, 4), None) # no piece on e2 any more
+    client.match_version = 2
+    assert client._decode_reply(reply(REPLY_MOVES, 3, encode_moves(match_flags(True, True), [e2e5]))) == ("error", "match status out of sync")
+    assert client.binary_match == None and client.match_version == None
@@ -0,0 +1,72 @@
+import time
+import socket
+import threading
+
+import pytest
+
+from chessmen import cluster, client, server
+from chessmen.client import chessmenClient
+from chessmen.cluster import chessmenDispatcher
+
+SERVER_PASSWORD = "hello" # the password of the env.yaml of the repo
+PUSH_TIMEOUT = 5 # seconds
+
+def free_port(shards: int) -> int:
+    # a port with the shard ports after it free as well
+    while True:
+        with socket.socket() as skt:
+            skt.bind(("127.0.0.1", 0))
+            port = skt.getsockname()[1]
+        try:
+            for offset in range(1, shards + 1):
+                with socket.socket() as skt:
+                    skt.bind(("127.0.0.1", port + offset))
+            return port
+        except OSError:
+            continue
+
+@pytest.fixture
+def dispatcher(request, monkeypatch):
+    # a cluster on this host, shards are forked by the dispatcher so they see the patched port too
+    shards = request.param
+    port = free_port(shards)
+    for module in (cluster, client):
+        monkeypatch.setattr(module, "IP_ADDR", "127.0.0.1")
+        monkeypatch.setattr(module, "PORT", port)
+    dispatcher = chessmenDispatcher(SERVER_PASSWORD, shards=shards, log_level="WARNING")
+    thread = threading.Thread(target=dispatcher.run, daemon=True)
+    thread.start()
+    yield dispatcher
+    chessmenClient(server_password=SERVER_PASSWORD).kill_server()
+    thread.join(timeout=10)
+
+# with one shard the queue shard of every user is also the shard of its match, so no subscription is moved
+@pytest.mark.parametrize("dispatcher", [1, 2], indirect=True)
+def test_subscribers_get_pushed_into_match(dispatcher):
+    clients = [chessmenClient(f"sub_{index}", binary=True) for index in range(6)]
+    for player in clients:
+        assert player.find_match()
+        assert player.subscribe_match()
+    for player in clients:
+        status = player.wait_match_update(timeout=PUSH_TIMEOUT)
+        while status != None and status[0] == "in_queue":
+            status = player.wait_match_update(timeout=PUSH_TIMEOUT)
+        assert status != None and status[0] == "in_match", player.user_id
+    for player in clients:
+        player.close()
+
+@pytest.fixture
+def short_idle(monkeypatch):
+    # shards are forked after this, so they expire idle users within a second
+    monkeypatch.setattr(server, "USER_MAX_IDLE_TIME", 1)
+
+@pytest.mark.parametrize("dispatcher", [2], indirect=True)
+def test_idle_users_leave_the_dispatcher_queue(short_idle, dispatcher):
+    idle = chessmenClient("idle")
+    assert idle.find_match()
+    assert idle.user_id in dispatcher.match_queue
+    deadline = time.time() + PUSH_TIMEOUT
+    while idle.user_id in dispatcher.match_queue and time.time() < deadline:
+        time.sleep(0.1)
+    assert idle.user_id not in dispatcher.match_queue
+    assert idle.user_id not in dispatcher.routes
@@ -0,0 +1,35 @@
+import io
+
+import pytest
+
+from chessmen.pgn import read_pgn
+
+GAMES = """[Event "first"]
+[Result "0-1"]
+
+1. f3 e5 2. g4 Qh4# 0-1
+
+[Event "corrupt"]
+[Result "*"]
+
+1. e4 e5 2. Ke3 *
+
+[Event "last"]
+[Result "1-0"]
+
+1. e4 e5 2. Bc4 Nc6 3. Qh5 Nf6 4. Qxf7# 1-0
+"""
+
+@pytest.mark.parametrize("processes", [0, 2])
+def test_corrupt_game_is_skipped(processes, caplog):
+    games = list(read_pgn(io.StringIO(GAMES), processes=processes, chunk_size=1))
+    assert [game.headers["Event"] for game in games] == ["first", "last"]
+    assert [len(game.moves) for game in games] == [4, 7]
+    assert "index=1" in caplog.text
+
+@pytest.mark.parametrize("processes", [0, 2])
+def test_corrupt_game_raises_when_strict(processes):
+    games = read_pgn(io.StringIO(GAMES), processes=processes, chunk_size=1, strict=True)
+    assert next(games).headers["Event"] == "first"
+    with pytest.raises(ValueError):
+        next(games)
@@ -0,0 +1,108 @@
+import time
+import threading
+
+import pytest
+
+from chessmen import client, server as server_module
+from chessmen.client import chessmenClient
+from chessmen.server import chessmenServer
+from chessmen.archive import chessmenArchive
+
+SERVER_PASSWORD = "hello" # the password of the env.yaml of the repo
+
+@pytest.fixture
+def server(monkeypatch):
+    server = chessmenServer(SERVER_PASSWORD, address=("127.0.0.1", 0), log_level="WARNING")
+    monkeypatch.setattr(client, "IP_ADDR", "127.0.0.1")
+    monkeypatch.setattr(client, "PORT", server.skt.getsockname()[1])
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    yield server
+    chessmenClient(server_password=SERVER_PASSWORD).kill_server()
+    thread.join(timeout=10)
+
+def start_match(binary: bool = False, user_ids: tuple = ("alice", "bob")) -> tuple:
+    # the two players of a new match, white first (user ids are used as they are, without the client's cut)
+    players = [chessmenClient(binary=binary), chessmenClient(binary=binary)]
+    for player, user_id in zip(players, user_ids):
+        player.user_id = user_id
+    for player in players:
+        assert player.find_match()
+    if players[0].status_match()[1][2] != 'white':
+        players.reverse()
+    return players
+
+@pytest.mark.parametrize("fen", [
+    "hello world",
+    "8/8/8/8/8/8/8/8 w - - 0 1", # no kings
+    "4k3/8/8/8/8/8/8/4KK2 w - - 0 1", # two white kings
+    "4k3/8/8/8/8/8/8/4K2 w - - 0 1", # short row
+    "4k2P/8/8/8/8/8/8/4K3 w - - 0 1", # pawn on the last rank
+    "4k3/8/8/8/8/8/8/4K3 w K - 0 1", # castling without a rook
+    "4k3/4R3/8/8/8/8/8/4K3 w - - 0 1", # black in check with white to move
+])
+def test_bad_fen_is_rejected(server, fen):
+    white, black = start_match()
+    assert not white.update_match(fen)
+    status, (current_fen, _, _, user_turn) = white.status_match()
+    assert status == "in_match" and user_turn
+    assert white.update_match("4k3/8/8/8/8/8/8/4K2R b K - 0 1")
+    assert black.status_match()[1][0] == "4k3/8/8/8/8/8/8/4K2R b K - 0 1"
+
+@pytest.mark.parametrize("request_type", ["FOO", "RELEASE_USER"])
+def test_unknown_request_is_answered(server, request_type):
+    assert chessmenClient("dave").request(request_type) == ("error", "unknown request")
+
+MATE_FEN = "k7/1Q6/1K6/8/8/8/8/8 b - - 0 1" # black is checkmated
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_finished_match_stays_readable(server, binary):
+    white, black = start_match(binary)
+    black.status_match()
+    # black long-polls on the last position while white ends the match
+    results = []
+    poll = threading.Thread(target=lambda: results.append(black.status_match(wait=5)))
+    poll.start()
+    time.sleep(0.5)
+    assert white.update_match(MATE_FEN)
+    poll.join(timeout=10)
+    assert results == [("match_over", (MATE_FEN, (black.user_id, white.user_id), 'black', False))]
+    assert black.match_result == (1, "checkmate")
+    assert white.status_match()[0] == "match_over" and white.match_result == (1, "checkmate")
+    # moves are refused, looking for a new match acknowledges the result
+    assert not white.update_match(MATE_FEN)
+    assert white.find_match()
+    assert white.status_match() == ("in_queue", None)
+    assert black.status_match()[0] == "match_over"
+
+def test_finished_match_expires(server, monkeypatch):
+    monkeypatch.setattr(server_module, "FINISHED_MATCH_GRACE_TIME", 1)
+    white, black = start_match()
+    assert white.update_match(MATE_FEN)
+    assert black.status_match()[0] == "match_over"
+    time.sleep(2)
+    assert black.status_match() == None
+
+def test_long_user_ids_are_archived(server, tmp_path):
+    server.archive = chessmenArchive(str(tmp_path))
+    white, black = start_match(user_ids=("w" * 300, "b" * 300))
+    assert white.update_match(MATE_FEN)
+    assert black.status_match()[0] == "match_over"
+    assert white.find_match() and white.status_match() == ("in_queue", None)
+    (game, ) = list(server.archive)
+    assert (game.white_user_id, game.black_user_id, game.result) == (white.user_id, black.user_id, 1)
+
+def test_expiry_survives_a_failed_tick(server, monkeypatch):
+    monkeypatch.setattr(server_module, "USER_MAX_IDLE_TIME", 1)
+    refresh, failures = server.refresh, []
+    def failing_refresh():
+        if not failures:
+            failures.append(True)
+            raise RuntimeError("bad tick")
+        return refresh()
+    monkeypatch.setattr(server, "refresh", failing_refresh)
+    player = chessmenClient("carol")
+    assert player.find_match()
+    time.sleep(3)
+    assert failures and server.expiry_thread.is_alive()
+    assert player.status_match() == None # went idle